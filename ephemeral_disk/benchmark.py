@@ -0,0 +1,206 @@
+#-------------------------------------------------------------------------------
+# Name:        Ephemeral Python benchmark
+# Purpose:     Measure how long provisioning takes using loop devices
+#              backed by sparse files, so no EC2 instance is needed
+#
+# Usage:       python benchmark.py --count 2 --size 4G --swap-size 1G --runs 3
+#
+#              Must run as root. Loop devices, mount points and SWAP are
+#              removed once the benchmark is over. With --simulate, disks
+#              are kept in memory (see ephemeral_disk.simulated_backend)
+#              and neither root nor loop devices are needed.
+#-------------------------------------------------------------------------------
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import ephemeral_disk
+
+
+def create_loop_devices(directory, count, size):
+    """ Create count sparse files of size bytes and attach them to loop devices
+        with partition scanning enabled, returning the devices (e.g. /dev/loop0) """
+
+    devices = []
+    for index in range(count):
+        path = os.path.join(directory, 'disk{0}.img'.format(index))
+        with open(path, 'wb') as filename:
+            filename.truncate(size)
+        devices.append(subprocess.check_output(['losetup', '--find', '--show', '--partscan', path]).strip())
+
+    return devices
+
+
+def remove_loop_devices(tools, devices):
+    """ Unmount anything left on the loop devices and detach them """
+
+    release(tools, devices)
+    for device in devices:
+        subprocess.call(['losetup', '--detach', device])
+
+
+def release(tools, devices):
+    """ Unmount and disable SWAP on every partition of the devices, as a reboot
+        does, while partition tables and file systems are kept """
+
+    for device in devices:
+        if tools.check_partition(device) and tools.check_mount_point(device):
+            tools.force_unmount(device)
+
+
+def state(tools, devices):
+    """ Return where each partition of the loop devices ended up (mount points and SWAP) """
+
+    tools.inventory.invalidate()
+    result = {}
+    for device in devices:
+        for partition in tools.inventory.partitions(device):
+            path = os.path.join('/dev', partition)
+            result[path] = tools.mount_usage(path)
+            result[path]['fs_type'] = tools.probe_fs_type(path)
+
+    return result
+
+
+def summary(tools, wall):
+    """ Summarise a run from the tools report """
+
+    report = tools.report()
+    return {'wall': wall,
+            'commands': report['commands'],
+            'processes': report['processes'],
+            'steps': report['steps']}
+
+
+def simulated_disks(count, size):
+    """ Return a simulated backend with count disks of size (xvdb, xvdc...) and their devices """
+
+    names = ['xvd{0}'.format(chr(ord('b') + index)) for index in range(count)]
+    backend = ephemeral_disk.simulated_backend(dict((name, size) for name in names))
+
+    return backend, [os.path.join('/dev', name) for name in names]
+
+
+def bench_pipeline(devices, args, mount_point, idempotent, backend=None):
+    """ Run the whole provisioning (as disks.py does) on all loop devices """
+
+    tools = ephemeral_disk.tools(force=1, backend=backend)
+    started = time.time()
+    results = tools.provision_disks(disks=devices, swap_size=args.swap_size, fs_type=args.fs_type,
+                                    mount_point=mount_point, format_profile=args.format_profile,
+                                    idempotent=idempotent)
+    run = summary(tools, time.time() - started)
+    run['results'] = results
+    run['state'] = state(tools, devices)
+
+    return run
+
+
+def bench_methods(devices, args, mount_point, backend=None):
+    """ Run each method on its own, one device after the other """
+
+    tools = ephemeral_disk.tools(force=1, backend=backend)
+    timings = {}
+
+    def timed(name, function, *arguments):
+        started = time.time()
+        function(*arguments)
+        timings.setdefault(name, []).append(time.time() - started)
+
+    started = time.time()
+    for index, device in enumerate(devices):
+        swap = tools.partition_name(device, '1')
+        data = tools.partition_name(device, '2')
+        disk_mount_point = '{0}{1}'.format(mount_point, index)
+        if not tools.backend.isdir(disk_mount_point):
+            tools.backend.makedirs(disk_mount_point)
+
+        layout = [(args.swap_size, 'swap'), (tools.data_size(device, args.swap_size), 'linux')]
+        timed('write_partition_table', tools.write_partition_table, device, layout)
+        timed('enable_swap', tools.enable_swap, swap)
+        timed('format_as_{0}'.format(args.fs_type), getattr(tools, 'format_as_{0}'.format(args.fs_type)), data, args.format_profile)
+        timed('mount_partition', tools.mount_partition, data, disk_mount_point)
+        timed('force_unmount', tools.force_unmount, device)
+
+    run = summary(tools, time.time() - started)
+    run['methods'] = timings
+    run['state'] = state(tools, devices)
+
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ephemeral_disk provisioning on loop devices')
+    parser.add_argument('--count', type=int, default=2, help='number of loop devices (default: 2)')
+    parser.add_argument('--size', default='4G', help='size of each loop device (default: 4G)')
+    parser.add_argument('--swap-size', default='1G', help='SWAP partition size (default: 1G)')
+    parser.add_argument('--fs-type', default='ext4', choices=['ext3', 'ext4', 'xfs'])
+    parser.add_argument('--format-profile', default='default', choices=sorted(ephemeral_disk.FORMAT_PROFILES))
+    parser.add_argument('--runs', type=int, default=1, help='number of runs of each benchmark (default: 1)')
+    parser.add_argument('--bench', default='all', choices=['all', 'pipeline', 'reboot', 'methods'],
+                        help='pipeline provisions from scratch, reboot provisions again with idempotent=True '
+                             'once mounts and SWAP are gone as after a reboot and methods times each method on its own')
+    parser.add_argument('--directory', help='where sparse files are created (default: a temporary directory)')
+    parser.add_argument('--output', help='write results as JSON to this file rather than stdout')
+    parser.add_argument('--simulate', action='store_true',
+                        help='use in-memory disks rather than loop devices, which measures the overhead of '
+                             'ephemeral_disk itself (no root needed)')
+    args = parser.parse_args()
+
+    if os.geteuid() != 0 and not args.simulate:
+        parser.error('loop devices can only be set up by root')
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    backend = None
+    if args.simulate:
+        directory = None
+        mount_point = '/mnt'
+        backend, devices = simulated_disks(args.count, args.size)
+    else:
+        directory = tempfile.mkdtemp(prefix='ephemeral-bench-', dir=args.directory)
+        mount_point = os.path.join(directory, 'mnt')
+        devices = create_loop_devices(directory, args.count, ephemeral_disk.to_bytes(args.size))
+    results = {'devices': devices, 'size': args.size, 'fs_type': args.fs_type, 'simulate': args.simulate, 'runs': []}
+
+    try:
+        for number in range(args.runs):
+            run = {}
+            if args.bench in ('all', 'pipeline', 'reboot'):
+                run['pipeline'] = bench_pipeline(devices, args, mount_point, False, backend)
+            if args.bench in ('all', 'reboot'):
+                # Only what a reboot undoes is left to do, outside of the time measured
+                release(ephemeral_disk.tools(force=1, backend=backend), devices)
+                run['reboot'] = bench_pipeline(devices, args, mount_point, True, backend)
+            if args.bench in ('all', 'methods'):
+                run['methods'] = bench_methods(devices, args, mount_point, backend)
+            results['runs'].append(run)
+
+            for name, bench in sorted(run.items()):
+                logging.warning('Run {0} {1}: {2:.2f}s, {3} processes'.format(number + 1, name, bench['wall'], bench['processes']))
+    finally:
+        if not args.simulate:
+            remove_loop_devices(ephemeral_disk.tools(force=1), devices)
+
+            # Never remove the directory while something is still mounted inside it
+            mounted = [path for path, dirs, files in os.walk(directory) if os.path.ismount(path)]
+            if mounted:
+                logging.error('{0} still mounted, please remove {1} by hand'.format(', '.join(mounted), directory))
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as filename:
+            json.dump(results, filename, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,25 @@
 import ephemeral_disk
-import os, urllib2
+import sys
 
 # Instantiate instance_tools class into ephemeral
 ephemeral = ephemeral_disk.tools(force=1)
 
-# Get the current instance type of the instance which run this script
-instance_type = urllib2.urlopen('http://169.254.169.254/latest/meta-data/instance-type').read()
+# Create a SWAP partition with 8GB plus a /mnt partition with the space left on every ephemeral disk,
+# format the latter as EXT4 and mount it (/mnt, /mnt1, /mnt2...). All disks are provisioned at the same time
+# (SWAP is set up while the data partition of the same disk is being formatted) and the space left
+# is calculated from the size of each disk, so there is no need to ask for the instance type.
+# On Xen instances, where EBS volumes look the same as ephemeral disks, the block device mapping is read from the
+# metadata service to tell them apart (NVMe disks are told apart by their model), as is the instance type if a disk
+# size cannot be read. Metadata is read with short timeouts and a few retries, and cached in
+# /var/cache/ephemeral_disk/metadata.json for the lifetime of the instance, so a reboot does not read it again.
+# As force is set, the ephemeral disk already mounted in /mnt on a fresh instance is unmounted and provisioned.
+# After a reboot, disks that already match are only mounted again rather than formatted. SWAP can also be grown
+# on demand afterwards with swap_monitor rather than sized here once and for all
+results = ephemeral.provision_disks(swap_size='8G', fs_type='ext4', mount_point='/mnt', idempotent=True)
 
-# Create new SWAP primary partition with 8GB if ephemeral disk was replaced, also create /mnt partition and format it
-ephemeral.create_disk_partition('/dev/xvdb', '8G', '1', instance_type)
+for disk, result in sorted(results.items()):
+    print "{0}: {1} {2}".format(disk, result['status'], result['error'] or result['mount_point'])
 
-# Format new partition as SWAP and enable it afterwards
-ephemeral.enable_swap('/dev/xvdb1')
-
-# Format new partition created as EXT4
-ephemeral.format_as_ext4('/dev/xvdb2')
-
-# Mount as /mnt the new partition
-ephemeral.mount_partition('/dev/xvdb2', '/mnt')
+# Optionally save how long each step took on each device as JSON (e.g. python disks.py /var/log/ephemeral_disk.json)
+if len(sys.argv) > 1:
+    ephemeral.write_report(sys.argv[1])
@@ -11,553 +11,4600 @@
 # NOTES:
 #-------------------------------------------------------------------------------
 
+import io
 import os
+import re
+import stat
+import errno
+import ctypes
+import ctypes.util
+import tarfile
+import json
+import mmap
+import time
+import struct
+import urllib2
+import httplib
+import select
+import socket
 import logging
+import threading
+import subprocess
 from sys import exit
+from fractions import gcd
 
 ## Define logging properties globally as will be used over all code.
 logging.basicConfig(level=logging.INFO, format='Timestamp: %(asctime)s - Level: %(levelname)s - %(message)s')
 
+## Ephemeral disk size (GB) per instance type, only used when the disk size
+## cannot be read from sysfs. Numbers as of May 2014 and they can change.
+EPHEMERAL_SIZES = {
+    'm1.small': 140,
+    'c1.medium': 335,
+    'm1.medium': 390,
+    'm1.large': 410,
+    'm2.xlarge': 410,
+    'm2.2xlarge': 840,
+    'm2.4xlarge': 830,
+    'c1.xlarge': 410,
+    'cc1.4xlarge': 830,
+    'cc2.8xlarge': 830,
+    'cg1.4xlarge': 830,
+    'cr1.8xlarge': 230,
+    'hi1.4xlarge': 830,
+    'hs1.8xlarge': 2014,
+    'm3.medium': 4,
+    'm3.large': 32,
+    'm3.xlarge': 40,
+    'm3.2xlarge': 80,
+    'c3.large': 16,
+    'c3.xlarge': 40,
+    'c3.2xlarge': 80,
+    'c3.4xlarge': 160,
+    'c3.8xlarge': 320,
+    'g2.2xlarge': 60,
+    'r3.large': 32,
+    'r3.xlarge': 80,
+    'r3.2xlarge': 160,
+    'r3.4xlarge': 320,
+    'i2.xlarge': 800,
+    'i2.2xlarge': 800,
+    'i2.4xlarge': 800,
+    'i2.8xlarge': 800}
 
-class tools:
-    """ This class will provide some useful functions to manage
-        EC2 instance resources"""
 
-    def __init__(self, force=0):
-        """ Force parameter can be enabled when you are sure
-            that existing partitions can be deleted while you
-            are trying to create new ones. This also
-            applies for mount_points that can be forced to be
-            unmounted
+## mkfs options per file system for each format profile (see tools.format_partition)
+FORMAT_PROFILES = {
+    'default': {},
+    'fast-boot': {'ext3': '-E nodiscard',
+                  'ext4': '-E lazy_itable_init=1,lazy_journal_init=1,nodiscard',
+                  'xfs': '-K'},
+    'throughput': {'ext3': '-J size=256',
+                   'ext4': '-J size=1024',
+                   'xfs': '-l size=512m',
+                   'stripe': True}}
 
-            Example:
 
-            t = ephemeral_python.tools(force=1)
-            t.create_disk_partition('/dev/xvdb', '1', 'c1.medium')
+## Units accepted in sizes (e.g. 8G or 4M)
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
 
-        """
-        self.force = force
 
-    def create_disk_partition(self, disk, size, part_number, *instances):
-        """ Creates a partition using fdisk using the information given.
+## Sizes are converted here for both tools and simulated_backend
+def to_bytes(size, total=None):
+    """ Convert sizes such as 4M, 512MiB, 8G or 4096 (bytes) to bytes, example:
 
-            Example:
+    to_bytes('25%', 1024 ** 3) returns 268435456
 
-            create_disk_partition('/dev/xvdj', '8G', '1')
+        Units are powers of 1024 whether written as M or MiB. Percentages
+        are taken of total. Raises ValueError if size cannot be understood.
+    """
 
-            This will create the first primary partition in /dev/xvdj
-            with 8GB size.
+    size = str(size).strip()
+    if size.endswith('%'):
+        if total is None:
+            raise ValueError('Size {0} is a percentage but the total size is unknown'.format(size))
+        percentage = float(size[:-1])
+        if not 0 < percentage <= 100:
+            raise ValueError('Size {0} must be a percentage between 0 and 100'.format(size))
+        return int(total * percentage / 100)
 
-            This function only creates primary partitions as
-            ephemeral disk is a spare disk and there is no need
-            to create logical partitions.
+    if size.endswith('iB'):
+        size = size[:-2]
+    if size[-1:].upper() in SIZE_UNITS:
+        return int(size[:-1]) * SIZE_UNITS[size[-1].upper()]
+    return int(size)
 
-            This function can also be used to create ephemeral SWAP partition
-            and also create another partition (usually for /mnt) using
-            the space left. It calculates only one ephemeral disk based
-            on instance type.
 
-            create_disk_partition('/dev/xvdj', '8G', '1', 'c1.medium')
+## Mount options per file system for each mount profile (see tools.mount_partition)
+MOUNT_PROFILES = {
+    'default': {},
+    'scratch': {'ext3': 'noatime,nodiratime,data=writeback,barrier=0',
+                'ext4': 'noatime,nodiratime,data=writeback,barrier=0',
+                'xfs': 'noatime,nodiratime,logbufs=8,logbsize=256k'}}
 
-            This will create a SWAP of 8G + /mnt of 327G as total of the ephemeral
-            disk is 335 for a c1.medium instance.
-            """
+## Block queue settings for each queue profile (see tools.tune_queue),
+## schedulers are given in order of preference as available ones depend on the kernel
+QUEUE_PROFILES = {
+    'default': {},
+    'streaming': {'scheduler': 'mq-deadline,deadline',
+                  'read_ahead_kb': '4096',
+                  'nr_requests': '1024',
+                  'add_random': '0'},
+    'scratch': {'scheduler': 'none,noop',
+                'read_ahead_kb': '128',
+                'nr_requests': '1024',
+                'rotational': '0',
+                'add_random': '0'}}
 
-        # fdisk command to create partition
-        command = """echo "
-n
-p
-{2}
+## Queue attributes in the order they are written, changing the scheduler resets nr_requests
+QUEUE_ATTRIBUTES = ('scheduler', 'read_ahead_kb', 'nr_requests', 'rotational', 'add_random')
 
-+{1}
-w
-" | /sbin/fdisk {0} 1>/dev/null """
-        partitioning = command.format(disk, size, part_number)
-        partition = "".join((disk, part_number))
-        try:
-            # Check if partition number is between 1 and 4
-            if not int(part_number) in range(1,5):
-                logging.error('Partition number must be between 1 and 4')
-                exit(2)
 
-            if not self.force:
-                # Check if partition selected exist, otherwise raise an error
-                # Hint: module commands or subprocess can be used here to simplify
-                if self.check_partition(partition):
-                    logging.error('Partition {0} already exist, please choose other one'.format(partition))
-                    logging.error('Set "force=1" while instantiating this class to force removing existing partitions')
-                    exit(2)
-            else:
-                count = 1
-                ## Loop through all primary partitions and delete if found
-                for attempts in range(1,5):
-                    my_part = disk + str(count)
-                    if self.check_partition(my_part):
-                        self.delete_disk_partition(disk, str(count))
+class system_backend:
+    """ Run commands and read /proc and /sys of the running system.
 
-                    # Jump to the next partition
-                    count = count + 1
+        Commands are run directly from their argument list (no shell
+        in between) with their output captured, example:
 
-            # Partprobe is needed to reload Disk partition table on Linux as it is required in few cases
-            logging.info('Reloading Disk partition table')
-            os.system("partprobe")
+        system_backend().execute(['mkswap', '/dev/xvdb1']) returns (0, 'Setting up swapspace...', '')
+        """
 
-            # Check if partition size ends with G, otherwise raise an error
-            if not size.endswith('G'):
-                logging.error('Partitions size must be in Gigabytes (e.g 9G, 10G)')
-                exit(2)
+    c_library = None
 
-            # Check if any instance type was given as an argument
-            # and then create the ephemeral partition (/mnt), otherwise
-            # do nothing.
-            for instance in instances:
-                if instance is not None:
-                    self.create_ephemeral_partition(disk, size, instance)
+    def execute(self, argv, input=None):
+        """ Run a command and return its exit code, output and error output """
 
-            logging.info('Creating partition...!')
-            os.system(partitioning)
+        try:
+            process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, close_fds=True)
+        except OSError, e:
+            return 127, '', "{0}".format(e)
 
-            # Partprobe is needed to reload Disk partition table on Linux as it is required in few cases
-            os.system("partprobe")
+        output, error = process.communicate(input)
+        return process.returncode, output, error
 
-            # Confirm if partition was created successfully
-            if not self.check_partition(partition):
-                logging.critical('Could not create the partition. Maybe the size is too big?')
-                exit(2)
+    def executable(self, path):
+        return os.path.isfile(path) and os.access(path, os.X_OK)
 
-            logging.info('Partition created successfully')
+    def read(self, path):
+        with open(path, 'r') as filename:
+            return filename.read()
 
-        except Exception, e:
-            logging.critical("Error trying to create a new partition")
-            logging.error("{0}".format(e))
-            exit(2)
+    def read_bytes(self, path, size):
+        with open(path, 'rb') as filename:
+            return filename.read(size)
 
-    def create_ephemeral_partition(self, disk, size, instance):
-        """ If an instance type was given to create_disk_partition function,
-            then this function will be called informing the primary partition size
-            and the instance type, therefore this function will calculate the space left
-            to create /mnt partition (Amazon ONLY). Example:
+    def write(self, path, value):
+        with open(path, 'w') as filename:
+            filename.write(value)
 
-            create_ephemeral_partition('/dev/xvdb', '8G', 'c1.medium')
+    def open_direct(self, path, write=False):
+        """ Open a device for direct I/O (O_DIRECT), bypassing the page cache.
+            Buffers used to read or write must be aligned, e.g. a mmap """
 
-            Please be aware that these numbers can change, therefore
-            a method to update these values would be useful in the future
-            """
+        flags = (os.O_RDWR if write else os.O_RDONLY) | getattr(os, 'O_DIRECT', 0)
+        return io.FileIO(os.open(path, flags), 'r+' if write else 'r')
 
-        if 'm1.small' in instance:
-            total = 140
-        if 'c1.medium' in instance:
-            total = 335
-        if 'm1.medium' in instance:
-            total = 390
-        if 'm1.large' in instance:
-            total = 410
-        if 'm2.xlarge' in instance:
-            total = 410
-        if 'm2.2xlarge' in instance:
-            total = 840
-        if 'm2.4xlarge' in instance:
-            total = 830
-        if 'c1.xlarge' in instance:
-            total = 410
-        if 'cc1.4xlarge' in instance:
-            total = 830
-        if 'cc2.8xlarge' in instance:
-            total = 830
-        if 'cg1.4xlarge' in instance:
-            total = 830
-        if 'cr1.8xlarge' in instance:
-            total = 230
-        if 'hi1.4xlarge' in instance:
-            total = 830
-        if 'hs1.8xlarge' in instance:
-            total = 2014
-	# added numbers for the 3rd generation instances, as of May 2014
-	if 'm3.medium' in instance:
-	    total = 4
-	if 'm3.large' in instance:
-	    total = 32
-	if 'm3.xlarge' in instance:
-            total = 40
-        if 'm3.2xlarge' in instance:
-	    total = 80
-	if 'c3.large' in instance:
-	    total = 16
-	if 'c3.xlarge' in instance:
-	    total = 40
-	if 'c3.2xlarge' in instance:
-	    total = 80
-	if 'c3.4xlarge' in instance:
-	    total = 160
-	if 'c3.8xlarge' in instance:
-	    total = 320
-	if 'g2.2xlarge' in instance:
-	    total = 60
-	if 'r3.large' in instance:
-	    total = 32
-	if 'r3.xlarge' in instance:
-	    total = 80
-	if 'r3.2xlarge' in instance:
-	    total = 160
-	if 'r3.4xlarge' in instance:
-	    total = 320
-	if 'i2.xlarge' in instance:
-	    total = 800
-	if 'i2.2xlarge' in instance:
-	    total = 800
-	if 'i2.4xlarge' in instance:
-	    total = 800
-	if 'i2.8xlarge' in instance:
-	    total = 800
-	
-
-        # Calculates how large ephemeral partition can be
-        # Then, it creates itself using all space left
-        eph = total - int(size.strip('G'))
-        mnt = "".join((str(eph), 'G'))
-
-        # Confirm what partition number is available to create
-        ### Create loop here to confirm what part number can be used
-        self.create_disk_partition(disk, mnt, '2')
+    def open(self, path):
+        return open(path, 'rb')
 
-    def check_partition(self, partition):
-        """ Check if partition exists and return True or False """
+    def walk(self, path):
+        return os.walk(path)
 
-        # Confirm that fdisk binary exists
-        if not self.check_command('/sbin/fdisk'):
-            logging.error('fdisk command does not exist or cannot be accessible')
-            exit(2)
+    def isfile(self, path):
+        return os.path.isfile(path)
 
-        # Ensure that partition in question already exist or not
-        # Then, it returns True or False depending on the result
-        if partition in os.popen("fdisk -l {0} 2> /dev/null".format(partition)).read():
-            return True
-        else:
-            return False
+    def islink(self, path):
+        return os.path.islink(path)
 
-    def check_mount_point(self, partition):
-        """ Check if partition is mounted, example:
+    def readlink(self, path):
+        return os.readlink(path)
 
-        check_mount_point('/dev/xvdj1')
+    def symlink(self, target, path):
+        os.symlink(target, path)
 
-            Return True or False depending on the result.
-            However it force is enabled, it tries to unmount
-        """
-        try:
+    def getsize(self, path):
+        return os.path.getsize(path)
 
-            # Check if partition exists before enabling SWAP
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+    def remove(self, path):
+        os.remove(path)
 
-            # Confirm that mount/umount binary exists
-            if not self.check_command('/bin/mount') and not self.check_command('/bin/umount'):
-                logging.error('mount/umount command does not exist or cannot be accessible')
-                exit(2)
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
 
-            # Ensure that partition in question is already mounted or not
-            # Returns True or False depending on the result
-            # It is also important to check if is mounted as SWAP which uses a different place
-
-            mount_points = os.popen("mount 2> /dev/null".format(partition)).read()
-            with open('/proc/swaps', 'r') as filename:
-                swap_points = filename.read()
-                if partition in mount_points or partition in swap_points:
-                    return True
-                elif partition[:-1] in mount_points or partition[:-1] in swap_points:
-                    return True
-                else:
-                    return False
+    def file_mode(self, path):
+        return stat.S_IMODE(os.stat(path).st_mode)
 
-        except Exception, e:
-            logging.critical("Error while checking mount point")
-            logging.error("{0}".format(e))
+    def libc(self):
+        """ Return the C library, loaded once, for system calls Python 2 has no wrapper for """
 
-    def check_command(self, command):
-        """ Check if command exists and can be executed.access
+        if system_backend.c_library is None:
+            system_backend.c_library = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return system_backend.c_library
 
-            Returns True or False depending on the result
+    def copy_range(self, source, target, offset=0, length=None, mode=0644, chunk=8 * 1024 ** 2, progress=None):
+        """ Copy length bytes of source from offset to a new file, without
+            passing them through Python buffers when possible, example:
+
+        copy_range('/var/lib/seed/cache.db', '/mnt/cache.db') returns 'copy_file_range'
+
+            copy_file_range is tried first, then sendfile (e.g. kernels which
+            cannot copy across file systems) and finally plain reads and writes.
+            progress is called with the bytes copied after every chunk.
+            Returns the method which copied the file.
         """
 
-        if os.path.isfile(command) and os.access(command, os.X_OK):
-            return True
-        else:
-            return False
+        if length is None:
+            length = os.path.getsize(source) - offset
 
-    def delete_disk_partition(self, disk, part_number):
-        """ Delete partitions using fdisk, example:
+        methods = ['copy_file_range', 'sendfile', 'read']
+        source_fd = os.open(source, os.O_RDONLY)
+        try:
+            target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+            try:
+                copied = 0
+                while copied < length:
+                    count = min(chunk, length - copied)
+                    try:
+                        done = self.copy_chunk(methods[0], source_fd, target_fd, offset + copied, copied, count)
+                    except OSError, e:
+                        # Not supported by the kernel, the C library or these file systems
+                        if e.errno in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP) and len(methods) > 1:
+                            methods.pop(0)
+                            continue
+                        raise
+                    if not done:
+                        raise IOError(errno.EIO, 'Unexpected end of file', source)
 
-        delete('/dev/xvdj', '1')
+                    copied += done
+                    if progress is not None:
+                        progress(done)
+            finally:
+                os.close(target_fd)
+        finally:
+            os.close(source_fd)
 
-            Then, deletes partition 1 of the
-            disk /dev/xvdj. """
+        return methods[0]
 
-        # fdisk command to delete partition
-        command = """echo "
-d
-{1}
-w
-" | /sbin/fdisk {0} 1>/dev/null """
-        partitioning = command.format(disk, part_number)
-        partition = "".join((disk, part_number))
-        try:
-            # Check if partition number is between 1 and 4
-            if not part_number in str(partition):
-                logging.error('Partition number must be between 1 and 4')
-                exit(2)
+    def copy_chunk(self, method, source_fd, target_fd, offset, target_offset, count):
+        """ Copy up to count bytes between file descriptors using method, returning the bytes copied """
 
-            # Check if partition selected exist, otherwise raise an error
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+        if method == 'read':
+            os.lseek(source_fd, offset, os.SEEK_SET)
+            data = os.read(source_fd, count)
+            os.lseek(target_fd, target_offset, os.SEEK_SET)
+            written = 0
+            while written < len(data):
+                written += os.write(target_fd, data[written:])
+            return written
 
-            logging.info("Deleting partition... !")
-            os.system(partitioning)
-            logging.info("Partition deleted successfully")
+        function = getattr(self.libc(), method if method == 'copy_file_range' else 'sendfile64', None)
+        if function is None:
+            raise OSError(errno.ENOSYS, '{0} is not available'.format(method))
 
-        except Exception, e:
-            logging.critical("Error while deleting disk partition {0} - Please double check if it is in use and try again".format(partition))
-            logging.error("{0}".format(e))
+        source_offset = ctypes.c_int64(offset)
+        if method == 'copy_file_range':
+            function.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+            function.restype = ctypes.c_ssize_t
+            done = function(source_fd, ctypes.byref(source_offset), target_fd,
+                            ctypes.byref(ctypes.c_int64(target_offset)), count, 0)
+        else:
+            # sendfile writes at the current offset of the target
+            os.lseek(target_fd, target_offset, os.SEEK_SET)
+            function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+            function.restype = ctypes.c_ssize_t
+            done = function(target_fd, source_fd, ctypes.byref(source_offset), count)
 
-    def enable_swap(self, partition):
-        """ Enable SWAP partition previously created, example:
+        if done < 0:
+            number = ctypes.get_errno()
+            raise OSError(number, os.strerror(number))
+        return done
 
-        enable('/dev/xvdj1')
+    def copy_stream(self, handle, target, length, mode=0644, chunk=8 * 1024 ** 2, progress=None):
+        """ Copy length bytes read from a file object (e.g. a member of a compressed
+            archive) to a new file, calling progress with the bytes copied after every chunk """
 
-            Then, formats partition as SWAP and then enable
-            using SWAPON command in Linux"""
+        target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
         try:
+            copied = 0
+            while copied < length:
+                data = handle.read(min(chunk, length - copied))
+                if not data:
+                    raise IOError(errno.EIO, 'Unexpected end of file', target)
+                written = 0
+                while written < len(data):
+                    written += os.write(target_fd, data[written:])
 
-            # Check if partition exists before enabling SWAP
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+                copied += written
+                if progress is not None:
+                    progress(written)
+        finally:
+            os.close(target_fd)
 
-            # Confirm that mkswap binary exists
-            if not self.check_command('/sbin/mkswap'):
-                logging.error('mkswap command does not exist or cannot be accessible')
-                exit(2)
+        return 'read'
 
-            # Double check if partition is already in use
-            # and if Force is set unmount it before taking any action
-            if self.check_mount_point(partition):
-                if self.force:
-                    self.force_unmount(partition)
-                else:
-                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
-                    exit(2)
+    def exists(self, path):
+        return os.path.exists(path)
 
-            # Creates SWAP using mkswap and enable it using swapon
-            logging.info('Formating partition {0} as SWAP'.format(partition))
-            os.system("mkswap {0} 1>/dev/null".format(partition))
+    def isdir(self, path):
+        return os.path.isdir(path)
 
-            os.system('swapon {0} 1>/dev/null'.format(partition))
-            logging.info('SWAP enabled successfully')
+    def listdir(self, path):
+        return os.listdir(path)
 
-        except Exception, e:
-            logging.critical("Error while enabling SWAP")
-            logging.error("{0}".format(e))
+    def makedirs(self, path):
+        os.makedirs(path)
 
-    def disable_swap(self, partition):
-        """ Disable SWAP partition, example
+    def realpath(self, path):
+        return os.path.realpath(path)
 
-        disable('/dev/xvdj1') """
+    def device_number(self, path):
+        """ Return major and minor numbers of a device node """
 
-        try:
-            # Check if partition exists before enabling SWAP
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+        device = os.stat(path).st_rdev
+        return os.major(device), os.minor(device)
 
-             # Confirm that swapoff binary exists
-            if not self.check_command('/sbin/swapoff'):
-                logging.error('swapoff command does not exist or cannot be accessible')
-                exit(2)
+    def root_device(self):
+        """ Return major and minor numbers of the device holding the root file system """
 
-            # Double check if partition is already in use
-            # and if Force is set unmount it before taking any action
-            if self.check_mount_point(partition):
-                if self.force:
-                    self.force_unmount(partition)
-                else:
-                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
-                    exit(2)
+        device = os.stat('/').st_dev
+        return os.major(device), os.minor(device)
 
-            os.system("swapoff {0} 1>/dev/null".format(partition))
-            logging.info('SWAP disabled successfully')
+    def watcher(self):
+        return uevent_watcher()
 
-        except Exception, e:
-            logging.critical("Error while disabling SWAP")
-            logging.error("{0}".format(e))
+    def metadata(self):
+        return metadata_client(backend=self)
 
-    def format_as_ext3(self, partition):
-        """ Format partition previously created as EXT3, example:
 
-        format_as_ext3('/dev/xvdj1')
+class simulated_backend:
+    """ In-memory disks standing in for the kernel and the commands used by tools,
+        so provisioning can run without root or real block devices, example:
+
+        backend = simulated_backend({'xvdb': '335G', 'xvdc': '335G'}, volumes={'xvdf': '100G'})
+        t = tools(force=1, backend=backend)
+        t.provision_disks()
+
+        Partition tables, file systems, RAID arrays, zram, mount points and SWAP
+        are kept in memory and exposed through the same /proc and /sys files
+        read by tools. Commands not simulated exit with 127. disks are instance
+        store, listed in the block device mapping of metadata_values (answered
+        by metadata), while volumes stand for EBS volumes.
         """
 
-        try:
-            # Check if partition selected exist, otherwise raise an error
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+    def __init__(self, disks=None, root_size='8G', volumes=None):
+        self.lock = threading.RLock()
+        self.devices = {}
+        self.mounts = {}
+        self.swaps = {}
+        self.directories = set(['/', '/mnt'])
+        self.files = {}
+        self.links = {}
+        self.allocated = {}
+        self.swap_used = {}
+        self.memory = {'MemTotal': 4 * 1024 ** 3, 'MemAvailable': 3 * 1024 ** 3}
+        self.mapper = {}
+        self.commands = 0
 
-             # Confirm that mkfs.ext3 binary exists
-            if not self.check_command('/sbin/mkfs.ext3'):
-                logging.error('mkfs.ext3 command does not exist or cannot be accessible')
-                exit(2)
+        # Root disk with the root file system mounted, which is never an ephemeral disk
+        self.add_device('xvda', root_size)
+        self.add_device('xvda1', to_bytes(root_size) - 1024 ** 2, 'xvda', 1)
+        self.devices['xvda1']['fs'] = 'ext4'
+        self.mounts['/'] = {'device': 'xvda1', 'options': 'rw,relatime'}
 
-            # Double check if partition is already in use
-            # and if Force is set unmount it before taking any action
-            if self.check_mount_point(partition):
-                if self.force:
-                    self.force_unmount(partition)
-                else:
-                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
-                    exit(2)
+        for name, size in sorted((disks or {'xvdb': '335G'}).items()):
+            self.add_device(name, size)
+        for name, size in sorted((volumes or {}).items()):
+            self.add_device(name, size)['model'] = 'Amazon Elastic Block Store' if name.startswith('nvme') else ''
 
-            logging.info('Formating partition {0} as EXT3'.format(partition))
+        # Metadata service answers, where sdb shows up as xvdb as on Xen instances
+        ephemeral = sorted(disks or {'xvdb': '335G'})
+        mappings = ['ephemeral{0}'.format(index) for index in range(len(ephemeral))]
+        self.metadata_values = {'block-device-mapping/': '\n'.join(['ami'] + mappings + ['root'])}
+        for index, name in enumerate(ephemeral):
+            self.metadata_values['block-device-mapping/ephemeral{0}'.format(index)] = re.sub('^xvd', 'sd', name)
 
-            os.system("mkfs.ext3 -q {0} 1>/dev/null".format(partition))
-            logging.info('Partition formatted successfully as EXT3')
+    def metadata(self):
+        return simulated_metadata(self)
 
-        except Exception, e:
-            logging.critical("Error while formatting partition as EXT3")
-            logging.error("{0}".format(e))
+    def add_device(self, name, size, disk=None, number=None, major=202):
+        """ Add a disk, or a partition when disk and number are given """
 
-    def format_as_ext4(self, partition):
-        """ Format partition previously created as EXT4, example:
+        with self.lock:
+            if disk is not None:
+                major = self.devices[disk]['major']
+                minor = self.devices[disk]['minor'] + number
+            else:
+                minor = 16 * len([device for device in self.devices.values() if device['major'] == major and device['disk'] is None])
 
-        format_as_ext4('/dev/xvdj1')
-        """
+            self.devices[name] = {'major': major,
+                                  'minor': minor,
+                                  'size': to_bytes(size),
+                                  'disk': disk,
+                                  'number': number,
+                                  'start': 1024 ** 2,
+                                  'fs': None,
+                                  'model': 'Amazon EC2 NVMe Instance Storage' if name.startswith('nvme') else '',
+                                  'queue': {'minimum_io_size': '512',
+                                            'optimal_io_size': '0',
+                                            'logical_block_size': '512',
+                                            'discard_max_bytes': '2199023255040' if name.startswith('nvme') else '0',
+                                            'scheduler': '[mq-deadline] kyber none',
+                                            'read_ahead_kb': '128',
+                                            'nr_requests': '64',
+                                            'rotational': '0',
+                                            'add_random': '0'}}
+            return self.devices[name]
 
-        try:
-            # Check if partition selected exist, otherwise raise an error
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+    def name(self, path):
+        """ Return the device name of a path, e.g. dm-0 for /dev/mapper/ephemeral-cache """
 
-             # Confirm that mkfs.ext4 binary exists
-            if not self.check_command('/sbin/mkfs.ext4'):
-                logging.error('mkfs.ext4 command does not exist or cannot be accessible')
-                exit(2)
+        if path.startswith('/dev/mapper/'):
+            return self.mapper.get(os.path.basename(path), os.path.basename(path))
+        return os.path.basename(path)
 
-            # Double check if partition is already in use
-            # and if Force is set unmount it before taking any action
-            if self.check_mount_point(partition):
-                if self.force:
-                    self.force_unmount(partition)
-                else:
-                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
-                    exit(2)
+    def holders(self, name):
+        """ Return devices built on top of a device, such as RAID arrays or device mapper targets """
 
-            logging.info('Formating partition {0} as EXT4'.format(partition))
+        return sorted(holder for holder, device in self.devices.items() if name in device.get('members', []))
 
-            os.system("mkfs.ext4 -q {0} 1>/dev/null".format(partition))
-            logging.info('Partition formmatted successfully as EXT4')
+    def partitions(self, disk):
+        return sorted((device['number'], name) for name, device in self.devices.items() if device['disk'] == disk)
 
-        except Exception, e:
-            logging.critical("Error while formatting partition as EXT4")
-            logging.error("{0}".format(e))
+    def in_use(self, name):
+        """ Return True if a device, its disk or its partitions are mounted or used as SWAP """
 
-    def format_as_xfs(self, partition):
-        """ Format partition previously created as XFS, example:
+        related = [name, self.devices[name]['disk']] + [part for number, part in self.partitions(name)]
+        used = set(mount['device'] for mount in self.mounts.values()) | set(self.swaps)
+        return bool(used.intersection(related)) or any(self.holders(device) for device in related if device)
 
-        format_as_xfs('/dev/xvdj1')
-        """
+    # Files read by tools
 
-        try:
-            # Check if partition selected exist, otherwise raise an error
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+    def split(self, path):
+        """ Split a path, with /sys/block/<disk>/<partition>/... seen as /sys/block/<partition>/... """
 
-             # Confirm that mkfs.ext4 binary exists
-            if not self.check_command('/sbin/mkfs.xfs'):
-                logging.error('mkfs.xfs command does not exist or cannot be accessible')
-                logging.info('Please make sure you have XFS file system tools installed')
-                exit(2)
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['sys', 'block'] and len(parts) > 3 and parts[3] in self.devices:
+            del parts[2]
+        return parts
 
-            # Double check if partition is already in use
-            # and if Force is set unmount it before taking any action
-            if self.check_mount_point(partition):
-                if self.force:
-                    self.force_unmount(partition)
-                else:
-                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
-                    exit(2)
+    def read(self, path):
+        with self.lock:
+            parts = self.split(path)
 
-            logging.info('Formating partition {0} as XFS'.format(partition))
+            if path == '/proc/partitions':
+                lines = ['major minor  #blocks  name', '']
+                for name, device in sorted(self.devices.items(), key=lambda item: (item[1]['major'], item[1]['minor'])):
+                    if device['size']:
+                        lines.append('{0:4d} {1:7d} {2:10d} {3}'.format(device['major'], device['minor'], device['size'] // 1024, name))
+                return '\n'.join(lines) + '\n'
 
-            os.system("mkfs.xfs -q {0} 1>/dev/null".format(partition))
-            logging.info('Partition formmatted successfully as XFS')
+            if path == '/proc/self/mountinfo':
+                lines = []
+                for index, (mount_point, mount) in enumerate(sorted(self.mounts.items())):
+                    device = self.devices[mount['device']]
+                    lines.append('{0} 1 {1}:{2} / {3} {4} - {5} /dev/{6} rw'.format(
+                        index + 20, device['major'], device['minor'], mount_point.replace(' ', '\\040'),
+                        mount['options'], device['fs'], mount['device']))
+                return '\n'.join(lines) + '\n'
 
-        except Exception, e:
-            logging.critical("Error while formatting partition as XFS")
-            logging.error("{0}".format(e))
+            if path == '/proc/swaps':
+                lines = ['Filename\t\t\t\tType\t\tSize\t\tUsed\t\tPriority']
+                for name, priority in sorted(self.swaps.items()):
+                    if name in self.allocated:
+                        lines.append('{0}\tfile\t\t{1}\t{2}\t{3}'.format(name, self.allocated[name]['size'] // 1024,
+                                                                      self.swap_used.get(name, 0) // 1024, priority))
+                    else:
+                        lines.append('/dev/{0}\tpartition\t{1}\t{2}\t{3}'.format(name, self.devices[name]['size'] // 1024,
+                                                                            self.swap_used.get(name, 0) // 1024, priority))
+                return '\n'.join(lines) + '\n'
 
-    def mount_partition(self, partition, mount_point):
-        """ Mount partition previously created and formatted, example:
+            if path == '/proc/meminfo':
+                # memory holds MemTotal and MemAvailable in bytes, SWAP figures come from active SWAP
+                total = sum(self.swap_size(name) for name in self.swaps)
+                used = sum(self.swap_used.get(name, 0) for name in self.swaps)
+                values = [('MemTotal', self.memory['MemTotal']),
+                          ('MemFree', self.memory['MemAvailable']),
+                          ('MemAvailable', self.memory['MemAvailable']),
+                          ('SwapTotal', total),
+                          ('SwapFree', total - used)]
+                return ''.join('{0}:{1:>16d} kB\n'.format(name, value // 1024) for name, value in values)
 
-        mount_partition('/dev/xvdj2', '/mnt')
-        """
+            if path in self.files:
+                return self.files[path]
 
-        try:
-            # Check if partition selected exist, otherwise raise an error
-            if not self.check_partition(partition):
-                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
-                exit(2)
+            if path == '/sys/class/zram-control/hot_add':
+                number = len([name for name in self.devices if name.startswith('zram')])
+                self.add_device('zram{0}'.format(number), 0, major=252)
+                self.devices['zram{0}'.format(number)]['minor'] = number
+                return '{0}\n'.format(number)
 
-             # Confirm that mount binary exists
-            if not self.check_command('/bin/mount'):
-                logging.error('mount command does not exist or cannot be accessible, please ensure you also have permission to mount')
-                exit(2)
+            # /sys/class/block/<name>/partition, /sys/block/<name>/size, queue/<attribute>, device/model...
+            if parts[:2] in (['sys', 'block'], ['sys', 'class']) and len(parts) >= 4:
+                name = parts[3] if parts[1] == 'class' else parts[2]
+                attribute = '/'.join(parts[4:] if parts[1] == 'class' else parts[3:])
+                device = self.devices.get(name)
+                if device is not None:
+                    if attribute == 'partition' and device['number'] is not None:
+                        return '{0}\n'.format(device['number'])
+                    if attribute == 'size':
+                        return '{0}\n'.format(device['size'] // 512)
+                    if attribute == 'disksize':
+                        return '{0}\n'.format(device['size'])
+                    if attribute == 'device/model':
+                        return device['model'] + '\n'
+                    if attribute.startswith('queue/') and attribute[6:] in device['queue']:
+                        return device['queue'][attribute[6:]] + '\n'
 
-            # Double check if partition is already in use
-            # and if Force is set unmount it before taking any action
-            if self.check_mount_point(partition):
-                if self.force:
-                    self.force_unmount(partition)
-                else:
-                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
-                    exit(2)
+            raise IOError(2, 'No such file or directory', path)
 
-            logging.info('Mounting partition {0} in {1}'.format(partition, mount_point))
+    def read_bytes(self, path, size):
+        """ Return the first bytes of a device with the signature of its file system """
 
-            if os.system("mount {0} {1} 1>/dev/null".format(partition, mount_point)):
-                logging.info('Partition {0} was mounted successfully in {1}'.format(partition, mount_point))
+        with self.lock:
+            device = self.devices.get(self.name(path))
+            if device is None:
+                raise IOError(2, 'No such file or directory', path)
 
+            header = bytearray(max(size, 8192))
+            if device['fs'] == 'xfs':
+                header[0:4] = 'XFSB'
+            elif device['fs'] == 'swap':
+                header[4086:4096] = 'SWAPSPACE2'
+            elif device['fs'] in ('ext2', 'ext3', 'ext4'):
+                header[1080:1082] = '\x53\xef'
+                if device['fs'] != 'ext2':
+                    header[1116] = 0x4
+                if device['fs'] == 'ext4':
+                    header[1120] = 0x40
 
-        except Exception, e:
-            logging.critical("Error while mounting partition {0} in {1}".format(partition, mount_point))
-            logging.error("{0}".format(e))
+            return str(header[:size])
 
-    def force_unmount(self, partition):
-        """ Force unmount partition once mounted
+    def write(self, path, value):
+        with self.lock:
+            parts = self.split(path)
+            # Regular files (e.g. caches and state files) can be written in any directory created
+            if parts[0] not in ('sys', 'proc', 'dev'):
+                if os.path.dirname(path) not in self.directories:
+                    raise IOError(2, 'No such file or directory', path)
+                self.files[path] = value
+                return
 
-        force_unmount('/dev/xvdb1') or force_unmount('/dev/xvdb)
+            device = self.devices.get(parts[2]) if len(parts) > 3 and parts[:2] == ['sys', 'block'] else None
+            if device is None:
+                raise IOError(2, 'No such file or directory', path)
 
-        """
+            attribute = '/'.join(parts[3:])
+            if attribute == 'comp_algorithm' and value in ('lzo', 'lzo-rle', 'lz4', 'zstd'):
+                return
+            if attribute == 'disksize':
+                device['size'] = to_bytes(value)
+                return
+            if attribute == 'reset':
+                device['size'] = 0
+                device['fs'] = None
+                return
+            if attribute == 'queue/scheduler':
+                available = device['queue']['scheduler'].replace('[', '').replace(']', '').split()
+                if value in available:
+                    device['queue']['scheduler'] = ' '.join('[{0}]'.format(name) if name == value else name for name in available)
+                    return
+            elif attribute == 'queue/nr_requests' and device['major'] == 9:
+                # md arrays have no request queue of their own
+                pass
+            elif attribute.startswith('queue/') and attribute[6:] in device['queue']:
+                device['queue'][attribute[6:]] = value
+                return
 
-        if self.force:
+            raise IOError(22, 'Invalid argument', path)
+
+    def open_direct(self, path, write=False):
+        with self.lock:
+            device = self.devices.get(self.name(path))
+            if device is None:
+                raise IOError(2, 'No such file or directory', path)
+            return simulated_file(self, device, write)
+
+    def open(self, path):
+        with self.lock:
+            if path not in self.files:
+                raise IOError(2, 'No such file or directory', path)
+            return io.BytesIO(self.files[path])
+
+    def walk(self, path):
+        with self.lock:
+            root = path.rstrip('/') or '/'
+            entries = []
+            for directory in sorted(name for name in self.directories if name == root or name.startswith(root.rstrip('/') + '/')):
+                children = [name for name in self.directories if name != directory and os.path.dirname(name) == directory]
+                files = [name for name in list(self.files) + list(self.links) if os.path.dirname(name) == directory]
+                entries.append((directory, sorted(os.path.basename(name) for name in children),
+                                sorted(os.path.basename(name) for name in files)))
+            return entries
+
+    def isfile(self, path):
+        return path in self.files
+
+    def islink(self, path):
+        return path in self.links
+
+    def readlink(self, path):
+        if path not in self.links:
+            raise OSError(22, 'Invalid argument', path)
+        return self.links[path]
+
+    def symlink(self, target, path):
+        with self.lock:
+            path = os.path.join(self.realpath(os.path.dirname(path)), os.path.basename(path))
+            if os.path.dirname(path) not in self.directories:
+                raise OSError(2, 'No such file or directory', path)
+            if path in self.files or path in self.links:
+                raise OSError(17, 'File exists', path)
+            self.links[path] = target
+
+    def remove(self, path):
+        with self.lock:
+            if path in self.swaps:
+                raise OSError(1, 'Operation not permitted', path)
+            if path in self.links:
+                del self.links[path]
+            elif path in self.files:
+                del self.files[path]
+                self.allocated.pop(path, None)
+            else:
+                raise OSError(2, 'No such file or directory', path)
+
+    def chmod(self, path, mode):
+        if path not in self.files:
+            raise OSError(2, 'No such file or directory', path)
+
+    def getsize(self, path):
+        if path not in self.files:
+            raise OSError(2, 'No such file or directory', path)
+        if path in self.allocated:
+            return self.allocated[path]['size']
+        return len(self.files[path])
+
+    def file_mode(self, path):
+        if path not in self.files:
+            raise OSError(2, 'No such file or directory', path)
+        return 0644
+
+    def copy_range(self, source, target, offset=0, length=None, mode=0644, chunk=8 * 1024 ** 2, progress=None):
+        """ Copy a regular file, or part of it, as copy_file_range would """
+
+        data = self.open(source).read()
+        if length is None:
+            length = len(data) - offset
+        if offset + length > len(data):
+            raise IOError(5, 'Unexpected end of file', source)
+
+        return self.copy_stream(io.BytesIO(data[offset:offset + length]), target, length, mode, chunk, progress, 'copy_file_range')
+
+    def copy_stream(self, handle, target, length, mode=0644, chunk=8 * 1024 ** 2, progress=None, method='read'):
+        with self.lock:
+            target = self.realpath(target)
+            if os.path.dirname(target) not in self.directories:
+                raise IOError(2, 'No such file or directory', target)
+            self.files[target] = ''
+
+        copied = 0
+        while copied < length:
+            data = handle.read(min(chunk, length - copied))
+            if not data:
+                raise IOError(5, 'Unexpected end of file', target)
+            with self.lock:
+                self.files[target] += data
+            copied += len(data)
+            if progress is not None:
+                progress(len(data))
+
+        return method
+
+    def exists(self, path):
+        if path.startswith('/dev/'):
+            return self.name(path) in self.devices
+        if self.isdir(path):
+            return True
+        try:
+            self.read(path)
+            return True
+        except IOError:
+            return False
+
+    def isdir(self, path):
+        with self.lock:
+            parts = self.split(path)
+            if path == '/sys/class/zram-control':
+                return True
+            if parts[:2] == ['sys', 'block'] and len(parts) == 3:
+                return parts[2] in self.devices
+            return self.realpath(path.rstrip('/') or '/') in self.directories or path == '/'
+
+    def listdir(self, path):
+        with self.lock:
+            parts = path.strip('/').split('/')
+            if path.rstrip('/') == '/sys/block':
+                return [name for name, device in self.devices.items() if device['disk'] is None]
+            if parts[:3] == ['sys', 'class', 'block'] and len(parts) == 5 and parts[4] == 'holders' and parts[3] in self.devices:
+                return self.holders(parts[3])
+            if parts[:3] == ['sys', 'class', 'block'] and len(parts) == 5 and parts[4] == 'slaves' and parts[3] in self.devices:
+                return list(self.devices[parts[3]].get('members', []))
+            raise OSError(2, 'No such file or directory', path)
+
+    def makedirs(self, path):
+        with self.lock:
+            path = self.realpath(path)
+            while path not in ('', '/'):
+                self.directories.add(path.rstrip('/'))
+                path = os.path.dirname(path.rstrip('/'))
+
+    def realpath(self, path):
+        with self.lock:
+            if path.startswith('/dev/mapper/') and os.path.basename(path) in self.mapper:
+                return os.path.join('/dev', self.mapper[os.path.basename(path)])
+
+            parts = path.strip('/').split('/')
+            if parts[:3] == ['sys', 'class', 'block'] and len(parts) == 4:
+                name = parts[3]
+            elif parts[:3] == ['sys', 'dev', 'block'] and len(parts) == 4:
+                numbers = parts[3]
+                name = ([name for name, device in self.devices.items()
+                         if '{0}:{1}'.format(device['major'], device['minor']) == numbers] or [numbers])[0]
+            else:
+                return self.follow(path)
+
+            device = self.devices.get(name)
+            if device is not None and device['disk'] is not None:
+                return '/sys/block/{0}/{1}'.format(device['disk'], name)
+            return '/sys/block/{0}'.format(name)
+
+    def follow(self, path):
+        """ Resolve symbolic links found along a path, as the kernel does when opening it """
+
+        resolved = '/'
+        for part in [part for part in path.split('/') if part]:
+            resolved = os.path.join(resolved, part)
+            hops = 0
+            while resolved in self.links:
+                hops += 1
+                if hops > 40:
+                    raise OSError(40, 'Too many levels of symbolic links', path)
+                resolved = os.path.normpath(os.path.join(os.path.dirname(resolved), self.links[resolved]))
+
+        return resolved
+
+    def device_number(self, path):
+        device = self.devices.get(self.name(path))
+        if device is None:
+            raise OSError(2, 'No such file or directory', path)
+        return device['major'], device['minor']
+
+    def root_device(self):
+        return self.device_number('/dev/' + self.mounts['/']['device'])
+
+    def executable(self, path):
+        return self.name(path) in ('fdisk', 'sfdisk', 'partprobe', 'mkswap', 'swapon', 'swapoff', 'mount', 'umount',
+                                   'mkfs.ext3', 'mkfs.ext4', 'mkfs.xfs', 'mdadm', 'modprobe', 'blkdiscard', 'dmsetup',
+                                   'fallocate')
+
+    # Device nodes show up as soon as they are created, so there is nothing to wait for
+
+    def watcher(self):
+        return self
+
+    def wait(self, nodes, timeout=10):
+        return all(self.exists(node) for node in nodes)
+
+    def close(self):
+        pass
+
+    # Commands
+
+    def execute(self, argv, input=None):
+        """ Run a simulated command, returning its exit code, output and error output """
+
+        with self.lock:
+            self.commands += 1
+            command, args = self.name(argv[0]), argv[1:]
+            if command.startswith('mkfs.'):
+                # mkfs.ext4 -q ... /dev/xvdb2 is handled as mkfs ext4 -q ... /dev/xvdb2
+                command, args = 'mkfs', [command[len('mkfs.'):]] + args
+            handler = getattr(self, 'command_{0}'.format(command), None)
+            if handler is None:
+                return 127, '', '{0}: command not found'.format(argv[0])
+
+            try:
+                return handler(args, input)
+            except (KeyError, IndexError, ValueError), e:
+                return 1, '', '{0}: {1}'.format(argv[0], e)
+
+    def command_partprobe(self, args, input):
+        return 0, '', ''
+
+    def command_modprobe(self, args, input):
+        return 0, '', ''
+
+    def command_sfdisk(self, args, input):
+        disk = self.name(args[-1])
+        if self.in_use(disk):
+            return 1, '', 'Device or resource busy'
+
+        # label: dos|gpt followed by one "start=N, size=N, type=T" line per partition (in 512 bytes sectors)
+        label = 'dos'
+        entries = []
+        for line in input.splitlines():
+            if line.startswith('label:'):
+                label = line.split(':', 1)[1].strip()
+            elif '=' in line:
+                entries.append(dict(field.strip().split('=', 1) for field in line.split(',')))
+
+        # GPT keeps a backup of the table in the last 33 sectors
+        end = self.devices[disk]['size'] - (33 * 512 if label == 'gpt' else 0)
+        if label == 'dos' and (len(entries) > 4 or end > 2 ** 32 * 512):
+            return 1, '', 'Too many partitions or disk too large for a dos label'
+
+        layout = []
+        for index, entry in enumerate(entries):
+            start = int(entry['start']) * 512
+            size = int(entry['size']) * 512 if 'size' in entry else end - start
+            if size <= 0 or start + size > end or (layout and start < layout[-1][0] + layout[-1][1]):
+                return 1, '', 'Sector out of range'
+            layout.append((start, size))
+
+        for number, name in self.partitions(disk):
+            del self.devices[name]
+        for number, (start, size) in enumerate(layout, 1):
+            self.add_device(self.partition(disk, number), size, disk, number)['start'] = start
+        self.devices[disk]['label'] = label
+
+        return 0, '', ''
+
+    def command_fdisk(self, args, input):
+        disk = self.name(args[-1])
+        answers = [line.strip() for line in input.splitlines()][1:]
+
+        if answers[0] == 'd':
+            name = self.partition(disk, answers[1])
+            del self.devices[name]
+            return 0, '', ''
+
+        # n, p, number, default first sector, +size
+        number = int(answers[2])
+        existing = [self.devices[name] for part, name in self.partitions(disk)]
+        start = max([part['start'] + part['size'] for part in existing] + [1024 ** 2])
+        size = to_bytes(answers[4].lstrip('+'))
+        if number in [part['number'] for part in existing] or start + size > self.devices[disk]['size']:
+            return 1, '', 'Value out of range'
+
+        self.add_device(self.partition(disk, number), size, disk, number)['start'] = start
+        return 0, '', ''
+
+    def partition(self, disk, number):
+        if disk[-1].isdigit():
+            return '{0}p{1}'.format(disk, number)
+        return '{0}{1}'.format(disk, number)
+
+    def command_mkswap(self, args, input):
+        if args[-1] in self.allocated:
+            if args[-1] in self.swaps:
+                return 1, '', 'Device or resource busy'
+            self.allocated[args[-1]]['fs'] = 'swap'
+            return 0, '', ''
+
+        name = self.name(args[-1])
+        if self.in_use(name):
+            return 1, '', 'Device or resource busy'
+        self.devices[name]['fs'] = 'swap'
+        return 0, '', ''
+
+    def command_mkfs(self, args, input):
+        name = self.name(args[-1])
+        if self.in_use(name):
+            return 1, '', 'Device or resource busy'
+        self.devices[name]['fs'] = args[0]
+        return 0, '', ''
+
+    def command_blkdiscard(self, args, input):
+        name = self.name(args[-1])
+        if self.in_use(name) or self.devices[name]['queue']['discard_max_bytes'] == '0':
+            return 1, '', 'BLKDISCARD ioctl failed'
+
+        # Discarded blocks read back as zeros, so file systems of the device and its partitions are gone
+        for device in [name] + [part for number, part in self.partitions(name)]:
+            self.devices[device]['fs'] = None
+        return 0, '', ''
+
+    def command_dmsetup(self, args, input):
+        action, name = args[0], args[1]
+
+        if action == 'create':
+            table = args[args.index('--table') + 1].split()
+            if name in self.mapper:
+                return 1, '', 'Device {0} already exists'.format(name)
+
+            # linear: start length linear device offset
+            # cache: start length cache metadata data origin block_size features... policy policy_args
+            members = [self.name(table[3])] if table[2] == 'linear' else [self.name(path) for path in table[3:6]]
+            if any(member not in self.devices for member in members):
+                return 1, '', 'No such device'
+
+            # Several device mapper targets can share a device, which must not be used otherwise
+            for member in members:
+                others = [holder for holder in self.holders(member) if not holder.startswith('dm-')]
+                if others or member in self.swaps or member in [mount['device'] for mount in self.mounts.values()]:
+                    return 1, '', 'Device or resource busy'
+
+            minor = len([device for device in self.devices.values() if device['major'] == 253])
+            self.mapper[name] = 'dm-{0}'.format(minor)
+            device = self.add_device(self.mapper[name], int(table[1]) * 512, major=253)
+            device['minor'] = minor
+            device['queue']['scheduler'] = 'none'
+            device['members'] = members
+            device['table'] = table
+            if table[2] == 'cache':
+                # The cache device shows the data of origin
+                device['fs'] = self.devices[members[2]]['fs']
+                device['cache'] = {'read_hits': 0, 'read_misses': 0, 'write_hits': 0, 'write_misses': 0, 'dirty': 0}
+            return 0, '', ''
+
+        if name not in self.mapper:
+            return 1, '', 'Device {0} not found'.format(name)
+        device = self.devices[self.mapper[name]]
+
+        if action == 'remove':
+            if self.in_use(self.mapper[name]):
+                return 1, '', 'Device or resource busy'
+            if device['table'][2] == 'cache':
+                self.devices[device['members'][2]]['fs'] = device['fs']
+            del self.devices[self.mapper.pop(name)]
+            return 0, '', ''
+
+        if action == 'table':
+            return 0, ' '.join(device['table']) + '\n', ''
+
+        if action == 'status':
+            table = device['table']
+            if table[2] != 'cache':
+                return 0, ' '.join(table[:3]) + '\n', ''
+            stats = device['cache']
+            blocks = self.devices[device['members'][1]]['size'] // (int(table[6]) * 512)
+            used = min(stats['read_misses'] + stats['write_misses'], blocks)
+            return 0, '{0} {1} cache 8 32/4096 {2} {3}/{4} {5} {6} {7} {8} 0 {3} {9} 1 {10} 2 migration_threshold 2048 {11} 0 rw -\n'.format(
+                table[0], table[1], table[6], used, blocks, stats['read_hits'], stats['read_misses'],
+                stats['write_hits'], stats['write_misses'], stats['dirty'], table[8], table[9]), ''
+
+        if action == 'reload':
+            device['reload'] = args[args.index('--table') + 1].split()
+            return 0, '', ''
+
+        if action == 'resume':
+            if 'reload' in device:
+                device['table'] = device.pop('reload')
+            # The cleaner policy writes every dirty block back to origin
+            if device['table'][2] == 'cache' and 'cleaner' in device['table']:
+                device['cache']['dirty'] = 0
+            return 0, '', ''
+
+        return 1, '', 'Unknown command {0}'.format(action)
+
+    def command_swapon(self, args, input):
+        name = args[-1] if args[-1] in self.allocated else self.name(args[-1])
+        device = self.allocated.get(name) or self.devices[name]
+        if device['fs'] != 'swap' or name in self.swaps:
+            return 255, '', 'swapon failed'
+        self.swaps[name] = int(args[1]) if args[0] == '-p' else -2 - len(self.swaps)
+        return 0, '', ''
+
+    def command_swapoff(self, args, input):
+        name = args[-1] if args[-1] in self.allocated else self.name(args[-1])
+        if name not in self.swaps:
+            return 255, '', 'swapoff failed'
+
+        # Pages swapped out must fit in memory or in the SWAP left
+        room = self.memory['MemAvailable'] + sum(self.swap_size(other) - self.swap_used.get(other, 0)
+                                                 for other in self.swaps if other != name)
+        if self.swap_used.get(name, 0) > room:
+            return 255, '', 'swapoff failed: Cannot allocate memory'
+
+        del self.swaps[name]
+        self.swap_used.pop(name, None)
+        return 0, '', ''
+
+    def swap_size(self, name):
+        if name in self.allocated:
+            return self.allocated[name]['size']
+        return self.devices[name]['size']
+
+    def command_fallocate(self, args, input):
+        path, size = args[-1], to_bytes(args[args.index('-l') + 1])
+        if os.path.dirname(path) not in self.directories or path in self.swaps:
+            return 1, '', 'fallocate failed'
+        self.files[path] = ''
+        self.allocated[path] = {'size': size, 'fs': None}
+        return 0, '', ''
+
+    def command_mount(self, args, input):
+        options, device, mount_point = args[1], self.name(args[2]), args[3]
+        if self.devices[device]['fs'] in (None, 'swap') or mount_point in self.mounts or not self.isdir(mount_point):
+            return 32, '', 'mount failed'
+        self.mounts[mount_point] = {'device': device, 'options': options}
+        return 0, '', ''
+
+    def command_umount(self, args, input):
+        if args[-1] not in self.mounts:
+            return 32, '', 'not mounted'
+        del self.mounts[args[-1]]
+        return 0, '', ''
+
+    def command_mdadm(self, args, input):
+        name = self.name(args[1])
+        if args[0] == '--stop':
+            if self.in_use(name):
+                return 1, '', 'Device or resource busy'
+            for member in self.devices[name]['members']:
+                self.devices[member]['fs'] = None
+            del self.devices[name]
+            return 0, '', ''
+
+        options = dict(arg[2:].split('=', 1) for arg in args if arg.startswith('--') and '=' in arg)
+        members = [self.name(arg) for arg in args[2:] if not arg.startswith('--')]
+        if name in self.devices or any(self.in_use(member) for member in members):
+            return 1, '', 'Device or resource busy'
+
+        chunk = int(options.get('chunk', 512)) * 1024
+        array = self.add_device(name, sum(self.devices[member]['size'] for member in members), major=9)
+        array['queue']['scheduler'] = 'none'
+        array['minor'] = int(name[2:])
+        array['members'] = members
+        array['queue']['minimum_io_size'] = str(chunk)
+        array['queue']['optimal_io_size'] = str(chunk * len(members))
+        for member in members:
+            self.devices[member]['fs'] = 'linux_raid_member'
+
+        return 0, '', ''
+
+
+class simulated_metadata:
+    """ Metadata service of simulated_backend, answering from its metadata_values
+        (None, as metadata_client does, for anything else) """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, key):
+        return self.backend.metadata_values.get(key)
+
+
+class simulated_file:
+    """ A device of simulated_backend opened for direct I/O, which only keeps
+        track of the offset. Reads return zeros, while writes wipe the file
+        system signature when they reach its superblock """
+
+    def __init__(self, backend, device, write):
+        self.backend = backend
+        self.device = device
+        self.writable = write
+        self.offset = 0
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def readinto(self, data):
+        length = max(min(len(data), self.device['size'] - self.offset), 0)
+        self.offset += length
+        return length
+
+    def write(self, data):
+        if not self.writable:
+            raise IOError(9, 'Bad file descriptor')
+        length = max(min(len(data), self.device['size'] - self.offset), 0)
+        with self.backend.lock:
+            if self.offset < 8192 and length:
+                self.device['fs'] = None
+        self.offset += length
+        return length
+
+    def close(self):
+        pass
+
+
+class inventory:
+    """ Block devices known by the kernel, read from /proc/partitions
+        and /sys/class/block without running any command.
+
+        The list is built once and kept until invalidate() is called,
+        which should happen after the partition table of a disk changes"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or system_backend()
+        self.lock = threading.Lock()
+        self.devices = None
+
+    def invalidate(self):
+        """ Forget the current list so it is read again on next lookup """
+
+        with self.lock:
+            self.devices = None
+
+    def refresh(self):
+        """ Read /proc/partitions and return a dictionary such as:
+
+        {'xvdb1': {'major': 202, 'minor': 17, 'blocks': 8388608, 'disk': 'xvdb', 'number': 1}}
+
+            Whole disks have both disk and number set as None.
+        """
+
+        devices = {}
+        for line in self.backend.read('/proc/partitions').splitlines()[2:]:
+            fields = line.split()
+            if len(fields) != 4:
+                continue
+
+            name = fields[3]
+            device = {'major': int(fields[0]),
+                      'minor': int(fields[1]),
+                      'blocks': int(fields[2]),
+                      'disk': None,
+                      'number': None}
+
+            # Partitions have a 'partition' file holding its number in sysfs
+            # and live inside the directory of the disk they belong to
+            sys_path = os.path.join('/sys/class/block', name)
+            try:
+                device['number'] = int(self.backend.read(os.path.join(sys_path, 'partition')))
+                device['disk'] = os.path.basename(os.path.dirname(self.backend.realpath(sys_path)))
+            except IOError:
+                pass
+
+            devices[name] = device
+
+        return devices
+
+    def snapshot(self):
+        """ Return the current list of devices, reading it again if it was invalidated """
+
+        with self.lock:
+            if self.devices is None:
+                self.devices = self.refresh()
+            return self.devices
+
+    def get(self, device):
+        """ Return the details of a device such as '/dev/xvdb1' or None if it does not exist """
+
+        return self.snapshot().get(os.path.basename(self.backend.realpath(device)))
+
+    def partitions(self, disk):
+        """ Return partitions of a disk such as ['xvdb1', 'xvdb2'] ordered by number """
+
+        name = os.path.basename(self.backend.realpath(disk))
+        found = [(device['number'], part) for part, device in self.snapshot().items() if device['disk'] == name]
+
+        return [part for number, part in sorted(found)]
+
+
+class mount_state:
+    """ Snapshot of mounted file systems and active SWAP, read from
+        /proc/self/mountinfo and /proc/swaps without running any command.
+
+        Both are keyed by device major:minor (e.g. '202:17'), so a
+        partition is never mistaken by another one with a similar name"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or system_backend()
+        self.mounts = {}
+        self.swaps = {}
+        self.swap_files = {}
+
+        for line in self.backend.read('/proc/self/mountinfo').splitlines():
+            # Optional fields end with a single '-' followed by fstype, source and super options
+            fields, extra = line.split(' - ', 1)
+            fields = fields.split()
+            extra = extra.split()
+            self.mounts.setdefault(fields[2], []).append({
+                'mountpoint': self.unescape(fields[4]),
+                'options': fields[5],
+                'fstype': extra[0],
+                'source': self.unescape(extra[1]),
+                'super_options': extra[2] if len(extra) > 2 else ''})
+
+        for line in self.backend.read('/proc/swaps').splitlines()[1:]:
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+
+            swap = {'filename': self.unescape(fields[0]),
+                    'type': fields[1],
+                    'size': int(fields[2]),
+                    'used': int(fields[3]),
+                    'priority': int(fields[4])}
+
+            if swap['type'] != 'partition':
+                self.swap_files[swap['filename']] = swap
+                continue
+
+            try:
+                major, minor = self.backend.device_number(swap['filename'])
+            except OSError:
+                continue
+            self.swaps['{0}:{1}'.format(major, minor)] = swap
+
+    def unescape(self, value):
+        """ Decode octal escapes used by the kernel for spaces and tabs (e.g. '\\040') """
+
+        return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), value)
+
+    def in_use(self, device_id):
+        """ Return True if device major:minor is mounted or used as SWAP """
+
+        return device_id in self.mounts or device_id in self.swaps
+
+
+class uevent_watcher:
+    """ Wait for device nodes to show up in /dev as soon as the kernel
+        or udev report them, listening to uevents through netlink.
+
+        The watcher must be created before the action that creates the
+        devices (e.g. a partition table write), so no event is missed:
+
+        watcher = uevent_watcher()
+        try:
+            os.system('partprobe /dev/xvdb')
+            watcher.wait(['/dev/xvdb1', '/dev/xvdb2'], 10)
+        finally:
+            watcher.close()
+        """
+
+    # Netlink protocol and multicast groups for kernel (1) and udev (2) uevents
+    NETLINK_KOBJECT_UEVENT = 15
+    GROUPS = 1 | 2
+
+    def __init__(self):
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, self.GROUPS))
+        except (AttributeError, socket.error), e:
+            logging.warning('Could not listen to uevents ({0}), checking devices periodically instead'.format(e))
+            self.sock = None
+
+    def wait(self, nodes, timeout=10):
+        """ Block until all nodes exist or timeout (seconds) is reached,
+            returning True or False depending on the result """
+
+        deadline = time.time() + timeout
+        while True:
+            if all(os.path.exists(node) for node in nodes):
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.error('Timed out waiting for {0}'.format(', '.join(node for node in nodes if not os.path.exists(node))))
+                return False
+
+            if self.sock is None:
+                time.sleep(min(0.1, remaining))
+                continue
+
+            # Any uevent wakes us up to check nodes again,
+            # pending events are drained as they may come in bursts
+            readable = select.select([self.sock], [], [], remaining)[0]
+            while readable:
+                self.sock.recv(65536)
+                readable = select.select([self.sock], [], [], 0)[0]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class metadata_client:
+    """ Read the instance metadata service (IMDSv2) with short timeouts and
+        a bounded number of retries, caching answers on disk, example:
+
+        metadata_client().get('instance-type') returns 'c5d.large'
+
+            A single session token is requested and reused for every
+            request until it expires. If the token cannot be requested
+            (IMDSv1 only) requests are sent without it. Answers are cached
+            in cache along with the instance identity (DMI board asset tag
+            or Xen hypervisor uuid), so they are reused across reboots of
+            the same instance but never by an instance launched from an
+            image of it. url can point to a local stand-in server, e.g.
+            metadata_client('http://127.0.0.1:8080', cache=None).
+
+            get returns None when the metadata service cannot be reached.
+        """
+
+    # Where the instance identity can be read, for Nitro and Xen based instances
+    IDENTITY_PATHS = ('/sys/devices/virtual/dmi/id/board_asset_tag', '/sys/hypervisor/uuid')
+
+    def __init__(self, url='http://169.254.169.254', timeout=1, retries=3, token_ttl=21600,
+                 cache='/var/cache/ephemeral_disk/metadata.json', backend=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.token_ttl = token_ttl
+        self.cache = cache
+        self.backend = backend or system_backend()
+        self.lock = threading.Lock()
+        self.token = None
+        self.token_expires = 0
+        self.identity = None
+        self.values = None
+
+    def identify(self):
+        """ Return the instance identity (e.g. i-0123456789abcdef0) or None if unknown """
+
+        for path in self.IDENTITY_PATHS:
+            try:
+                identity = self.backend.read(path).strip()
+            except IOError:
+                continue
+            if identity:
+                return identity
+
+        return None
+
+    def load(self):
+        """ Load answers cached by this very instance, if any """
+
+        self.values = {}
+        self.identity = self.identify()
+        if self.cache is None or self.identity is None:
+            return
+
+        try:
+            cached = json.loads(self.backend.read(self.cache))
+        except (IOError, ValueError):
+            return
+
+        if cached.get('identity') == self.identity:
+            self.values = cached.get('values', {})
+        else:
+            logging.info('Ignoring metadata cached by another instance in {0}'.format(self.cache))
+
+    def save(self):
+        if self.cache is None or self.identity is None:
+            return
+
+        try:
+            if not self.backend.isdir(os.path.dirname(self.cache)):
+                self.backend.makedirs(os.path.dirname(self.cache))
+            self.backend.write(self.cache, json.dumps({'identity': self.identity, 'values': self.values}))
+        except (IOError, OSError), e:
+            logging.warning('Could not cache metadata in {0}: {1}'.format(self.cache, e))
+
+    def request(self, path, method='GET', headers=None):
+        """ Send a request, retrying on timeouts, connection errors and
+            server errors. Returns the body, or raises the last error """
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(0.1 * 2 ** (attempt - 1))
+
+            request = urllib2.Request(self.url + path, headers=headers or {})
+            request.get_method = lambda: method
+            try:
+                response = urllib2.urlopen(request, timeout=self.timeout)
+                try:
+                    return response.read()
+                finally:
+                    response.close()
+            except urllib2.HTTPError, e:
+                # Client errors (e.g. 404 or 401) would get the same answer again
+                if e.code < 500 and e.code != 429:
+                    raise
+                error = e
+            except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+                error = e
+
+            logging.warning('Metadata request {0} {1} failed ({2}), attempt {3} of {4}'.format(
+                method, path, error, attempt + 1, self.retries + 1))
+
+        raise error
+
+    def session(self):
+        """ Return a valid session token, requesting one only when needed """
+
+        if self.token is not None and time.time() < self.token_expires:
+            return self.token
+
+        try:
+            self.token = self.request('/latest/api/token', 'PUT', {'X-aws-ec2-metadata-token-ttl-seconds': str(self.token_ttl)})
+            # Renew a bit earlier than needed, so the token does not expire in the middle of a request
+            self.token_expires = time.time() + self.token_ttl - 60
+        except urllib2.HTTPError, e:
+            logging.info('Could not get a metadata session token ({0}), using IMDSv1'.format(e))
+            self.token = None
+
+        return self.token
+
+    def get(self, key):
+        """ Return a metadata value (e.g. instance-type or placement/availability-zone) """
+
+        with self.lock:
+            if self.values is None:
+                self.load()
+            if key in self.values:
+                return self.values[key]
+
+            try:
+                token = self.session()
+                headers = {'X-aws-ec2-metadata-token': token} if token else {}
+                try:
+                    value = self.request('/latest/meta-data/' + key, headers=headers)
+                except urllib2.HTTPError, e:
+                    # Token was revoked or expired earlier than expected, ask for a new one once
+                    if e.code != 401 or not token:
+                        raise
+                    self.token = None
+                    value = self.request('/latest/meta-data/' + key, headers={'X-aws-ec2-metadata-token': self.session()})
+            except Exception, e:
+                logging.error('Could not read {0} from the metadata service: {1}'.format(key, e))
+                return None
+
+            self.values[key] = value.strip()
+            self.save()
+            return self.values[key]
+
+
+class step_scheduler:
+    """ Run the steps of a task graph concurrently, each one as soon as the
+        steps it depends on are done and the devices it locks are free, example:
+
+        scheduler = step_scheduler(function, workers=4)
+        scheduler.add('partition', {'device': '/dev/xvdb'}, locks=['/dev/xvdb'])
+        scheduler.add('mkswap', {'device': '/dev/xvdb1'}, after=['partition'], locks=['/dev/xvdb1'])
+        scheduler.add('format', {'device': '/dev/xvdb2'}, after=['partition'], locks=['/dev/xvdb2'])
+        scheduler.add('mount', {'device': '/dev/xvdb2'}, after=['format'], locks=['/dev/xvdb2'])
+        results = scheduler.run()
+
+            function is called with each task given to add, so mkswap and format
+            above overlap once partition is done. No two steps holding the same
+            lock run at the same time. When a step fails (raises or exits), the
+            steps depending on it are skipped while the others carry on.
+
+            run returns the result of each step by name, e.g.
+            {'mkswap': {'status': 'ok', 'started': 0.4, 'elapsed': 0.2, 'error': None, 'result': None}}
+            where status is ok, failed or skipped and started is relative to run.
+        """
+
+    def __init__(self, function, workers=4):
+        self.function = function
+        self.workers = workers
+        self.order = []
+        self.tasks = {}
+
+    def add(self, name, task, after=(), locks=()):
+        """ Add a step named name, run after the steps named in after, holding locks while it runs """
+
+        if name in self.tasks:
+            raise ValueError('Step {0} was already added'.format(name))
+
+        self.order.append(name)
+        self.tasks[name] = {'task': task, 'after': list(after), 'locks': set(locks)}
+
+    def run(self):
+        """ Run all steps added and return their results once all of them are over """
+
+        condition = threading.Condition()
+        pending = list(self.order)
+        running = set()
+        locked = set()
+        results = {}
+        started = time.time()
+
+        for name in self.order:
+            unknown = [dependency for dependency in self.tasks[name]['after'] if dependency not in self.tasks]
+            if unknown:
+                raise ValueError('Step {0} depends on unknown step(s) {1}'.format(name, ', '.join(unknown)))
+
+        def skip(name, error):
+            pending.remove(name)
+            results[name] = {'status': 'skipped', 'started': None, 'elapsed': None, 'error': error, 'result': None}
+
+        def next_step():
+            """ Return the first pending step ready to run, skipping those whose dependencies failed """
+
+            for name in list(pending):
+                after = self.tasks[name]['after']
+                failed = [dependency for dependency in after if dependency in results and results[dependency]['status'] != 'ok']
+                if failed:
+                    skip(name, '{0} did not complete'.format(', '.join(failed)))
+                elif all(dependency in results for dependency in after) and not self.tasks[name]['locks'] & locked:
+                    return name
+
+            return None
+
+        def worker():
+            while True:
+                with condition:
+                    while True:
+                        name = next_step()
+                        if name is not None:
+                            break
+                        if not pending:
+                            condition.notify_all()
+                            return
+                        if not running:
+                            # Nothing running can ever make the steps left ready (e.g. circular dependencies)
+                            for name in list(pending):
+                                skip(name, 'dependencies cannot be met')
+                            condition.notify_all()
+                            return
+                        condition.wait()
+
+                    pending.remove(name)
+                    running.add(name)
+                    locked.update(self.tasks[name]['locks'])
+
+                result = {'status': 'ok', 'started': time.time() - started, 'elapsed': None, 'error': None, 'result': None}
+                try:
+                    result['result'] = self.function(self.tasks[name]['task'])
+                except SystemExit, e:
+                    result['status'] = 'failed'
+                    result['error'] = 'exited with code {0}'.format(e.code)
+                except Exception, e:
+                    result['status'] = 'failed'
+                    result['error'] = "{0}".format(e)
+                result['elapsed'] = time.time() - started - result['started']
+
+                with condition:
+                    running.discard(name)
+                    locked.difference_update(self.tasks[name]['locks'])
+                    results[name] = result
+                    condition.notify_all()
+
+        threads = [threading.Thread(target=worker, name='step-scheduler-{0}'.format(index))
+                   for index in range(max(1, min(self.workers, len(self.order))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+
+class swap_monitor:
+    """ Grow SWAP on demand with swap files on an ephemeral file system, and
+        shrink it again once memory pressure is gone, example:
+
+        monitor = swap_monitor(tools(), directory='/mnt/swap', file_size='2G', max_files=4)
+        monitor.start()
+
+            /proc/meminfo and /proc/swaps are sampled every interval seconds
+            (two reads, no command run). When SWAP in use reaches high of the
+            SWAP available, or there is no SWAP and available memory falls
+            below memory_low of the total, a swap file of file_size is
+            preallocated (fallocate), formatted and enabled with priority, which
+            is lower than partitions set up by provision_disks so those are used
+            first. Then nothing is added for cooldown seconds, so the new file
+            shows up in the samples. Once SWAP in use would stay below low of
+            the SWAP left without the newest file for hold seconds, that file is
+            disabled and removed. Only files added here (or left in directory
+            by a previous monitor) are ever removed.
+
+            Every decision is kept in decisions with how long it took, and
+            report (also written as JSON to output after every decision) adds
+            how many samples were taken and how long sampling took, e.g.
+            {'action': 'grow', 'file': '/mnt/swap/swapfile0', 'status': 'ok', 'elapsed': 0.8, 'swap_used': 0.82, ...}
+        """
+
+    def __init__(self, ephemeral=None, directory='/mnt/swap', file_size='1G', max_files=4, priority=1,
+                 high=0.75, low=0.25, memory_low=0.1, hold=300, cooldown=30, interval=5, output=None):
+        self.ephemeral = ephemeral or tools()
+        self.backend = self.ephemeral.backend
+        self.directory = directory.rstrip('/')
+        self.file_size = self.ephemeral.to_bytes(file_size)
+        self.max_files = max_files
+        self.priority = priority
+        self.high = high
+        self.low = low
+        self.memory_low = memory_low
+        self.hold = hold
+        self.cooldown = cooldown
+        self.interval = interval
+        self.output = output
+        self.files = []
+        self.decisions = []
+        self.samples = 0
+        self.sample_time = 0.0
+        self.last_sample = None
+        self.last_grow = 0
+        self.adopted = False
+        self.low_since = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        """ Return memory and SWAP figures in bytes, e.g.
+            {'memory_total': 8589934592, 'memory_available': 536870912, 'swap_total': 1073741824, 'swap_used': 0,
+             'swap_files': {'/mnt/swap/swapfile0': {'size': 1073741824, 'used': 0}}}
+        """
+
+        started = time.time()
+        meminfo = {}
+        for line in self.backend.read('/proc/meminfo').splitlines():
+            fields = line.replace(':', ' ').split()
+            if len(fields) >= 2 and fields[0] in ('MemTotal', 'MemAvailable', 'MemFree', 'SwapTotal', 'SwapFree'):
+                meminfo[fields[0]] = int(fields[1]) * 1024
+
+        # Swap files are listed with their own size and use, in KiB
+        swap_files = {}
+        for line in self.backend.read('/proc/swaps').splitlines()[1:]:
+            fields = line.split()
+            if len(fields) >= 5 and fields[1] == 'file':
+                swap_files[fields[0]] = {'size': int(fields[2]) * 1024, 'used': int(fields[3]) * 1024}
+
+        sample = {'time': started,
+                  'memory_total': meminfo.get('MemTotal', 0),
+                  'memory_available': meminfo.get('MemAvailable', meminfo.get('MemFree', 0)),
+                  'swap_total': meminfo.get('SwapTotal', 0),
+                  'swap_used': meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0),
+                  'swap_files': swap_files}
+
+        with self.lock:
+            self.samples += 1
+            self.sample_time += time.time() - started
+            self.last_sample = sample
+
+        return sample
+
+    def adopt(self, sample):
+        """ Take over swap files left active in directory, e.g. by a monitor restarted """
+
+        for path in sorted(sample['swap_files']):
+            if os.path.dirname(path) == self.directory and path not in self.files:
+                logging.info('Taking over swap file {0}'.format(path))
+                self.files.append(path)
+
+    def decide(self, sample):
+        """ Return 'grow', 'shrink' or None for a sample """
+
+        now = sample['time']
+        memory_low = sample['memory_available'] < self.memory_low * sample['memory_total']
+
+        if sample['swap_total']:
+            pressure = sample['swap_used'] >= self.high * sample['swap_total']
+        else:
+            pressure = memory_low
+
+        if pressure:
+            self.low_since = None
+            if len(self.files) < self.max_files and now - self.last_grow >= self.cooldown:
+                return 'grow'
+            return None
+
+        # Shrinking only once SWAP left would still be mostly free, for hold seconds in a row
+        if self.files and not memory_low:
+            newest = sample['swap_files'].get(self.files[-1], {}).get('size', self.file_size)
+            if sample['swap_used'] <= self.low * (sample['swap_total'] - newest):
+                if self.low_since is None:
+                    self.low_since = now
+                if now - self.low_since >= self.hold:
+                    self.low_since = now
+                    return 'shrink'
+                return None
+
+        self.low_since = None
+        return None
+
+    def check(self):
+        """ Take a sample and act on it, returning the decision made (if any) """
+
+        sample = self.sample()
+        if not self.adopted:
+            self.adopt(sample)
+            self.adopted = True
+
+        action = self.decide(sample)
+        if action is None:
+            return None
+
+        decision = {'action': action,
+                    'time': sample['time'],
+                    'file': None,
+                    'status': 'ok',
+                    'error': None,
+                    'elapsed': None,
+                    'memory_available': float(sample['memory_available']) / max(sample['memory_total'], 1),
+                    'swap_used': float(sample['swap_used']) / sample['swap_total'] if sample['swap_total'] else None,
+                    'swap_files': len(self.files)}
+
+        started = time.time()
+        try:
+            if action == 'grow':
+                self.last_grow = sample['time']
+                decision['file'] = self.grow()
+            else:
+                decision['file'] = self.shrink()
+        except Exception, e:
+            decision['status'] = 'failed'
+            decision['error'] = "{0}".format(e)
+        decision['elapsed'] = time.time() - started
+
+        if decision['status'] == 'ok':
+            logging.info('Swap file {0} {1} in {2:.2f}s, {3} swap file(s) active'.format(
+                decision['file'], 'added' if action == 'grow' else 'removed', decision['elapsed'], len(self.files)))
+        else:
+            logging.error('Could not {0} SWAP: {1}'.format(action, decision['error']))
+
+        with self.lock:
+            self.decisions.append(decision)
+        self.save()
+
+        return decision
+
+    def grow(self):
+        """ Add a preallocated swap file, returning its path """
+
+        index = 0
+        while os.path.join(self.directory, 'swapfile{0}'.format(index)) in self.files or \
+                self.backend.exists(os.path.join(self.directory, 'swapfile{0}'.format(index))):
+            index += 1
+        path = os.path.join(self.directory, 'swapfile{0}'.format(index))
+
+        if not self.backend.isdir(self.directory):
+            self.backend.makedirs(self.directory)
+
+        # Preallocated rather than sparse, as the kernel refuses swap files with holes
+        try:
+            if self.ephemeral.run(['fallocate', '-l', str(self.file_size), path], 'fallocate', path):
+                raise IOError('Could not preallocate {0} bytes for {1}'.format(self.file_size, path))
+            self.backend.chmod(path, 0600)
+            if self.ephemeral.run(['mkswap', path], 'mkswap', path):
+                raise IOError('Could not format {0} as SWAP'.format(path))
+            if self.ephemeral.run(['swapon', '-p', str(int(self.priority)), path], 'swapon', path):
+                raise IOError('Could not enable SWAP on {0}'.format(path))
+        except Exception:
+            if self.backend.exists(path):
+                self.backend.remove(path)
+            raise
+
+        self.files.append(path)
+        return path
+
+    def shrink(self):
+        """ Disable and remove the newest swap file, returning its path """
+
+        path = self.files[-1]
+        if self.ephemeral.run(['swapoff', path], 'swapoff', path):
+            raise IOError('Could not disable SWAP on {0}'.format(path))
+
+        self.files.pop()
+        self.backend.remove(path)
+        return path
+
+    def run(self, duration=None):
+        """ Check every interval seconds until stop is called or duration seconds went by """
+
+        started = time.time()
+        logging.info('Monitoring SWAP pressure every {0}s, adding up to {1} swap file(s) in {2}'.format(
+            self.interval, self.max_files, self.directory))
+
+        while not self.stopping.is_set():
+            try:
+                self.check()
+            except Exception, e:
+                logging.error('Could not sample memory: {0}'.format(e))
+
+            if duration is not None and time.time() - started >= duration:
+                break
+            self.stopping.wait(self.interval)
+
+    def start(self):
+        """ Run in the background, returning the thread doing the work """
+
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='swap-monitor')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self, remove=False):
+        """ Stop running in the background, also disabling and removing swap files added when remove is set """
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        while remove and self.files:
+            self.shrink()
+        self.save()
+
+    def report(self):
+        """ Return decisions made, swap files active and how long sampling took """
+
+        with self.lock:
+            return {'samples': self.samples,
+                    'sample_time': self.sample_time,
+                    'files': list(self.files),
+                    'decisions': list(self.decisions),
+                    'last_sample': self.last_sample}
+
+    def save(self):
+        if self.output is None:
+            return
+
+        try:
+            self.backend.write(self.output, json.dumps(self.report(), indent=2, sort_keys=True))
+        except (IOError, OSError), e:
+            logging.warning('Could not write SWAP monitor report to {0}: {1}'.format(self.output, e))
+
+
+class tools:
+    """ This class will provide some useful functions to manage
+        EC2 instance resources"""
+
+    def __init__(self, force=0, device_timeout=30, backend=None, metadata=None):
+        """ Force parameter can be enabled when you are sure
+            that existing partitions can be deleted while you
+            are trying to create new ones. This also
+            applies for mount_points that can be forced to be
+            unmounted
+
+            Example:
+
+            t = ephemeral_python.tools(force=1)
+            t.create_disk_partition('/dev/xvdb', '1', 'c1.medium')
+
+            device_timeout is how long (in seconds) to wait for device
+            nodes to show up once a partition table or RAID array is written.
+
+            backend runs commands and reads /proc and /sys, system_backend
+            by default. simulated_backend keeps disks in memory instead:
+
+            t = ephemeral_python.tools(force=1, backend=ephemeral_python.simulated_backend())
+
+            metadata is the metadata_client used to find the instance type
+            when disk sizes cannot be read from sysfs. It is only created
+            (and the metadata service only reached) when needed.
+
+        """
+        self.force = force
+        self.device_timeout = device_timeout
+        self.backend = backend or system_backend()
+        self.inventory = inventory(self.backend)
+        self.metadata = metadata
+        self.metadata_lock = threading.Lock()
+
+        # Every external command run is recorded here (see run and report)
+        self.started = time.time()
+        self.spans = []
+        self.spans_lock = threading.Lock()
+
+        # Queue settings changed by tune_queue, to be restored by restore_queue
+        self.queue_defaults = {}
+        self.queue_lock = threading.Lock()
+
+        # Results of devices discarded in the background (see discard_devices)
+        self.discard_results = {}
+
+        # Latest figures of each device being prewarmed (see prewarm)
+        self.prewarm_status = {}
+        self.prewarm_lock = threading.Lock()
+
+        # Latest figures of each mount point being hydrated (see hydrate)
+        self.hydrate_status = {}
+        self.hydrate_lock = threading.Lock()
+
+    def create_disk_partition(self, disk, size, part_number, *instances):
+        """ Creates a partition using fdisk using the information given.
+
+            Example:
+
+            create_disk_partition('/dev/xvdj', '8G', '1')
+
+            This will create the first primary partition in /dev/xvdj
+            with 8GB size.
+
+            This function only creates primary partitions as
+            ephemeral disk is a spare disk and there is no need
+            to create logical partitions.
+
+            This function can also be used to create ephemeral SWAP partition
+            and also create another partition (usually for /mnt) using
+            the space left. It calculates only one ephemeral disk based
+            on instance type.
+
+            create_disk_partition('/dev/xvdj', '8G', '1', 'c1.medium')
+
+            This will create a SWAP of 8G + /mnt of 327G as total of the ephemeral
+            disk is 335 for a c1.medium instance. The disk size is read from sysfs,
+            so 'auto' can be given rather than the instance type, which is only used
+            when sysfs is not available. Both partitions are written at once
+            through write_partition_table, so partition number must be 1.
+            """
+
+        # fdisk commands to create partition
+        command = """
+n
+p
+{1}
+
++{0}
+w
+"""
+        partitioning = command.format(size, part_number)
+        partition = self.partition_name(disk, part_number)
+        try:
+            # Check if partition number is between 1 and 4
+            if not int(part_number) in range(1,5):
+                logging.error('Partition number must be between 1 and 4')
+                exit(2)
+
+            # Check if partition size is in Gigabytes or Megabytes, otherwise raise an error
+            if not re.match(r'^\d+[GM](iB)?$', size):
+                logging.error('Partitions size must be in Gigabytes or Megabytes (e.g 9G, 10G, 512M, 512MiB)')
+                exit(2)
+
+            # Check if any instance type was given as an argument
+            # and then write both SWAP and ephemeral partition (/mnt)
+            # in a single partition table write
+            for instance in instances:
+                if instance is not None:
+                    if part_number != '1':
+                        logging.error('Partition number must be 1 when an instance type is given')
+                        exit(2)
+
+                    self.write_partition_table(disk, [(size, 'swap'), (self.data_size(disk, size, instance), 'linux')])
+                    return
+
+            if not self.force:
+                # Check if partition selected exist, otherwise raise an error
+                # Hint: module commands or subprocess can be used here to simplify
+                if self.check_partition(partition):
+                    logging.error('Partition {0} already exist, please choose other one'.format(partition))
+                    logging.error('Set "force=1" while instantiating this class to force removing existing partitions')
+                    exit(2)
+            else:
+                count = 1
+                ## Loop through all primary partitions and delete if found
+                for attempts in range(1,5):
+                    my_part = self.partition_name(disk, str(count))
+                    if self.check_partition(my_part):
+                        self.delete_disk_partition(disk, str(count))
+
+                    # Jump to the next partition
+                    count = count + 1
+
+            # Partprobe is needed to reload Disk partition table on Linux as it is required in few cases
+            logging.info('Reloading Disk partition table')
+            self.run(['partprobe', disk], 'partprobe', disk)
+            self.inventory.invalidate()
+
+            logging.info('Creating partition...!')
+            watcher = self.backend.watcher()
+            try:
+                self.run(['fdisk', disk], 'fdisk', disk, partitioning)
+
+                # Partprobe is needed to reload Disk partition table on Linux as it is required in few cases
+                self.run(['partprobe', disk], 'partprobe', disk)
+                self.inventory.invalidate()
+
+                # Confirm if partition was created successfully
+                if not self.check_partition(partition) or not watcher.wait([partition], self.device_timeout):
+                    logging.critical('Could not create the partition. Maybe the size is too big?')
+                    exit(2)
+            finally:
+                watcher.close()
+
+            logging.info('Partition created successfully')
+
+        except Exception, e:
+            logging.critical("Error trying to create a new partition")
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def create_ephemeral_partition(self, disk, size, instance='auto'):
+        """ Create /mnt partition (number 2) using the space left once
+            the primary partition is created (Amazon ONLY). Example:
+
+            create_ephemeral_partition('/dev/xvdb', '8G', 'c1.medium')
+            """
+
+        self.create_disk_partition(disk, self.ephemeral_size(disk, size, instance), '2')
+
+    def ephemeral_size(self, disk, size, instance='auto'):
+        """ Calculate the space left in the ephemeral disk once
+            the primary partition size is taken. Example:
+
+            ephemeral_size('/dev/xvdb', '8G') returns '326G' for a 335G disk
+
+            The disk size is read from /sys/block/<disk>/size. Only if it
+            cannot be read, the instance type is looked up in EPHEMERAL_SIZES
+            (Amazon ONLY), please be aware that these numbers can change.
+            With 'auto', the instance type is read from the metadata service.
+            Whole Gigabytes of the disk are counted, see data_size to use
+            every byte left instead.
+            """
+
+        name = os.path.basename(self.backend.realpath(disk))
+        try:
+            # Size is given in 512 bytes sectors regardless of the disk sector size,
+            # first MiB is left out as partitions are aligned to it
+            total = (int(self.backend.read('/sys/block/{0}/size'.format(name))) * 512 - 1024 ** 2) // 1024 ** 3
+        except (IOError, ValueError):
+            if instance == 'auto':
+                instance = self.instance_type()
+            if instance not in EPHEMERAL_SIZES:
+                logging.error('Could not find the size of {0} nor the ephemeral disk size of instance type {1}'.format(disk, instance))
+                exit(2)
+            total = EPHEMERAL_SIZES[instance]
+
+        # Calculates how large ephemeral partition can be (in Megabytes)
+        eph = total * 1024 - self.to_bytes(size) // 1024 ** 2
+        if eph <= 0:
+            logging.error('There is no space left in {0} after a {1} partition'.format(disk, size))
+            exit(2)
+
+        # Whole Gigabytes are kept as such (e.g. 326G rather than 333824M)
+        if eph % 1024:
+            return "".join((str(eph), 'M'))
+        return "".join((str(eph // 1024), 'G'))
+
+    def data_size(self, disk, size, instance='auto'):
+        """ Return the size of a data partition following a primary partition
+            of size, as given to partition_layout. Example:
+
+            data_size('/dev/xvdb', '8G') returns None
+
+            None (the space left) is returned whenever the disk size can be
+            read from sysfs, so partition_layout works out the exact length.
+            Otherwise it falls back to ephemeral_size.
+            """
+
+        try:
+            self.device_size(disk)
+            return None
+        except (IOError, ValueError):
+            return self.ephemeral_size(disk, size, instance)
+
+    def instance_type(self):
+        """ Return the instance type from the metadata service (see metadata_client), example:
+
+            instance_type() returns 'm3.medium'
+            """
+
+        return self.metadata_service().get('instance-type')
+
+    def metadata_service(self):
+        """ Return the metadata_client given to this class, creating one on first use """
+
+        with self.metadata_lock:
+            if self.metadata is None:
+                self.metadata = self.backend.metadata()
+            return self.metadata
+
+    def ephemeral_mappings(self):
+        """ Return kernel names of instance store disks in the block device mapping of the instance, example:
+
+        ephemeral_mappings() returns ['xvdb', 'xvdc']
+
+            Names are read from block-device-mapping/ephemeral* in the metadata
+            service, where sdb shows up as xvdb on Xen instances. Returns None
+            if the metadata service cannot be reached.
+        """
+
+        metadata = self.metadata_service()
+        listing = metadata.get('block-device-mapping/')
+        if listing is None:
+            return None
+
+        names = []
+        for entry in sorted(line.strip() for line in listing.splitlines()):
+            if not entry.startswith('ephemeral'):
+                continue
+            device = metadata.get('block-device-mapping/{0}'.format(entry))
+            if not device:
+                continue
+
+            device = os.path.basename(device.strip())
+            candidates = [device]
+            if device.startswith('sd'):
+                candidates.append('xvd' + device[2:])
+            elif device.startswith('xvd'):
+                candidates.append('sd' + device[3:])
+            found = [name for name in candidates if self.backend.isdir(os.path.join('/sys/block', name))]
+            if found:
+                names.append(found[0])
+            else:
+                logging.warning('{0} ({1}) is mapped but was not found, skipping it'.format(entry, device))
+
+        return names
+
+    def partition_alignment(self, disk):
+        """ Return where partitions of a disk should start (in bytes), example:
+
+        partition_alignment('/dev/md0') returns 3145728 for an optimal I/O size of 768KiB
+
+            Partitions are aligned to 1MiB, or to the optimal I/O size of the
+            disk reported in sysfs (e.g. RAID stripe width) when it does not divide 1MiB.
+        """
+
+        alignment = 1024 ** 2
+        try:
+            optimal = int(self.backend.read(os.path.join(self.sysfs_queue(disk), 'optimal_io_size')))
+        except (IOError, ValueError):
+            optimal = 0
+
+        # Least common multiple, so partitions stay aligned to both
+        if optimal > 0 and optimal % 512 == 0:
+            alignment = alignment * optimal // gcd(alignment, optimal)
+
+        return alignment
+
+    def partition_layout(self, disk, layout, label='dos', alignment=None):
+        """ Work out where each partition of a layout starts and how large it is, example:
+
+        partition_layout('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+        returns [(1048576, 8589934592, 'swap'), (8590983168, 351119720448, 'linux')]
+
+            Sizes can be given in Gigabytes or Megabytes (8G, 512M, 512MiB),
+            as a percentage of the disk (25%) or as None (or 'rest') for the space
+            left, which only the last partition can use. Partitions start at
+            a multiple of alignment (see partition_alignment) and sizes are
+            rounded down to it, so the next partition is aligned too. Starts and
+            sizes are in bytes. When the disk size cannot be read from sysfs,
+            percentages are refused and the last partition size is left as None.
+        """
+
+        alignment = alignment or self.partition_alignment(disk)
+        try:
+            total = self.device_size(disk)
+        except (IOError, ValueError):
+            total = None
+
+        # GPT keeps a backup copy of the table at the end of the disk
+        end = None
+        if total is not None:
+            end = (total - (1024 ** 2 if label == 'gpt' else 0)) // alignment * alignment
+
+        start = alignment
+        partitions = []
+        for index, (size, part_type) in enumerate(layout):
+            if size in (None, 'rest'):
+                if index != len(layout) - 1:
+                    logging.error('Only the last partition can use the space left')
+                    exit(2)
+                length = end - start if end is not None else None
+            else:
+                try:
+                    length = self.to_bytes(size, end - alignment if end is not None else None) // alignment * alignment
+                except ValueError, e:
+                    logging.error('Partition size {0} is not valid: {1}'.format(size, e))
+                    exit(2)
+
+            if length is not None and (length <= 0 or (end is not None and start + length > end)):
+                logging.error('Partition {0} of {1} ({2}) does not fit in the disk'.format(index + 1, disk, size))
+                exit(2)
+
+            partitions.append((start, length, part_type))
+            if length is not None:
+                start += length
+
+        return partitions
+
+    def write_partition_table(self, disk, layout, label='auto', alignment=None):
+        """ Write a whole partition table at once using sfdisk, example:
+
+        write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+            Creates '/dev/xvdb1' with 8G as SWAP and '/dev/xvdb2' using
+            the space left. Sizes are given as in partition_layout (8G, 512M,
+            25% or None for the space left) and every partition is aligned
+            to 1MiB or the disk optimal I/O size. Types can be linux, swap,
+            raid or lvm.
+
+            label can be dos (MBR, up to 4 partitions and 2TiB) or gpt. With
+            auto, disks of 2TiB or more get a GPT label and smaller ones MBR.
+
+            Existing partitions are replaced by the new table in a single
+            write followed by a single partition table reload, so the disk
+            never holds a half written table. Exits if sfdisk fails or the
+            partitions found afterwards do not match the layout (e.g. an old
+            table is still in use). Returns the partitions created.
+            """
+
+        types = {'linux': 'L', 'swap': 'S', 'raid': 'R', 'lvm': 'V'}
+
+        # sfdisk script with one line per partition (start, size, type)
+        command = """label: {0}
+
+{1}
+"""
+
+        try:
+            if label == 'auto':
+                try:
+                    label = 'gpt' if self.device_size(disk) >= 2 * 1024 ** 4 else 'dos'
+                except (IOError, ValueError):
+                    label = 'dos'
+
+            if label not in ('dos', 'gpt'):
+                logging.error('Partition table label must be dos, gpt or auto')
+                exit(2)
+
+            # Check if the layout fits in primary partitions (MBR) or the GPT table
+            if not len(layout) in range(1, 5 if label == 'dos' else 129):
+                logging.error('Partition layout must have between 1 and {0} partitions'.format(4 if label == 'dos' else 128))
+                exit(2)
+
+            for size, part_type in layout:
+                if part_type not in types:
+                    logging.error('Partition type {0} is not supported, please choose one of {1}'.format(part_type, ', '.join(sorted(types))))
+                    exit(2)
+
+            # Starts and sizes are given to sfdisk in logical sectors of the disk
+            try:
+                sector = int(self.backend.read(os.path.join(self.sysfs_queue(disk), 'logical_block_size')))
+            except (IOError, ValueError):
+                sector = 512
+
+            lines = []
+            planned = self.partition_layout(disk, layout, label, alignment)
+            for start, length, part_type in planned:
+                if length is None:
+                    lines.append("start={0}, type={1}".format(start // sector, types[part_type]))
+                else:
+                    lines.append("start={0}, size={1}, type={2}".format(start // sector, length // sector, types[part_type]))
+
+            # Confirm that sfdisk binary exists
+            if not self.check_command('/sbin/sfdisk'):
+                logging.error('sfdisk command does not exist or cannot be accessible')
+                exit(2)
+
+            # Existing partitions are only replaced when force is set
+            # and anything still using the disk is unmounted first
+            existing = self.inventory.partitions(disk)
+            if existing and not self.force:
+                logging.error('Disk {0} already has partitions, cannot touch it!'.format(disk))
+                logging.error('Set "force=1" while instantiating this class to force removing existing partitions')
+                exit(2)
+
+            for device in [disk] + [os.path.join('/dev', part) for part in existing]:
+                if self.check_mount_point(device):
+                    if self.force:
+                        self.force_unmount(device)
+                    else:
+                        logging.error('Disk {0} already mounted, cannot touch it!'.format(device))
+                        exit(2)
+
+            logging.info('Writing {0} partition table of {1} with {2} partition(s)'.format(label, disk, len(layout)))
+            partitions = [self.partition_name(disk, number) for number in range(1, len(layout) + 1)]
+            watcher = self.backend.watcher()
+            try:
+                if self.run(['sfdisk', '--no-reread', '-q', disk], 'sfdisk', disk, command.format(label, "\n".join(lines))):
+                    logging.critical('Could not write the partition table of {0}'.format(disk))
+                    exit(2)
+
+                # Single reload of the disk partition table for all partitions written
+                self.run(['partprobe', disk], 'partprobe', disk)
+                self.inventory.invalidate()
+
+                # Partitions left over from an older table must not pass for the new ones
+                for partition, (start, length, part_type) in zip(partitions, planned):
+                    if not self.check_partition(partition):
+                        logging.critical('Could not create the partition {0}. Maybe the size is too big?'.format(partition))
+                        exit(2)
+                    if length is not None and self.device_size(partition) != length:
+                        logging.critical('Partition {0} is {1} bytes rather than {2}, the new partition table was not applied'.format(
+                            partition, self.device_size(partition), length))
+                        exit(2)
+
+                # Partitions are only usable once their device nodes exist
+                if not watcher.wait(partitions, self.device_timeout):
+                    logging.critical('Partitions of {0} did not show up in time'.format(disk))
+                    exit(2)
+            finally:
+                watcher.close()
+
+            logging.info('Partition table written successfully')
+            return partitions
+
+        except Exception, e:
+            logging.critical("Error trying to write the partition table of {0}".format(disk))
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def check_partition(self, partition):
+        """ Check if partition exists and return True or False
+
+            Partitions and disks are looked up by their exact name in
+            the inventory, which is only read again once a partition
+            table is changed by this class.
+        """
+
+        if self.inventory.get(partition) is not None:
+            return True
+        else:
+            return False
+
+    def check_mount_point(self, partition):
+        """ Check if partition is mounted, example:
+
+        check_mount_point('/dev/xvdj1')
+
+            Return True or False depending on the result, a partition
+            which is part of a RAID array or device mapper target counts
+            as mounted. However it force is enabled, it tries to unmount
+        """
+        try:
+
+            # Check if partition exists before enabling SWAP
+            if not self.check_partition(partition):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
+                exit(2)
+
+            # Ensure that partition in question is already mounted or not
+            # Returns True or False depending on the result
+            # It is also important to check if is mounted as SWAP which uses a different place,
+            # or part of a RAID array or device mapper target which is not mounted itself
+            usage = self.mount_usage(partition)
+            if usage['mounts'] or usage['swaps'] or usage['holders']:
+                return True
+            else:
+                return False
+
+        except Exception, e:
+            logging.critical("Error while checking mount point")
+            logging.error("{0}".format(e))
+
+    def mount_usage(self, partition):
+        """ Return where a partition is in use, example:
+
+        mount_usage('/dev/xvdb1') returns {'mounts': ['/mnt'], 'swaps': [], 'holders': []}
+
+            The partition itself, the whole disk it belongs to or,
+            for a disk, any of its partitions are taken into account.
+            holders are devices built on top of them, such as RAID
+            arrays or device mapper targets (e.g. ['md0']).
+        """
+
+        state = mount_state(self.backend)
+        device = self.inventory.get(partition)
+        if device is None:
+            return {'mounts': [], 'swaps': [], 'holders': []}
+
+        name = os.path.basename(self.backend.realpath(partition))
+        related = [name]
+        if device['disk'] is not None:
+            related.append(device['disk'])
+        else:
+            related.extend(self.inventory.partitions(partition))
+
+        mounts = []
+        swaps = []
+        holders = []
+        for item in related:
+            details = self.inventory.get(item)
+            device_id = '{0}:{1}'.format(details['major'], details['minor'])
+            mounts.extend(mount['mountpoint'] for mount in state.mounts.get(device_id, []))
+            if device_id in state.swaps:
+                swaps.append(state.swaps[device_id]['filename'])
+            holders.extend(self.holders(os.path.join('/dev', item)))
+
+        return {'mounts': mounts, 'swaps': swaps, 'holders': holders}
+
+    def run(self, argv, step, device=None, input=None):
+        """ Run an external command through the backend and record how long it took, example:
+
+        run(['mkswap', '/dev/xvdb1'], 'mkswap', '/dev/xvdb1')
+
+            input is given to the command standard input. Returns the
+            command exit code, which is also kept along with its duration
+            (see report). Error output is only logged (as a warning) if the
+            command fails.
+        """
+
+        return self.capture(argv, step, device, input)[0]
+
+    def capture(self, argv, step, device=None, input=None):
+        """ Run an external command as run does, returning its exit code and output, example:
+
+        capture(['dmsetup', 'status', 'ephemeral-cache'], 'dmsetup') returns (0, '0 41943040 cache 8 ...')
+        """
+
+        started = time.time()
+        exit_code, output, error = self.backend.execute(argv, input)
+        duration = time.time() - started
+
+        span = {'step': step,
+                'device': device,
+                'command': ' '.join(argv),
+                'started': started - self.started,
+                'duration': duration,
+                'exit_code': exit_code,
+                'processes': 1}
+
+        with self.spans_lock:
+            self.spans.append(span)
+
+        logging.debug('{0} on {1} took {2:.3f}s (exit code {3})'.format(step, device, duration, exit_code))
+        if exit_code:
+            logging.warning('{0} failed with exit code {1}: {2}'.format(span['command'], exit_code, (error or output).strip()))
+
+        return exit_code, output
+
+    def report(self):
+        """ Return how long each external command took, grouped by device, example:
+
+        {'duration': 12.3, 'commands': 9, 'processes': 20,
+         'steps': {'mkfs': {'count': 1, 'duration': 9.1, 'failed': 0}, ...},
+         'devices': {'/dev/xvdb2': [{'step': 'mkfs', 'duration': 9.1, 'exit_code': 0, ...}], ...}}
+
+            Durations are in seconds and 'started' of each command is relative
+            to when this class was instantiated.
+        """
+
+        with self.spans_lock:
+            spans = list(self.spans)
+
+        steps = {}
+        devices = {}
+        for span in spans:
+            summary = steps.setdefault(span['step'], {'count': 0, 'duration': 0.0, 'failed': 0})
+            summary['count'] += 1
+            summary['duration'] += span['duration']
+            if span['exit_code']:
+                summary['failed'] += 1
+            devices.setdefault(span['device'] or 'none', []).append(span)
+
+        return {'duration': time.time() - self.started,
+                'commands': len(spans),
+                'processes': sum(span['processes'] for span in spans),
+                'steps': steps,
+                'devices': devices}
+
+    def write_report(self, path):
+        """ Write report() as JSON to path, example:
+
+        write_report('/var/log/ephemeral_disk.json')
+        """
+
+        with open(path, 'w') as filename:
+            json.dump(self.report(), filename, indent=2, sort_keys=True)
+        logging.info('Report written to {0}'.format(path))
+
+    def check_command(self, command):
+        """ Check if command exists and can be executed.access
+
+            Returns True or False depending on the result
+        """
+
+        if self.backend.executable(command):
+            return True
+        else:
+            return False
+
+    def partition_name(self, disk, part_number):
+        """ Return the device name of a partition, example:
+
+        partition_name('/dev/xvdb', '1') returns '/dev/xvdb1'
+        partition_name('/dev/nvme1n1', '1') returns '/dev/nvme1n1p1'
+
+            Disks whose name ends with a digit (NVMe, loop, md) use
+            a 'p' separator before the partition number.
+        """
+
+        if disk[-1].isdigit():
+            return "".join((disk, 'p', str(part_number)))
+        else:
+            return "".join((disk, str(part_number)))
+
+    def delete_disk_partition(self, disk, part_number):
+        """ Delete partitions using fdisk, example:
+
+        delete('/dev/xvdj', '1')
+
+            Then, deletes partition 1 of the
+            disk /dev/xvdj. """
+
+        # fdisk commands to delete partition
+        command = """
+d
+{0}
+w
+"""
+        partitioning = command.format(part_number)
+        partition = self.partition_name(disk, part_number)
+        try:
+            # Check if partition number is between 1 and 4
+            if not part_number in str(partition):
+                logging.error('Partition number must be between 1 and 4')
+                exit(2)
+
+            # Check if partition selected exist, otherwise raise an error
+            if not self.check_partition(partition):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
+                exit(2)
+
+            logging.info("Deleting partition... !")
+            self.run(['fdisk', disk], 'fdisk', disk, partitioning)
+            self.inventory.invalidate()
+            logging.info("Partition deleted successfully")
+
+        except Exception, e:
+            logging.critical("Error while deleting disk partition {0} - Please double check if it is in use and try again".format(partition))
+            logging.error("{0}".format(e))
+
+    def enable_swap(self, partition, priority=None):
+        """ Enable SWAP partition previously created, example:
+
+        enable('/dev/xvdj1')
+
+            Then, formats partition as SWAP and then enable
+            using SWAPON command in Linux. Priority goes from
+            0 to 32767 and higher priority SWAP is used first,
+            when not given the kernel picks a decreasing one."""
+        try:
+
+            # Check if partition exists before enabling SWAP
+            if not self.check_partition(partition):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
+                exit(2)
+
+            # Confirm that mkswap binary exists
+            if not self.check_command('/sbin/mkswap'):
+                logging.error('mkswap command does not exist or cannot be accessible')
+                exit(2)
+
+            # Double check if partition is already in use
+            # and if Force is set unmount it before taking any action
+            if self.check_mount_point(partition):
+                if self.force:
+                    self.force_unmount(partition)
+                else:
+                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
+                    exit(2)
+
+            # Creates SWAP using mkswap and enable it using swapon
+            logging.info('Formating partition {0} as SWAP'.format(partition))
+            if self.run(['mkswap', partition], 'mkswap', partition):
+                logging.error('Could not format partition {0} as SWAP'.format(partition))
+                exit(2)
+
+            self.activate_swap(partition, priority)
+
+        except Exception, e:
+            logging.critical("Error while enabling SWAP")
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def activate_swap(self, partition, priority=None):
+        """ Enable a partition already formatted as SWAP using SWAPON, example:
+
+        activate_swap('/dev/xvdj1', 10)
+        """
+
+        if priority is None:
+            exit_code = self.run(['swapon', partition], 'swapon', partition)
+        else:
+            exit_code = self.run(['swapon', '-p', str(int(priority)), partition], 'swapon', partition)
+
+        if exit_code:
+            logging.error('Could not enable SWAP on {0}'.format(partition))
+            exit(2)
+        logging.info('SWAP enabled successfully')
+
+    def enable_striped_swap(self, partitions, priority=10):
+        """ Enable SWAP on several partitions with the same priority, example:
+
+        enable_striped_swap(['/dev/xvdb1', '/dev/xvdc1'])
+
+            Kernel interleaves pages across SWAP areas of equal priority,
+            so SWAP I/O is spread across all disks rather than one at a time.
+            Partitions are formatted at the same time. Exits once all of them
+            are done if any could not be enabled.
+        """
+
+        def enable(partition):
+            try:
+                self.enable_swap(partition, priority)
+                return None
+            except SystemExit:
+                return partition
+
+        logging.info('Enabling striped SWAP on {0} with priority {1}'.format(', '.join(partitions), priority))
+        failed = [partition for partition in self._map(enable, partitions) if partition is not None]
+        if failed:
+            logging.error('Could not enable SWAP on {0}'.format(', '.join(failed)))
+            exit(2)
+
+    def enable_zram_swap(self, size='1G', priority=100, algorithm='lz4'):
+        """ Enable a compressed SWAP in RAM using zram, example:
+
+        enable_zram_swap('2G') returns '/dev/zram0'
+
+            Size is the uncompressed size (e.g 512M, 2G). As its priority
+            is higher than the disk SWAP, pages go to RAM first and only
+            then to disk. If algorithm is not supported by the kernel, its
+            default is kept. Returns the zram device created.
+        """
+
+        try:
+            # Confirm that mkswap binary exists
+            if not self.check_command('/sbin/mkswap'):
+                logging.error('mkswap command does not exist or cannot be accessible')
+                exit(2)
+
+            if not self.backend.isdir('/sys/class/zram-control') and not self.backend.isdir('/sys/block/zram0'):
+                self.run(['modprobe', 'zram', 'num_devices=1'], 'modprobe')
+
+            # Newer kernels add zram devices on demand, older ones only have zram0
+            if self.backend.isdir('/sys/class/zram-control'):
+                name = 'zram{0}'.format(int(self.backend.read('/sys/class/zram-control/hot_add')))
+            else:
+                name = 'zram0'
+                if int(self.backend.read('/sys/block/zram0/disksize')):
+                    logging.error('zram device /dev/zram0 is already in use')
+                    exit(2)
+
+            device = os.path.join('/dev', name)
+            sys_path = os.path.join('/sys/block', name)
+
+            # Compression algorithm must be set before the size
+            if not self.write_sysfs(os.path.join(sys_path, 'comp_algorithm'), algorithm):
+                logging.warning('Compression algorithm {0} is not supported, keeping the default one'.format(algorithm))
+            if not self.write_sysfs(os.path.join(sys_path, 'disksize'), size):
+                logging.error('Could not set the size of {0} to {1}'.format(device, size))
+                exit(2)
+
+            # zram device only shows up as a block device once it has a size
+            self.inventory.invalidate()
+            self.enable_swap(device, priority)
+
+            return device
+
+        except Exception, e:
+            logging.critical("Error while enabling zram SWAP")
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def write_sysfs(self, path, value):
+        """ Write a value to a sysfs attribute, returning True or False depending on the result """
+
+        try:
+            self.backend.write(path, str(value))
+            return True
+        except IOError:
+            return False
+
+    def disable_swap(self, partition):
+        """ Disable SWAP partition, example
+
+        disable('/dev/xvdj1')
+
+            zram devices are also reset, releasing the memory they hold,
+            but only once swapoff succeeded. Exits if swapoff fails (e.g.
+            pages swapped out do not fit in memory anymore). """
+
+        try:
+            # Check if partition exists before enabling SWAP
+            if not self.check_partition(partition):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
+                exit(2)
+
+             # Confirm that swapoff binary exists
+            if not self.check_command('/sbin/swapoff'):
+                logging.error('swapoff command does not exist or cannot be accessible')
+                exit(2)
+
+            # Double check if partition is mounted as a file system
+            # and if Force is set unmount it before taking any action
+            usage = self.mount_usage(partition)
+            if usage['mounts']:
+                if self.force:
+                    self.force_unmount(partition)
+                else:
+                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
+                    exit(2)
+
+            for swap in usage['swaps']:
+                if self.run(['swapoff', swap], 'swapoff', partition):
+                    logging.error('Could not disable SWAP on {0}'.format(swap))
+                    exit(2)
+
+            name = os.path.basename(self.backend.realpath(partition))
+            if name.startswith('zram'):
+                self.write_sysfs(os.path.join('/sys/block', name, 'reset'), 1)
+                self.inventory.invalidate()
+
+            logging.info('SWAP disabled successfully')
+
+        except Exception, e:
+            logging.critical("Error while disabling SWAP")
+            logging.error("{0}".format(e))
+
+    def format_as_ext3(self, partition, profile='default'):
+        """ Format partition previously created as EXT3, example:
+
+        format_as_ext3('/dev/xvdj1')
+
+            See format_partition for profiles available.
+        """
+
+        return self.format_partition(partition, 'ext3', profile)
+
+    def format_as_ext4(self, partition, profile='default'):
+        """ Format partition previously created as EXT4, example:
+
+        format_as_ext4('/dev/xvdj1', 'fast-boot')
+
+            See format_partition for profiles available.
+        """
+
+        return self.format_partition(partition, 'ext4', profile)
+
+    def format_as_xfs(self, partition, profile='default'):
+        """ Format partition previously created as XFS, example:
+
+        format_as_xfs('/dev/xvdj1', 'throughput')
+
+            See format_partition for profiles available.
+        """
+
+        return self.format_partition(partition, 'xfs', profile)
+
+    def format_partition(self, partition, fs_type, profile='default'):
+        """ Format partition previously created as fs_type using a profile, example:
+
+        format_partition('/dev/xvdj1', 'ext4', 'fast-boot')
+
+            Profiles are listed in FORMAT_PROFILES:
+
+            default    - mkfs defaults
+            fast-boot  - lazy inode table and journal initialization, no discard while formatting
+            throughput - stripe aligned geometry (from the device I/O sizes) and a larger journal/log
+
+            Returns how long formatting took in seconds.
+        """
+
+        name = fs_type.upper()
+        try:
+            if fs_type not in ('ext3', 'ext4', 'xfs'):
+                logging.error('File system {0} is not supported, please choose ext3, ext4 or xfs'.format(fs_type))
+                exit(2)
+
+            if profile not in FORMAT_PROFILES:
+                logging.error('Format profile {0} does not exist, please choose one of {1}'.format(profile, ', '.join(sorted(FORMAT_PROFILES))))
+                exit(2)
+
+            # Check if partition selected exist, otherwise raise an error
+            if not self.check_partition(partition):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
+                exit(2)
+
+             # Confirm that mkfs binary exists
+            if not self.check_command('/sbin/mkfs.{0}'.format(fs_type)):
+                logging.error('mkfs.{0} command does not exist or cannot be accessible'.format(fs_type))
+                if fs_type == 'xfs':
+                    logging.info('Please make sure you have XFS file system tools installed')
+                exit(2)
+
+            # Double check if partition is already in use
+            # and if Force is set unmount it before taking any action
+            if self.check_mount_point(partition):
+                if self.force:
+                    self.force_unmount(partition)
+                else:
+                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
+                    exit(2)
+
+            options = self.format_options(partition, fs_type, profile)
+
+            logging.info('Formating partition {0} as {1} ({2} profile)'.format(partition, name, profile))
+
+            started = time.time()
+            if self.run(['mkfs.{0}'.format(fs_type), '-q'] + options.split() + [partition], 'mkfs', partition):
+                logging.error('Could not format partition {0} as {1}'.format(partition, name))
+                exit(2)
+            elapsed = time.time() - started
+
+            logging.info('Partition formatted successfully as {0} in {1:.2f}s'.format(name, elapsed))
+            return elapsed
+
+        except Exception, e:
+            logging.critical("Error while formatting partition as {0}".format(name))
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def format_options(self, partition, fs_type, profile):
+        """ Build mkfs options of a format profile for a partition, example:
+
+        format_options('/dev/md0', 'xfs', 'throughput') returns '-l size=512m -d su=256k,sw=2'
+        """
+
+        settings = FORMAT_PROFILES[profile]
+        options = [settings.get(fs_type, '')]
+
+        # Existing file systems are only overwritten when force is set
+        if self.force:
+            options.append('-f' if fs_type == 'xfs' else '-F')
+
+        # Stripe unit and width come from the device I/O sizes,
+        # which are set for RAID arrays (chunk and chunk * disks)
+        if settings.get('stripe'):
+            queue = self.sysfs_queue(partition)
+            try:
+                unit = int(self.backend.read(os.path.join(queue, 'minimum_io_size')))
+                width = int(self.backend.read(os.path.join(queue, 'optimal_io_size')))
+            except (IOError, ValueError):
+                unit = width = 0
+
+            if unit >= 4096 and width > unit and width % unit == 0:
+                if fs_type == 'xfs':
+                    options.append('-d su={0}k,sw={1}'.format(unit // 1024, width // unit))
+                else:
+                    options.append('-E stride={0},stripe_width={1}'.format(unit // 4096, width // 4096))
+
+        return ' '.join(option for option in options if option)
+
+    def sysfs_queue(self, device):
+        """ Return the sysfs queue directory of a device, example:
+
+        sysfs_queue('/dev/xvdb1') returns '/sys/block/xvdb/queue'
+
+            Partitions share the queue of the disk they belong to.
+        """
+
+        name = os.path.basename(self.backend.realpath(device))
+        details = self.inventory.get(device)
+        if details is not None and details['disk'] is not None:
+            name = details['disk']
+
+        return os.path.join('/sys/block', name, 'queue')
+
+    def supports_discard(self, device):
+        """ Return True if a device (or the disk a partition belongs to)
+            advertises discard support, i.e. discard_max_bytes is not 0 """
+
+        try:
+            return int(self.backend.read(os.path.join(self.sysfs_queue(device), 'discard_max_bytes'))) > 0
+        except (IOError, ValueError):
+            return False
+
+    def discard_partition(self, device):
+        """ Discard (TRIM) every block of a partition or a whole disk, example:
+
+        discard_partition('/dev/xvdb2')
+
+            SSD instance store keeps blocks written before (e.g. by partitions
+            removed using force) until they are discarded, and writes are slower
+            until the device garbage collects them. Devices that do not advertise
+            discard support in sysfs are skipped.
+
+            Returns how long discarding took in seconds, or None if it was skipped.
+        """
+
+        try:
+            # Check if device selected exist, otherwise raise an error
+            if not self.check_partition(device):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(device))
+                exit(2)
+
+            if not self.supports_discard(device):
+                logging.info('{0} does not support discard, skipping it'.format(device))
+                return None
+
+            # Confirm that blkdiscard binary exists
+            if not self.check_command('/sbin/blkdiscard'):
+                logging.error('blkdiscard command does not exist or cannot be accessible')
+                exit(2)
+
+            # Double check if device is already in use
+            # and if Force is set unmount it before taking any action
+            if self.check_mount_point(device):
+                if self.force:
+                    self.force_unmount(device)
+                else:
+                    logging.error('Partition {0} already mounted, cannot touch it!'.format(device))
+                    exit(2)
+
+            logging.info('Discarding all blocks of {0}'.format(device))
+
+            started = time.time()
+            if self.run(['blkdiscard', device], 'discard', device):
+                logging.error('Could not discard {0}'.format(device))
+                exit(2)
+            elapsed = time.time() - started
+
+            logging.info('{0} discarded successfully in {1:.2f}s'.format(device, elapsed))
+            return elapsed
+
+        except Exception, e:
+            logging.critical('Error while discarding {0}'.format(device))
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def discard_devices(self, devices, workers=None, background=False):
+        """ Discard several partitions or disks at the same time, example:
+
+        discard_devices(['/dev/nvme1n1', '/dev/nvme2n1'])
+
+            Returns the result for each device, e.g.
+            {'/dev/nvme1n1': {'status': 'ok', 'elapsed': 1.2, 'error': None}}
+            where status is skipped if the device does not support discard.
+            With background set, a thread doing the work is returned instead
+            and results are found in discard_results once it is over.
+        """
+
+        def run():
+            logging.info('Discarding {0} device(s): {1}'.format(len(devices), ', '.join(devices)))
+            results = dict((result.pop('device'), result) for result in self._map(self._discard_device, devices, workers))
+            self.discard_results.update(results)
+            return results
+
+        if background:
+            thread = threading.Thread(target=run, name='discard')
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        return run()
+
+    def _discard_device(self, device):
+        """ Discard a single device on behalf of discard_devices """
+
+        result = {'device': device, 'status': 'ok', 'elapsed': None, 'error': None}
+        try:
+            # Failures exit, so nothing returned means the device does not support discard
+            result['elapsed'] = self.discard_partition(device)
+            if result['elapsed'] is None:
+                result['status'] = 'skipped'
+        except SystemExit, e:
+            result['status'] = 'failed'
+            result['error'] = 'exited with code {0}'.format(e.code)
+
+        return result
+
+    def queue_settings(self, device):
+        """ Return the block queue settings of a device used by QUEUE_PROFILES, example:
+
+        queue_settings('/dev/xvdb1') returns {'scheduler': 'mq-deadline', 'read_ahead_kb': '128', 'nr_requests': '64',
+                                              'rotational': '0', 'add_random': '0'}
+
+            Partitions share the queue of their disk. Attributes a device does not have are left out.
+        """
+
+        queue = self.sysfs_queue(device)
+        settings = {}
+        for attribute in QUEUE_ATTRIBUTES:
+            try:
+                value = self.backend.read(os.path.join(queue, attribute)).strip()
+            except IOError:
+                continue
+
+            # Schedulers are listed with the one in use between brackets, e.g. '[mq-deadline] kyber none'
+            if attribute == 'scheduler':
+                match = re.search(r'\[(\S+)\]', value)
+                value = match.group(1) if match else value
+
+            settings[attribute] = value
+
+        return settings
+
+    def queue_changes(self, device, profile):
+        """ Return the queue settings of a profile that differ from those of a device, example:
+
+        queue_changes('/dev/xvdb', 'streaming') returns [('scheduler', 'mq-deadline'), ('read_ahead_kb', '4096')]
+
+            Settings are in the order they must be written, as changing the
+            scheduler resets nr_requests. A scheduler is only chosen if the
+            device offers it.
+        """
+
+        current = self.queue_settings(device)
+        changes = []
+        for attribute in QUEUE_ATTRIBUTES:
+            if attribute not in QUEUE_PROFILES[profile] or attribute not in current:
+                continue
+
+            value = QUEUE_PROFILES[profile][attribute]
+            if attribute == 'scheduler':
+                available = self.backend.read(os.path.join(self.sysfs_queue(device), 'scheduler')).replace('[', '').replace(']', '').split()
+                value = ([scheduler for scheduler in value.split(',') if scheduler in available] or [None])[0]
+                if value is None:
+                    continue
+
+            if current[attribute] != value:
+                changes.append((attribute, value))
+
+        return changes
+
+    def tune_queue(self, device, profile='streaming'):
+        """ Apply a queue profile to the block queue of a device, example:
+
+        tune_queue('/dev/md0', 'streaming')
+
+            Profiles are listed in QUEUE_PROFILES:
+
+            default   - distribution defaults, nothing is changed
+            streaming - large read ahead and a deep queue for sequential I/O
+            scratch   - no scheduler and no entropy from I/O, for SSD and NVMe
+
+            Partitions share the queue of their disk, so tuning a partition
+            tunes its disk. Previous values are kept in queue_defaults the first
+            time they change, so restore_queue can put them back. Returns the
+            settings changed with their previous values, e.g. {'read_ahead_kb': '128'}
+        """
+
+        try:
+            if profile not in QUEUE_PROFILES:
+                logging.error('Queue profile {0} does not exist, please choose one of {1}'.format(profile, ', '.join(sorted(QUEUE_PROFILES))))
+                exit(2)
+
+            # Check if device selected exist, otherwise raise an error
+            if not self.check_partition(device):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(device))
+                exit(2)
+
+            queue = self.sysfs_queue(device)
+            name = os.path.basename(os.path.dirname(queue))
+            previous = {}
+
+            with self.queue_lock:
+                current = self.queue_settings(device)
+                for attribute, value in self.queue_changes(device, profile):
+                    if not self.write_sysfs(os.path.join(queue, attribute), value):
+                        logging.warning('Could not set {0} of {1} to {2}'.format(attribute, name, value))
+                        continue
+                    previous[attribute] = current[attribute]
+                    self.queue_defaults.setdefault(name, {}).setdefault(attribute, current[attribute])
+
+            logging.info('Queue of {0} tuned with {1} profile ({2} setting(s) changed)'.format(name, profile, len(previous)))
+            return previous
+
+        except Exception, e:
+            logging.critical('Error while tuning the queue of {0}'.format(device))
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def restore_queue(self, devices=None, defaults=None):
+        """ Put back queue settings changed by tune_queue, example:
+
+        restore_queue(['/dev/md0'])
+
+            All devices tuned are restored when devices is not given. defaults
+            can be given rather than queue_defaults, e.g. loaded from a JSON
+            copy of queue_defaults saved before a restart. Returns the
+            settings restored for each device (e.g. {'md0': {'read_ahead_kb': '128'}}).
+        """
+
+        with self.queue_lock:
+            defaults = self.queue_defaults if defaults is None else defaults
+            names = sorted(defaults) if devices is None else [os.path.basename(os.path.dirname(self.sysfs_queue(device))) for device in devices]
+
+            restored = {}
+            for name in names:
+                settings = defaults.get(name, {})
+                queue = os.path.join('/sys/block', name, 'queue')
+                for attribute in QUEUE_ATTRIBUTES:
+                    if attribute not in settings:
+                        continue
+                    if self.write_sysfs(os.path.join(queue, attribute), settings[attribute]):
+                        restored.setdefault(name, {})[attribute] = settings[attribute]
+                    else:
+                        logging.warning('Could not restore {0} of {1} to {2}'.format(attribute, name, settings[attribute]))
+
+                if defaults is self.queue_defaults:
+                    self.queue_defaults.pop(name, None)
+
+        logging.info('Queue settings of {0} device(s) restored'.format(len(restored)))
+        return restored
+
+    def mount_partition(self, partition, mount_point, profile='default', commit=None, discard=None):
+        """ Mount partition previously created and formatted, example:
+
+        mount_partition('/dev/xvdj2', '/mnt')
+
+            Mount options can be given through a profile listed in MOUNT_PROFILES:
+
+            default - mount defaults
+            scratch - no access time updates and a relaxed journal, trading
+                      durability for throughput as ephemeral data is disposable
+
+            commit sets the journal commit interval in seconds (EXT3/EXT4 only)
+            and discard chooses between 'online' discard (EXT4/XFS only) and
+            'batched', which leaves discard to a periodic fstrim. Profiles other
+            than default, commit and discard are validated against the file
+            system found in the partition, while with none of them any file
+            system (e.g. btrfs) is mounted with defaults and detected by mount.
+
+            mount_partition('/dev/xvdj2', '/mnt', 'scratch', commit=60, discard='batched')
+
+            Returns the mount options used.
+        """
+
+        try:
+            # Check if partition selected exist, otherwise raise an error
+            if not self.check_partition(partition):
+                logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
+                exit(2)
+
+             # Confirm that mount binary exists
+            if not self.check_command('/bin/mount'):
+                logging.error('mount command does not exist or cannot be accessible, please ensure you also have permission to mount')
+                exit(2)
+
+            options = self.mount_options(partition, profile, commit, discard)
+
+            # Double check if partition is already in use
+            # and if Force is set unmount it before taking any action
+            if self.check_mount_point(partition):
+                if self.force:
+                    self.force_unmount(partition)
+                else:
+                    logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
+                    exit(2)
+
+            logging.info('Mounting partition {0} in {1} with options {2}'.format(partition, mount_point, options))
+
+            if self.run(['mount', '-o', options, partition, mount_point], 'mount', partition):
+                logging.error('Could not mount partition {0} in {1}'.format(partition, mount_point))
+                exit(2)
+
+            logging.info('Partition {0} was mounted successfully in {1}'.format(partition, mount_point))
+            return options
+
+        except Exception, e:
+            logging.critical("Error while mounting partition {0} in {1}".format(partition, mount_point))
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def mount_options(self, partition, profile='default', commit=None, discard=None):
+        """ Build and validate mount options for the file system in a partition, example:
+
+        mount_options('/dev/xvdj2', 'scratch', 60) returns 'noatime,nodiratime,data=writeback,barrier=0,commit=60'
+        """
+
+        if profile not in MOUNT_PROFILES:
+            logging.error('Mount profile {0} does not exist, please choose one of {1}'.format(profile, ', '.join(sorted(MOUNT_PROFILES))))
+            exit(2)
+
+        fs_type = self.probe_fs_type(partition)
+        if fs_type == 'swap':
+            logging.error('Partition {0} is formatted as SWAP, please use enable_swap instead'.format(partition))
+            exit(2)
+
+        # File systems not known here are left for mount to detect
+        if profile == 'default' and commit is None and discard is None:
+            return 'defaults'
+
+        if fs_type is None:
+            logging.error('Partition {0} does not have an EXT3, EXT4 or XFS file system, which {1} profile, commit and discard need'.format(
+                partition, profile))
+            exit(2)
+
+        options = [MOUNT_PROFILES[profile].get(fs_type, 'defaults')]
+
+        if commit is not None:
+            if fs_type not in ('ext3', 'ext4'):
+                logging.error('Journal commit interval is only supported by EXT3/EXT4, not {0}'.format(fs_type.upper()))
+                exit(2)
+            options.append('commit={0}'.format(int(commit)))
+
+        if discard == 'online':
+            if fs_type not in ('ext4', 'xfs'):
+                logging.error('Online discard is only supported by EXT4/XFS, not {0}'.format(fs_type.upper()))
+                exit(2)
+            options.append('discard')
+        elif discard == 'batched':
+            logging.info('Discard is batched, please make sure fstrim runs periodically (e.g. fstrim.timer)')
+        elif discard is not None:
+            logging.error('Discard must be either online or batched')
+            exit(2)
+
+        return ','.join(options)
+
+    def probe_fs_type(self, partition):
+        """ Find which file system a partition holds by reading its superblock, example:
+
+        probe_fs_type('/dev/xvdj2') returns 'ext4'
+
+            Returns ext2, ext3, ext4, xfs, swap or None if nothing was found.
+        """
+
+        header = self.backend.read_bytes(partition, 8192)
+
+        if header[:4] == 'XFSB':
+            return 'xfs'
+
+        # SWAP signature is at the end of the first page
+        for page_size in (4096, 8192):
+            if header[page_size - 10:page_size] in ('SWAPSPACE2', 'SWAP-SPACE'):
+                return 'swap'
+
+        # EXT superblock starts at 1024 with its magic number at offset 56
+        superblock = header[1024:2048]
+        if superblock[56:58] == '\x53\xef':
+            compat = struct.unpack('<I', superblock[92:96])[0]
+            incompat = struct.unpack('<I', superblock[96:100])[0]
+
+            # extents, 64bit or flex_bg features are EXT4 only, a journal makes it EXT3
+            if incompat & (0x40 | 0x80 | 0x200):
+                return 'ext4'
+            if compat & 0x4:
+                return 'ext3'
+            return 'ext2'
+
+        return None
+
+    def force_unmount(self, partition):
+        """ Force unmount partition once mounted
+
+        force_unmount('/dev/xvdb1') or force_unmount('/dev/xvdb)
+
+        """
+
+        if self.force:
             # Check if partition selected exist, otherwise raise an error
             # Hint: module commands or subprocess can be used here to simplify
             if not self.check_partition(partition):
                 logging.error('Partition {0} does not exist, please choose an existing one'.format(partition))
                 exit(2)
 
-            logging.info("Unmounting file system")
-            for attempts in range(1,4):
-                # Check if full partition or entire disk is mounted
-                # Then umounts if true (swap and or FS)
-                # This can be improved confirming if it is SWAP or FS rather than using both commands
+            # RAID arrays and device mapper targets are never torn down here, as they may hold data
+            holders = self.mount_usage(partition)['holders']
+            if holders:
+                logging.error('{0} is used by {1}, please stop it first (see stop_raid and remove_cache)'.format(
+                    partition, ', '.join(holders)))
+                exit(2)
+
+            logging.info("Unmounting file system")
+            for attempts in range(1,4):
+                # Check if full partition or entire disk is mounted
+                # Then umounts each mount point and SWAP found
+                usage = self.mount_usage(partition)
+                if not usage['mounts'] and not usage['swaps']:
+                    # Break the loop If unmounted successfully otherwise try again
+                    logging.info('Unmounted sucessfully!')
+                    break
+
+                # Deepest mount points go first as others may be mounted on top of them
+                for mount_point in sorted(usage['mounts'], reverse=True):
+                    self.run(['umount', '-l', mount_point], 'umount', partition)
+                for swap in usage['swaps']:
+                    self.run(['swapoff', swap], 'swapoff', partition)
+
+    def discover_disks(self):
+        """ Discover ephemeral (instance store) disks available, example:
+
+        discover_disks() returns ['/dev/xvdb', '/dev/xvdc']
+
+            NVMe disks are instance store when their model says so, while other
+            disks (e.g. xvdb on Xen instances, where EBS volumes look the same)
+            must be listed as ephemeral in the block device mapping of the
+            metadata service (see ephemeral_mappings). If it cannot be reached,
+            only NVMe disks are returned. Virtual devices (loop, ram, md, dm,
+            zram, cdrom) and the disk that holds the root file system are never
+            returned, nor disks that are part of a RAID array or device mapper
+            target built on other disks too (e.g. root on LVM or a cache in
+            front of an EBS volume). Disks mounted or used as SWAP (e.g. /mnt
+            on a freshly launched instance) are only returned when force is
+            set, so they are unmounted once provisioned, as are disks held by
+            arrays built only on ephemeral disks (see stop_raid). Disks
+            skipped can still be given to provision_disks explicitly.
+        """
+
+        ignored = ('loop', 'ram', 'md', 'dm-', 'zram', 'sr', 'fd', 'nbd')
+        mappings = None
+
+        # Find which disk holds the root file system through its major:minor
+        root_path = self.backend.realpath('/sys/dev/block/{0}:{1}'.format(*self.backend.root_device()))
+        if self.backend.exists(os.path.join(root_path, 'partition')):
+            root_path = os.path.dirname(root_path)
+        root_disk = os.path.basename(root_path)
+
+        candidates = []
+        for name in sorted(self.backend.listdir('/sys/block')):
+            if name.startswith(ignored) or name == root_disk:
+                continue
+
+            # NVMe devices can be either instance store or EBS volumes
+            if name.startswith('nvme'):
+                try:
+                    if 'Instance Storage' not in self.backend.read('/sys/block/{0}/device/model'.format(name)):
+                        continue
+                except IOError:
+                    continue
+            else:
+                # Other EBS volumes can only be told apart through the block device mapping
+                if mappings is None:
+                    mappings = self.ephemeral_mappings()
+                    if mappings is None:
+                        logging.warning('Block device mapping is unknown, only NVMe instance store disks are used')
+                        mappings = []
+                if name not in mappings:
+                    continue
+
+            candidates.append(name)
+
+        disks = []
+        for name in candidates:
+            disk = os.path.join('/dev', name)
+            usage = self.mount_usage(disk)
+            used = usage['mounts'] + usage['swaps'] + usage['holders']
+
+            # Arrays or targets also built on other disks hold data that does not go away with the instance
+            foreign = sorted(self.stacked_disks(usage['holders']) - set(candidates))
+            if foreign or (used and not self.force):
+                logging.warning('{0} is in use ({1}), skipping it'.format(disk, ', '.join(used)))
+                continue
+            if used:
+                logging.info('{0} is in use ({1}), it is released when provisioned as force is set'.format(disk, ', '.join(used)))
+
+            disks.append(disk)
+
+        return disks
+
+    def provision_disks(self, instance='auto', disks=None, swap_size='8G', fs_type='ext4', mount_point='/mnt', workers=None,
+                        format_profile='default', mount_profile='default', swap_priority=10, idempotent=False, discard=None,
+                        queue_profile=None):
+        """ Partition, format and mount all ephemeral disks concurrently, example:
+
+        provision_disks()
+
+            Each disk gets a SWAP partition of swap_size plus a data partition
+            with the space left, formatted as fs_type using format_profile. SWAP partitions
+            share swap_priority, so SWAP I/O is striped across disks. Disk sizes are read from
+            sysfs and instance type is only used if that fails. The first disk is mounted
+            in mount_point using mount_profile and the following ones in mount_point plus
+            its index (/mnt, /mnt1, /mnt2...). When disks is not given, discover_disks is used.
+
+            When idempotent is set, each disk is compared with the desired state
+            (see plan_disk) and only what differs is done, e.g. after a reboot
+            an ephemeral disk already partitioned and formatted is only mounted.
+
+            discard can be 'disk' to discard whole disks before they are partitioned
+            or 'partition' to discard data partitions before they are formatted (see
+            discard_partition), which is skipped on disks without discard support.
+            queue_profile is applied to the queue of every disk once it is mounted
+            (see tune_queue), keeping previous settings in queue_defaults.
+
+            Disks are planned at the same time, then the steps of all disks run as a
+            single task graph (see step_scheduler and schedule_plan) on workers (two per
+            disk by default), so SWAP and data partitions of a disk are set up at the
+            same time once it is partitioned. A failing step only stops the steps that
+            depend on it and a failing disk does not abort the others, instead a
+            dictionary with the result of each disk is returned:
+
+            {'/dev/xvdb': {'status': 'ok', 'swap': '/dev/xvdb1', 'data': '/dev/xvdb2', 'mount_point': '/mnt',
+                           'format_time': 42.1, 'discard_time': None, 'steps': ['partition', 'mkswap', 'format', 'mount'],
+                           'error': None}}
+        """
+
+        if fs_type not in ('ext3', 'ext4', 'xfs'):
+            logging.error('File system {0} is not supported, please choose ext3, ext4 or xfs'.format(fs_type))
+            exit(2)
+
+        if discard not in (None, 'disk', 'partition'):
+            logging.error('Discard must be disk or partition')
+            exit(2)
+
+        if disks is None:
+            disks = self.discover_disks()
+
+        if not disks:
+            logging.warning('No ephemeral disks were found')
+            return {}
+
+        jobs = []
+        for index, disk in enumerate(disks):
+            if index:
+                disk_mount_point = '{0}{1}'.format(mount_point, index)
+            else:
+                disk_mount_point = mount_point
+            jobs.append({'disk': disk,
+                         'instance': instance,
+                         'swap_size': swap_size,
+                         'swap_priority': swap_priority,
+                         'fs_type': fs_type,
+                         'format_profile': format_profile,
+                         'mount_point': disk_mount_point,
+                         'mount_profile': mount_profile,
+                         'idempotent': idempotent,
+                         'discard': discard,
+                         'queue_profile': queue_profile})
+
+        logging.info('Provisioning {0} disk(s): {1}'.format(len(disks), ', '.join(disks)))
+        results = self._map(self._plan_job, jobs, workers)
+
+        scheduler = step_scheduler(self.apply_step, workers or 2 * len(jobs))
+        for result in results:
+            if result['status'] == 'ok':
+                self.schedule_plan(scheduler, result['disk'], result['plan'])
+        outcomes = scheduler.run()
+
+        for result in results:
+            for step in result.pop('plan'):
+                outcome = outcomes[step['name']]
+                if outcome['status'] != 'ok':
+                    result['status'] = 'failed'
+                    result['error'] = result['error'] or '{0}: {1}'.format(step['step'], outcome['error'])
+                elif step['step'] == 'format':
+                    result['format_time'] = step['elapsed']
+                elif step['step'] == 'discard' and not step['skipped']:
+                    result['discard_time'] = (result['discard_time'] or 0) + step['elapsed']
+
+        failed = [result['disk'] for result in results if result['status'] != 'ok']
+        if failed:
+            logging.error('Could not provision disk(s): {0}'.format(', '.join(failed)))
+        else:
+            logging.info('All disks provisioned successfully')
+
+        return dict((result.pop('disk'), result) for result in results)
+
+    def _map(self, function, jobs, workers=None):
+        """ Run function for each job on a pool of workers (one per job by default)
+            and return their results in the same order.
+
+            Plain threads are used rather than multiprocessing ThreadPool, whose
+            teardown alone takes about 100ms. The first error raised by function
+            (SystemExit included) is raised again once all workers are done.
+        """
+
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        errors = []
+        pending = iter(range(len(jobs)))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    index = next(pending, None)
+                if index is None:
+                    return
+                try:
+                    results[index] = function(jobs[index])
+                except BaseException, e:
+                    with lock:
+                        errors.append((index, e))
+
+        threads = [threading.Thread(target=worker) for index in range(min(workers or len(jobs), len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise min(errors)[1]
+        return results
+
+    def _plan_job(self, job):
+        """ Plan a single disk on behalf of provision_disks, returning its
+            result so far along with the steps planned as 'plan' """
+
+        disk = job['disk']
+        result = {'disk': disk,
+                  'status': 'ok',
+                  'swap': self.partition_name(disk, '1'),
+                  'data': self.partition_name(disk, '2'),
+                  'mount_point': job['mount_point'],
+                  'format_time': None,
+                  'discard_time': None,
+                  'steps': [],
+                  'plan': [],
+                  'error': None}
+
+        # Planning exits on errors, which is caught so that the remaining disks can carry on
+        try:
+            result['plan'] = self.plan_disk(disk, job['swap_size'], job['fs_type'], job['mount_point'], job['instance'],
+                                            job['swap_priority'], job['format_profile'], job['mount_profile'],
+                                            compare=job['idempotent'], discard=job['discard'],
+                                            queue_profile=job['queue_profile'])
+            result['steps'] = [step['step'] for step in result['plan']]
+        except SystemExit, e:
+            result['status'] = 'failed'
+            result['error'] = 'exited with code {0}'.format(e.code)
+        except Exception, e:
+            result['status'] = 'failed'
+            result['error'] = "{0}".format(e)
+
+        return result
+
+    def _provision_disk(self, job):
+        """ Partition a single disk and enable its SWAP on behalf of provision_raid0,
+            the data partition is only created (as RAID member).
+        """
+
+        disk = job['disk']
+        swap_size = job['swap_size']
+        result = {'disk': disk,
+                  'status': 'ok',
+                  'swap': self.partition_name(disk, '1'),
+                  'data': self.partition_name(disk, '2'),
+                  'mount_point': job.get('mount_point'),
+                  'format_time': None,
+                  'discard_time': None,
+                  'steps': [],
+                  'error': None}
+
+        # Methods called here exit on errors, which is caught
+        # so that the remaining disks can carry on
+        try:
+            data_size = self.data_size(disk, swap_size, job['instance'])
+            self.write_partition_table(disk, [(swap_size, 'swap'), (data_size, 'raid')])
+            self.enable_swap(result['swap'], job.get('swap_priority'))
+        except SystemExit, e:
+            result['status'] = 'failed'
+            result['error'] = 'exited with code {0}'.format(e.code)
+        except Exception, e:
+            result['status'] = 'failed'
+            result['error'] = "{0}".format(e)
+
+        return result
+
+    def plan_disk(self, disk, swap_size='8G', fs_type='ext4', mount_point='/mnt', instance='auto',
+                  swap_priority=None, format_profile='default', mount_profile='default', compare=True, discard=None,
+                  queue_profile=None):
+        """ Compare a disk with its desired state and return the steps needed, example:
+
+        plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt')
+
+            Desired state is a SWAP partition of swap_size plus a data partition
+            with the space left formatted as fs_type and mounted in mount_point.
+            The partition table, file system signatures, active SWAP and mount
+            points found are compared against it, so after a reboot where the
+            disk survived it only returns what is missing:
+
+            [{'step': 'swapon', 'device': '/dev/xvdb1', 'priority': None},
+             {'step': 'mount', 'device': '/dev/xvdb2', 'mount_point': '/mnt', 'profile': 'default'}]
+
+            Steps are discard, partition, mkswap, swapon, format, mount and tune, which can be
+            done through apply_plan. When compare is False every step is returned.
+            With discard set to 'disk', the whole disk is discarded before it is
+            partitioned, and with 'disk' or 'partition' the data partition is
+            discarded before it is formatted (unless the whole disk just was).
+            With queue_profile, a last tune step applies it to the disk queue
+            (see tune_queue), when compared only if its settings differ.
+        """
+
+        swap = self.partition_name(disk, '1')
+        data = self.partition_name(disk, '2')
+        layout = [(swap_size, 'swap'), (self.data_size(disk, swap_size, instance), 'linux')]
+
+        partition_step = {'step': 'partition', 'device': disk, 'layout': layout}
+        mkswap_step = {'step': 'mkswap', 'device': swap, 'priority': swap_priority}
+        swapon_step = {'step': 'swapon', 'device': swap, 'priority': swap_priority}
+        format_step = {'step': 'format', 'device': data, 'fs_type': fs_type, 'profile': format_profile}
+        mount_step = {'step': 'mount', 'device': data, 'mount_point': mount_point, 'profile': mount_profile}
+        tune_steps = [{'step': 'tune', 'device': disk, 'profile': queue_profile}] if queue_profile else []
+
+        # Blocks are discarded right before they are written again
+        if discard == 'disk':
+            partition_steps = [{'step': 'discard', 'device': disk}, partition_step, mkswap_step, format_step, mount_step]
+        elif discard == 'partition':
+            partition_steps = [partition_step, mkswap_step, {'step': 'discard', 'device': data}, format_step, mount_step]
+        else:
+            partition_steps = [partition_step, mkswap_step, format_step, mount_step]
+
+        if not compare:
+            return partition_steps + tune_steps
+
+        # Partition table must have exactly both partitions with the sizes expected (in KiB),
+        # data partitions made by earlier releases were ephemeral_size long rather than the space left
+        layouts = [layout]
+        if layout[1][0] is None:
+            layouts.append([(swap_size, 'swap'), (self.ephemeral_size(disk, swap_size, instance), 'linux')])
+        expected = [[length // 1024 for start, length, part_type in self.partition_layout(disk, candidate)] for candidate in layouts]
+        partitions = [self.inventory.get(part) for part in self.inventory.partitions(disk)]
+        if [os.path.join('/dev', part) for part in self.inventory.partitions(disk)] != [swap, data] or \
+                [part['blocks'] for part in partitions] not in expected:
+            logging.info('Partition table of {0} differs from the one expected'.format(disk))
+            return partition_steps + tune_steps
+
+        steps = []
+        usage = self.mount_usage(swap)
+        if self.probe_fs_type(swap) != 'swap':
+            steps.append(mkswap_step)
+        elif swap not in usage['swaps']:
+            steps.append(swapon_step)
+
+        if self.probe_fs_type(data) != fs_type:
+            if discard is not None:
+                steps.append({'step': 'discard', 'device': data})
+            steps.extend([format_step, mount_step])
+        elif self.mount_usage(data)['mounts'] != [mount_point]:
+            steps.append(mount_step)
+
+        # Queue settings do not survive a reboot
+        if queue_profile and self.queue_changes(disk, queue_profile):
+            steps.extend(tune_steps)
+
+        logging.info('{0} needs {1} step(s): {2}'.format(disk, len(steps), ', '.join(step['step'] for step in steps) or 'none'))
+        return steps
+
+    def apply_plan(self, steps):
+        """ Apply steps returned by plan_disk in order, example:
+
+        apply_plan(plan_disk('/dev/xvdb'))
+
+            Each step gets how long it took in seconds as 'elapsed', and discard
+            steps also get 'skipped' when the device does not support discard.
+        """
+
+        for step in steps:
+            self.apply_step(step)
+
+        return steps
+
+    def apply_step(self, step):
+        """ Apply a single step returned by plan_disk, adding how long it took as 'elapsed'
+
+            Exits if the step could not be applied, so a step that returns was done
+            (or, for discard, skipped as the device does not support it).
+        """
+
+        started = time.time()
+        if step['step'] == 'discard':
+            step['skipped'] = self.discard_partition(step['device']) is None
+        elif step['step'] == 'partition':
+            self.write_partition_table(step['device'], step['layout'])
+        elif step['step'] == 'mkswap':
+            self.enable_swap(step['device'], step['priority'])
+        elif step['step'] == 'swapon':
+            self.activate_swap(step['device'], step['priority'])
+        elif step['step'] == 'format':
+            self.format_partition(step['device'], step['fs_type'], step['profile'])
+        elif step['step'] == 'mount':
+            if not self.backend.isdir(step['mount_point']):
+                self.backend.makedirs(step['mount_point'])
+            self.mount_partition(step['device'], step['mount_point'], step['profile'])
+        elif step['step'] == 'tune':
+            self.tune_queue(step['device'], step['profile'])
+        else:
+            logging.error('Step {0} is not supported'.format(step['step']))
+            exit(2)
+
+        step['elapsed'] = time.time() - started
+        return step
+
+    def schedule_plan(self, scheduler, disk, steps):
+        """ Add steps returned by plan_disk for disk to a step_scheduler, example:
+
+        scheduler = step_scheduler(self.apply_step)
+        schedule_plan(scheduler, '/dev/xvdb', plan_disk('/dev/xvdb'))
+        scheduler.run()
+
+            Each step runs after the steps planned before it on the same device
+            or on the whole disk, and locks its device while running. So once
+            the disk is partitioned, SWAP and the data partition are set up at
+            the same time. Steps on the whole disk (e.g. 'tune') run after every
+            step planned before them, so they are skipped when the data
+            partition could not be formatted or mounted. Steps are named after their disk, index and step
+            (e.g. '/dev/xvdb:2:format'), which is also kept in each step as 'name'.
+        """
+
+        for index, step in enumerate(steps):
+            step['name'] = '{0}:{1}:{2}'.format(disk, index, step['step'])
+            after = [previous['name'] for previous in steps[:index] if step['device'] == disk or previous['device'] in (step['device'], disk)]
+            scheduler.add(step['name'], step, after, [step['device']])
+
+        return steps
+
+    def create_raid0(self, partitions, md_device='/dev/md0', chunk=512):
+        """ Stripe partitions into a single RAID0 array using mdadm, example:
+
+        create_raid0(['/dev/xvdb2', '/dev/xvdc2'], '/dev/md0', 256)
+
+            Chunk size is given in KiB and must be a power of 2. The array
+            can then be formatted and mounted as any other partition:
+
+            format_as_ext4('/dev/md0')
+            mount_partition('/dev/md0', '/mnt')
+        """
+
+        try:
+            # Check if chunk size is a power of 2 and at least 4KiB
+            chunk = int(chunk)
+            if chunk < 4 or chunk & (chunk - 1):
+                logging.error('Chunk size must be a power of 2 and at least 4 (KiB)')
+                exit(2)
+
+            if len(partitions) < 2:
+                logging.error('RAID0 needs at least 2 partitions')
+                exit(2)
+
+            # Confirm that mdadm binary exists
+            if not self.check_command('/sbin/mdadm'):
+                logging.error('mdadm command does not exist or cannot be accessible')
+                logging.info('Please make sure you have mdadm installed')
+                exit(2)
+
+            if self.check_partition(md_device):
+                logging.error('RAID array {0} already exist, please choose other one'.format(md_device))
+                exit(2)
+
+            for partition in partitions:
+                # Check if partition selected exist, otherwise raise an error
+                if not self.check_partition(partition):
+                    logging.error('Partition {0} does not exist, please choose an existent one'.format(partition))
+                    exit(2)
+
+                # Double check if partition is already in use
+                # and if Force is set unmount it before taking any action
                 if self.check_mount_point(partition):
-                    os.system("umount -l {0} 2>/dev/null".format(partition))
-                    os.system("swapoff {0} 2>/dev/null".format(partition))
-                elif self.check_mount_point(partition[:-1]):
-                    os.system("umount -l {0} 2>/dev/null".format(partition[:-1]))
-                    os.system("swapoff {0} 2>/dev/null".format(partition[:-1]))
+                    if self.force:
+                        self.force_unmount(partition)
+                    else:
+                        logging.error('Partition {0} already mounted, cannot touch it!'.format(partition))
+                        exit(2)
+
+            logging.info('Creating RAID0 array {0} with {1}'.format(md_device, ', '.join(partitions)))
+            watcher = self.backend.watcher()
+            try:
+                self.run(['mdadm', '--create', md_device, '--run', '--level=0', '--chunk={0}'.format(chunk),
+                          '--raid-devices={0}'.format(len(partitions))] + partitions, 'mdadm', md_device)
+                self.inventory.invalidate()
+
+                if not self.check_partition(md_device) or not watcher.wait([md_device], self.device_timeout):
+                    logging.critical('Could not create RAID0 array {0}'.format(md_device))
+                    exit(2)
+            finally:
+                watcher.close()
+
+            logging.info('RAID0 array {0} created successfully'.format(md_device))
+            return md_device
+
+        except Exception, e:
+            logging.critical("Error while creating RAID0 array {0}".format(md_device))
+            logging.error("{0}".format(e))
+            exit(2)
+
+    def stop_raid(self, md_device):
+        """ Unmount and stop a RAID array, so its partitions can be used again, example:
+
+        stop_raid('/dev/md0')
+        """
+
+        try:
+            if not self.check_partition(md_device):
+                logging.error('RAID array {0} does not exist, please choose an existent one'.format(md_device))
+                exit(2)
+
+            if self.check_mount_point(md_device):
+                if self.force:
+                    self.force_unmount(md_device)
                 else:
-                    # Break the loop If unmounted successfully otherwise try again
-                    logging.info('Unmounted sucessfully!')
-                    break
+                    logging.error('RAID array {0} already mounted, cannot touch it!'.format(md_device))
+                    exit(2)
+
+            logging.info('Stopping RAID array {0}'.format(md_device))
+            self.run(['mdadm', '--stop', md_device], 'mdadm', md_device)
+            self.inventory.invalidate()
+
+        except Exception, e:
+            logging.critical("Error while stopping RAID array {0}".format(md_device))
+            logging.error("{0}".format(e))
+
+    def holders(self, device):
+        """ Return devices built on top of a device, e.g. ['md0'] or ['dm-1'], from sysfs """
+
+        name = os.path.basename(self.backend.realpath(device))
+        try:
+            return sorted(self.backend.listdir('/sys/class/block/{0}/holders'.format(name)))
+        except OSError:
+            return []
+
+    def slaves(self, device):
+        """ Return devices a RAID array or device mapper target is built on, e.g. ['xvdb2', 'xvdc2'], from sysfs """
+
+        name = os.path.basename(self.backend.realpath(device))
+        try:
+            return sorted(self.backend.listdir('/sys/class/block/{0}/slaves'.format(name)))
+        except OSError:
+            return []
+
+    def stacked_disks(self, holders):
+        """ Return the disks that holders (e.g. ['dm-0']), and anything stacked on top of them
+            or underneath them, are built on, e.g. set(['xvdb', 'xvdf']) for a dm-cache """
+
+        disks = set()
+        pending = list(holders)
+        seen = set()
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+
+            device = os.path.join('/dev', name)
+            slaves = self.slaves(device)
+            pending.extend(self.holders(device) + slaves)
+            if not slaves:
+                disks.add((self.inventory.get(name) or {}).get('disk') or name)
+
+        return disks
+
+    def create_cache(self, origin, cache_partition, name='ephemeral-cache', mode='writethrough', block_size='256K', policy='smq'):
+        """ Use an ephemeral partition as a block cache (dm-cache) in front of a persistent device, example:
+
+        create_cache('/dev/xvdf', '/dev/xvdb2') returns '/dev/mapper/ephemeral-cache'
+
+            cache_partition is split into a metadata area and a data area holding
+            copies of origin blocks of block_size, which are then read at instance
+            store latency. The cache device returned must be used (e.g. mounted)
+            rather than origin from then on.
+
+            Only writethrough (writes reach origin before they complete) and
+            passthrough modes are allowed, as blocks only written to an ephemeral
+            disk would be lost when the instance stops. Call remove_cache before
+            stopping the instance.
+        """
+
+        mapper = os.path.join('/dev/mapper', name)
+        created = []
+        try:
+            if mode not in ('writethrough', 'passthrough'):
+                logging.error('Cache mode must be writethrough or passthrough, data only held by an ephemeral disk is lost on stop')
+                exit(2)
+
+            # Cache blocks must be a multiple of 32KiB between 32KiB and 1GiB
+            block_size = self.to_bytes(block_size)
+            if block_size % (32 * 1024) or not 32 * 1024 <= block_size <= 1024 ** 3:
+                logging.error('Cache block size must be a multiple of 32K between 32K and 1G')
+                exit(2)
+
+            # Check if partitions selected exist, otherwise raise an error
+            for device in (origin, cache_partition):
+                if not self.check_partition(device):
+                    logging.error('Partition {0} does not exist, please choose an existent one'.format(device))
+                    exit(2)
+
+            if self.check_partition(mapper):
+                logging.error('Cache {0} already exist, please choose other name'.format(mapper))
+                exit(2)
+
+            # Origin holds persistent data, so it is never unmounted on our behalf
+            if self.check_mount_point(origin):
+                logging.error('Partition {0} already mounted, please unmount it and mount {1} once created'.format(origin, mapper))
+                exit(2)
+
+            # Double check if cache partition is already in use
+            # and if Force is set unmount it before taking any action
+            if self.check_mount_point(cache_partition):
+                if self.force:
+                    self.force_unmount(cache_partition)
+                else:
+                    logging.error('Partition {0} already mounted, cannot touch it!'.format(cache_partition))
+                    exit(2)
+
+            for device in (origin, cache_partition):
+                if self.holders(device):
+                    logging.error('Partition {0} is already used by {1}, cannot touch it!'.format(device, ', '.join(self.holders(device))))
+                    exit(2)
+
+            # Confirm that dmsetup binary exists
+            if not self.check_command('/sbin/dmsetup'):
+                logging.error('dmsetup command does not exist or cannot be accessible')
+                logging.info('Please make sure you have device mapper tools installed')
+                exit(2)
+
+            # Metadata needs about 4MiB plus 16 bytes per cache block, rounded up to 1MiB
+            cache_size = self.device_size(cache_partition)
+            metadata = (4 * 1024 ** 2 + 16 * (cache_size // block_size) + 1024 ** 2 - 1) // 1024 ** 2 * 1024 ** 2
+            data = (cache_size - metadata) // block_size * block_size
+            if data <= 0:
+                logging.error('Partition {0} is too small to be used as cache'.format(cache_partition))
+                exit(2)
+
+            # Metadata left by a previous use of the partition would be loaded as it is,
+            # so the metadata area starts zeroed
+            zeros = mmap.mmap(-1, 1024 ** 2)
+            handle = self.backend.open_direct(cache_partition, True)
+            try:
+                handle.write(zeros)
+            finally:
+                handle.close()
+                zeros.close()
+
+            tables = [(name + '-cmeta', '0 {0} linear {1} 0'.format(metadata // 512, cache_partition)),
+                      (name + '-cdata', '0 {0} linear {1} {2}'.format(data // 512, cache_partition, metadata // 512)),
+                      (name, '0 {0} cache {1}-cmeta {1}-cdata {2} {3} 1 {4} {5} 0'.format(
+                          self.device_size(origin) // 512, mapper, origin, block_size // 512, mode, policy))]
+
+            logging.info('Creating cache {0} of {1} on {2} ({3} mode)'.format(mapper, origin, cache_partition, mode))
+            watcher = self.backend.watcher()
+            try:
+                for target, table in tables:
+                    if self.run(['dmsetup', 'create', target, '--table', table], 'dmsetup', cache_partition):
+                        logging.critical('Could not create {0}'.format(target))
+                        exit(2)
+                    created.append(target)
+                self.inventory.invalidate()
+
+                if not watcher.wait([mapper], self.device_timeout):
+                    logging.critical('Cache {0} did not show up in time'.format(mapper))
+                    exit(2)
+            finally:
+                watcher.close()
+
+            logging.info('Cache {0} created successfully'.format(mapper))
+            return mapper
+
+        except SystemExit:
+            # Targets created so far would keep both partitions busy
+            for target in reversed(created):
+                self.run(['dmsetup', 'remove', target], 'dmsetup', cache_partition)
+            self.inventory.invalidate()
+            raise
+        except Exception, e:
+            logging.critical('Error while creating cache {0}'.format(mapper))
+            logging.error("{0}".format(e))
+
+    def cache_stats(self, name='ephemeral-cache'):
+        """ Return statistics of a cache created by create_cache, example:
+
+        cache_stats() returns {'read_hits': 9120, 'read_misses': 880, 'read_hit_ratio': 0.912, 'write_hits': 10,
+                               'write_misses': 90, 'demotions': 0, 'promotions': 880, 'dirty': 0,
+                               'used_blocks': 880, 'total_blocks': 1331200, 'block_size': 262144}
+
+            Counters are kept by the kernel since the cache was created.
+            Returns None if the cache cannot be found.
+        """
+
+        exit_code, output = self.capture(['dmsetup', 'status', name], 'dmsetup', os.path.join('/dev/mapper', name))
+
+        # start length cache metadata_block_size used/total_metadata cache_block_size used/total_blocks
+        # read_hits read_misses write_hits write_misses demotions promotions dirty ...
+        fields = output.split()
+        if exit_code or len(fields) < 14 or fields[2] != 'cache':
+            logging.error('Could not read statistics of cache {0}'.format(name))
+            return None
+
+        used, total = fields[6].split('/')
+        stats = dict(zip(('read_hits', 'read_misses', 'write_hits', 'write_misses', 'demotions', 'promotions', 'dirty'),
+                         [int(field) for field in fields[7:14]]))
+        stats.update({'used_blocks': int(used),
+                      'total_blocks': int(total),
+                      'block_size': int(fields[5]) * 512,
+                      'read_hit_ratio': None})
+
+        reads = stats['read_hits'] + stats['read_misses']
+        if reads:
+            stats['read_hit_ratio'] = float(stats['read_hits']) / reads
+
+        return stats
+
+    def remove_cache(self, name='ephemeral-cache', timeout=600):
+        """ Remove a cache created by create_cache, leaving origin as it was, example:
+
+        remove_cache()
+
+            Meant to be called before the instance is stopped. Should any block
+            be dirty, the cache is first switched to the cleaner policy, which
+            writes them back to origin, waiting up to timeout seconds.
+            The cache device is unmounted first if force is set.
+        """
+
+        mapper = os.path.join('/dev/mapper', name)
+        try:
+            if not self.check_partition(mapper):
+                logging.error('Cache {0} does not exist, please choose an existent one'.format(mapper))
+                exit(2)
+
+            if self.check_mount_point(mapper):
+                if self.force:
+                    self.force_unmount(mapper)
+                else:
+                    logging.error('Cache {0} already mounted, cannot touch it!'.format(mapper))
+                    exit(2)
+
+            stats = self.cache_stats(name)
+            if stats is None:
+                exit(2)
+
+            if stats['dirty']:
+                logging.info('Writing {0} dirty block(s) of {1} back to origin'.format(stats['dirty'], mapper))
+                exit_code, table = self.capture(['dmsetup', 'table', name], 'dmsetup', mapper)
+
+                # Same table with the cleaner policy: start length cache metadata data origin block_size #features features... policy
+                fields = table.split()
+                policy = 8 + int(fields[7])
+                self.run(['dmsetup', 'reload', name, '--table', ' '.join(fields[:policy] + ['cleaner', '0'])], 'dmsetup', mapper)
+                self.run(['dmsetup', 'resume', name], 'dmsetup', mapper)
+
+                deadline = time.time() + timeout
+                while stats is not None and stats['dirty']:
+                    if time.time() > deadline:
+                        logging.critical('Cache {0} still has {1} dirty block(s), it cannot be removed safely'.format(mapper, stats['dirty']))
+                        exit(2)
+                    time.sleep(1)
+                    stats = self.cache_stats(name)
+
+            logging.info('Removing cache {0}'.format(mapper))
+            for target in (name, name + '-cdata', name + '-cmeta'):
+                if self.run(['dmsetup', 'remove', target], 'dmsetup', mapper):
+                    logging.critical('Could not remove {0}'.format(target))
+                    exit(2)
+            self.inventory.invalidate()
+
+            logging.info('Cache {0} removed successfully'.format(mapper))
+
+        except Exception, e:
+            logging.critical('Error while removing cache {0}'.format(mapper))
+            logging.error("{0}".format(e))
+
+    def provision_raid0(self, instance='auto', disks=None, swap_size='8G', fs_type='ext4', mount_point='/mnt',
+                        md_device='/dev/md0', chunk=512, workers=None, format_profile='throughput', mount_profile='default',
+                        swap_priority=10, queue_profile=None):
+        """ Stripe the data partitions of all ephemeral disks into a RAID0 array, example:
+
+        provision_raid0(fs_type='xfs', chunk=256)
+
+            Each disk gets a SWAP partition of swap_size (all of them with swap_priority)
+            plus a RAID partition with the space left, all disks at the same time as provision_disks does.
+            RAID partitions are then striped into md_device, which is formatted
+            as fs_type using format_profile and mounted in mount_point using mount_profile.
+            queue_profile is then applied to the array and to every disk in it (see tune_queue).
+            Returns a dictionary such as:
+
+            {'status': 'ok', 'md_device': '/dev/md0', 'mount_point': '/mnt', 'format_time': 3.2, 'error': None, 'disks': {...}}
+
+            Where disks holds the result of each disk as in provision_disks.
+            With a single disk, the data partition is mounted as provision_disks does.
+        """
+
+        if fs_type not in ('ext3', 'ext4', 'xfs'):
+            logging.error('File system {0} is not supported, please choose ext3, ext4 or xfs'.format(fs_type))
+            exit(2)
+
+        if disks is None:
+            disks = self.discover_disks()
+
+        if len(disks) < 2:
+            logging.warning('RAID0 needs at least 2 disks, provisioning them without RAID')
+            return {'status': 'ok', 'md_device': None, 'mount_point': mount_point, 'error': None,
+                    'format_time': None,
+                    'disks': self.provision_disks(instance=instance, disks=disks, swap_size=swap_size, fs_type=fs_type,
+                                                  mount_point=mount_point, workers=workers, format_profile=format_profile,
+                                                  mount_profile=mount_profile, swap_priority=swap_priority,
+                                                  queue_profile=queue_profile)}
+
+        result = {'status': 'ok', 'md_device': md_device, 'mount_point': mount_point, 'format_time': None, 'error': None, 'disks': {}}
+        try:
+            # An array left from a previous run holds the partitions that are about to be replaced
+            if self.check_partition(md_device):
+                if self.force:
+                    self.stop_raid(md_device)
+                else:
+                    logging.error('RAID array {0} already exist, cannot touch it!'.format(md_device))
+                    exit(2)
+
+            logging.info('Provisioning {0} disk(s) for RAID0: {1}'.format(len(disks), ', '.join(disks)))
+            jobs = [{'disk': disk, 'instance': instance, 'swap_size': swap_size, 'swap_priority': swap_priority} for disk in disks]
+            for disk_result in self._map(self._provision_disk, jobs, workers):
+                result['disks'][disk_result.pop('disk')] = disk_result
+
+            failed = [disk for disk, disk_result in sorted(result['disks'].items()) if disk_result['status'] != 'ok']
+            if failed:
+                logging.error('Could not provision disk(s): {0}'.format(', '.join(failed)))
+                exit(2)
+
+            partitions = [result['disks'][disk]['data'] for disk in disks]
+            self.create_raid0(partitions, md_device, chunk)
+            result['format_time'] = self.format_partition(md_device, fs_type, format_profile)
+
+            if not self.backend.isdir(mount_point):
+                self.backend.makedirs(mount_point)
+            self.mount_partition(md_device, mount_point, mount_profile)
+
+            if queue_profile:
+                for device in [md_device] + disks:
+                    self.tune_queue(device, queue_profile)
+
+        except SystemExit, e:
+            result['status'] = 'failed'
+            result['error'] = 'exited with code {0}'.format(e.code)
+        except Exception, e:
+            result['status'] = 'failed'
+            result['error'] = "{0}".format(e)
+
+        return result
+
+    def to_bytes(self, size, total=None):
+        """ Convert sizes such as 4M, 512MiB, 8G or 4096 (bytes) to bytes, see to_bytes """
+
+        return to_bytes(size, total)
+
+    def device_size(self, device):
+        """ Return the size of a disk or partition in bytes, read from sysfs """
+
+        name = os.path.basename(self.backend.realpath(device))
+        return int(self.backend.read('/sys/class/block/{0}/size'.format(name))) * 512
+
+    def prewarm(self, devices, mode='read', chunk='4M', bandwidth=None, state=None, progress=None, workers=None, background=False):
+        """ Read (or write zeros to) whole devices, so every block is touched once
+            before production traffic pays the first access penalty, example:
+
+        prewarm(['/dev/xvdb2', '/dev/xvdc2'], bandwidth='200M', state='/var/lib/ephemeral_disk/prewarm.json')
+
+            All devices are done at the same time (one worker per device unless
+            workers is given) using direct I/O in chunk sized requests, which
+            bypass the page cache. bandwidth caps the throughput per second of
+            all devices together. 'read' mode is safe on mounted devices, while
+            'zero' mode refuses devices mounted, used as SWAP or part of a RAID
+            array or device mapper target (as well as their disk or partitions).
+
+            With state, how far each device got is saved in that file, so calling
+            prewarm again resumes from there rather than starting over. progress is
+            called with the device, bytes done and device size after every chunk,
+            and prewarm_status holds the latest figures of every device.
+
+            Returns the result for each device, e.g.
+            {'/dev/xvdb2': {'status': 'ok', 'bytes': 343597383680, 'elapsed': 812.3, 'error': None}}
+            With background set, a thread doing the work is returned instead, so
+            prewarm can carry on after mount_partition returns (see prewarm_status).
+            """
+
+        if isinstance(devices, basestring):
+            devices = [devices]
+
+        if mode not in ('read', 'zero'):
+            logging.error('Prewarm mode must be read or zero')
+            exit(2)
+
+        chunk = self.to_bytes(chunk)
+        if chunk <= 0 or chunk % mmap.PAGESIZE:
+            logging.error('Prewarm chunk must be a multiple of {0} bytes'.format(mmap.PAGESIZE))
+            exit(2)
+
+        saved = {}
+        if state is not None:
+            try:
+                saved = json.loads(self.backend.read(state))
+            except (IOError, ValueError):
+                saved = {}
+
+        shared = {'lock': threading.Lock(),
+                  'started': time.time(),
+                  'bytes': 0,
+                  'bandwidth': self.to_bytes(bandwidth) if bandwidth else None,
+                  'state': state,
+                  'saved': saved,
+                  'saved_at': time.time()}
+
+        jobs = [{'device': device, 'mode': mode, 'chunk': chunk, 'progress': progress, 'shared': shared} for device in devices]
+
+        def run():
+            logging.info('Prewarming {0} device(s) in {1} mode: {2}'.format(len(devices), mode, ', '.join(devices)))
+            results = self._map(self._prewarm_device, jobs, workers)
+            self._prewarm_save(shared, force=True)
+
+            failed = [result['device'] for result in results if result['status'] != 'ok']
+            if failed:
+                logging.error('Could not prewarm device(s): {0}'.format(', '.join(failed)))
+            else:
+                logging.info('All devices prewarmed successfully')
+
+            return dict((result.pop('device'), result) for result in results)
+
+        if background:
+            thread = threading.Thread(target=run, name='prewarm')
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        return run()
+
+    def _prewarm_device(self, job):
+        """ Prewarm a single device on behalf of prewarm """
+
+        device = job['device']
+        shared = job['shared']
+        result = {'device': device, 'status': 'ok', 'bytes': 0, 'elapsed': 0.0, 'error': None}
+        started = time.time()
+
+        try:
+            if job['mode'] == 'zero':
+                if not self.check_partition(device):
+                    logging.error('Partition {0} does not exist, please choose an existent one'.format(device))
+                    exit(2)
+
+                # mount_usage covers the disk of a partition and the partitions of a disk,
+                # RAID arrays or device mapper targets built on any of them included
+                usage = self.mount_usage(device)
+                if usage['mounts'] or usage['swaps'] or usage['holders']:
+                    logging.error('{0} is in use, zeros will not be written to it'.format(device))
+                    exit(2)
+
+            size = self.device_size(device)
+
+            # Resume where a previous run stopped, unless the device changed in between
+            offset = 0
+            with shared['lock']:
+                saved = shared['saved'].get(device)
+                if saved and saved.get('size') == size and saved.get('mode') == job['mode']:
+                    offset = saved.get('offset', 0)
+                    if offset:
+                        logging.info('Resuming prewarm of {0} from offset {1}'.format(device, offset))
+
+            with self.prewarm_lock:
+                self.prewarm_status[device] = {'status': 'running', 'bytes': offset, 'size': size, 'rate': 0.0}
+
+            # Direct I/O needs a buffer aligned to the block size, which an anonymous mmap is (page aligned).
+            # It is also filled with zeros, ready to be written in zero mode
+            data = mmap.mmap(-1, job['chunk'])
+            handle = self.backend.open_direct(device, job['mode'] == 'zero')
+            try:
+                handle.seek(offset)
+                while offset < size:
+                    length = min(job['chunk'], size - offset)
+                    if job['mode'] == 'zero':
+                        done = handle.write(buffer(data, 0, length) if length < job['chunk'] else data)
+                    else:
+                        done = handle.readinto(data)
+                    if not done:
+                        break
+
+                    offset += done
+                    result['bytes'] += done
+                    with shared['lock']:
+                        shared['saved'][device] = {'size': size, 'mode': job['mode'], 'offset': offset}
+                    self._prewarm_progress(job, offset, size, started)
+                    self._prewarm_save(shared)
+                    self._throttle(shared, done)
+            finally:
+                handle.close()
+                data.close()
+
+        except SystemExit, e:
+            result['status'] = 'failed'
+            result['error'] = 'exited with code {0}'.format(e.code)
+        except Exception, e:
+            result['status'] = 'failed'
+            result['error'] = "{0}".format(e)
+
+        result['elapsed'] = time.time() - started
+        with self.prewarm_lock:
+            self.prewarm_status.setdefault(device, {})['status'] = result['status']
+
+        return result
+
+    def _prewarm_progress(self, job, offset, size, started):
+        """ Update prewarm_status, log every 10% and call the progress function given to prewarm """
+
+        device = job['device']
+        elapsed = max(time.time() - started, 0.001)
+        with self.prewarm_lock:
+            status = self.prewarm_status.setdefault(device, {})
+            previous = status.get('bytes', 0)
+            status.update({'status': 'running', 'bytes': offset, 'size': size, 'rate': offset / elapsed})
+
+        if offset * 10 // size != previous * 10 // size:
+            logging.info('Prewarmed {0}% of {1}'.format(offset * 100 // size, device))
+
+        if job['progress'] is not None:
+            job['progress'](device, offset, size)
+
+    def _throttle(self, shared, done):
+        """ Sleep as long as needed to keep all workers together under the bandwidth given (see prewarm and hydrate) """
+
+        if shared['bandwidth'] is None:
+            return
+
+        with shared['lock']:
+            shared['bytes'] += done
+            delay = shared['started'] + float(shared['bytes']) / shared['bandwidth'] - time.time()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _prewarm_save(self, shared, force=False):
+        """ Save prewarm offsets to the state file, at most every 5 seconds unless forced """
+
+        if shared['state'] is None:
+            return
+
+        with shared['lock']:
+            if not force and time.time() - shared['saved_at'] < 5:
+                return
+            shared['saved_at'] = time.time()
+
+            try:
+                if not self.backend.isdir(os.path.dirname(shared['state'])):
+                    self.backend.makedirs(os.path.dirname(shared['state']))
+                self.backend.write(shared['state'], json.dumps(shared['saved']))
+            except (IOError, OSError), e:
+                logging.warning('Could not save prewarm state in {0}: {1}'.format(shared['state'], e))
+
+    def hydrate(self, source, mount_point='/mnt', workers=4, chunk='8M', bandwidth=None, progress=None,
+                marker='.hydrated', force=False, background=False):
+        """ Copy a seed directory or tar archive onto a file system just mounted,
+            so services start with warm caches rather than refilling them, example:
+
+        hydrate('/var/lib/seed/cache.tar', '/mnt', bandwidth='200M')
+
+            Files are copied by a pool of workers (biggest first) inside the kernel
+            using copy_file_range, or sendfile where it is not supported, falling back
+            to reads and writes. Members of an uncompressed tar archive are copied
+            straight from their offset in the archive, while compressed archives can
+            only be read in order, so they are streamed by a single worker. bandwidth
+            caps the throughput per second of all workers together.
+
+            mount_point must have a file system mounted. Symbolic links found there or
+            created by the seed are never followed, so members under a link (e.g. one
+            to /etc) fail rather than being written outside of mount_point.
+
+            Once every file is copied, marker is written in mount_point, so services
+            can wait for it and calling hydrate again does nothing unless force is set.
+            progress is called with mount_point, bytes done and bytes to copy (None
+            when streaming) after every chunk, and hydrate_status holds the latest
+            figures of every mount point.
+
+            Returns the result of the hydration, e.g.
+            {'status': 'ok', 'files': 1200, 'bytes': 8589934592, 'elapsed': 41.2, 'methods': {'copy_file_range': 1200},
+             'marker': '/mnt/.hydrated', 'errors': {}}
+            With background set, a thread doing the work is returned instead (see hydrate_status).
+        """
+
+        if not self.backend.isdir(mount_point):
+            logging.error('Mount point {0} does not exist, please mount a partition first'.format(mount_point))
+            exit(2)
+
+        # Seeding the directory a file system is about to be mounted on would copy to the root file system
+        mount_points = [mount['mountpoint'] for mounts in mount_state(self.backend).mounts.values() for mount in mounts]
+        if self.backend.realpath(mount_point) not in mount_points:
+            logging.error('{0} is not a mount point, please mount a partition first'.format(mount_point))
+            exit(2)
+
+        if not self.backend.isdir(source) and not self.backend.isfile(source):
+            logging.error('Seed {0} does not exist or is not a directory nor an archive'.format(source))
+            exit(2)
+
+        marker = os.path.join(mount_point, marker)
+        shared = {'lock': threading.Lock(),
+                  'started': time.time(),
+                  'bytes': 0,
+                  'bandwidth': self.to_bytes(bandwidth) if bandwidth else None,
+                  'mount_point': mount_point,
+                  'chunk': self.to_bytes(chunk),
+                  'progress': progress,
+                  'done': 0,
+                  'size': None}
+
+        def run():
+            result = {'status': 'ok', 'files': 0, 'bytes': 0, 'elapsed': 0.0, 'methods': {}, 'marker': None, 'errors': {}}
+            if self.backend.exists(marker):
+                if not force:
+                    logging.info('{0} was already hydrated, see {1}'.format(mount_point, marker))
+                    result.update({'status': 'skipped', 'marker': marker})
+                    return result
+                self.backend.remove(marker)
+
+            with self.hydrate_lock:
+                self.hydrate_status[mount_point] = {'status': 'running', 'files': 0, 'bytes': 0, 'size': None, 'rate': 0.0}
+
+            logging.info('Hydrating {0} from {1}'.format(mount_point, source))
+            try:
+                outcomes = self._hydrate_run(source, mount_point, shared, workers)
+            except Exception, e:
+                outcomes = [{'target': source, 'status': 'failed', 'bytes': 0, 'method': None, 'error': "{0}".format(e)}]
+
+            for outcome in outcomes:
+                if outcome['status'] == 'failed':
+                    result['status'] = 'failed'
+                    result['errors'][outcome['target']] = outcome['error']
+                elif outcome['method'] is not None:
+                    result['files'] += 1
+                    result['bytes'] += outcome['bytes']
+                    result['methods'][outcome['method']] = result['methods'].get(outcome['method'], 0) + 1
+            result['elapsed'] = time.time() - shared['started']
+
+            if result['status'] == 'ok':
+                # Only a complete copy is marked as ready
+                self.backend.write(marker, json.dumps({'source': source, 'files': result['files'], 'bytes': result['bytes'],
+                                                       'elapsed': result['elapsed'], 'hydrated': time.time()}))
+                result['marker'] = marker
+                logging.info('{0} hydrated with {1} file(s) in {2:.2f}s'.format(mount_point, result['files'], result['elapsed']))
+            else:
+                logging.error('Could not hydrate {0}, {1} file(s) failed'.format(mount_point, len(result['errors'])))
+
+            with self.hydrate_lock:
+                self.hydrate_status[mount_point]['status'] = result['status']
+
+            return result
+
+        if background:
+            thread = threading.Thread(target=run, name='hydrate')
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        return run()
+
+    def _hydrate_run(self, source, mount_point, shared, workers):
+        """ Copy the entries of a seed directory or archive on behalf of hydrate, returning their outcomes """
+
+        if self.backend.isdir(source):
+            return self._hydrate_entries(self._hydrate_tree(source, mount_point), shared, workers)
+
+        archive = self.backend.open(source)
+        try:
+            try:
+                members = tarfile.open(fileobj=archive, mode='r:').getmembers()
+            except tarfile.ReadError:
+                members = None
+
+            if members is not None:
+                return self._hydrate_entries([self._hydrate_member(source, member, mount_point) for member in members],
+                                             shared, workers)
+
+            # Compressed archives can only be read in order, so members are copied one after the other
+            archive.seek(0)
+            stream = tarfile.open(fileobj=archive, mode='r|*')
+            outcomes = []
+            links = []
+            for member in stream:
+                entry = self._hydrate_member(source, member, mount_point)
+                entry['shared'] = shared
+                if entry['kind'] == 'link':
+                    links.append(entry)
+                    continue
+                if entry['kind'] == 'file':
+                    entry['handle'] = stream.extractfile(member)
+                    outcomes.append(self._hydrate_entry({'kind': 'directory', 'target': os.path.dirname(entry['target']),
+                                                         'shared': shared}))
+                outcomes.append(self._hydrate_entry(entry))
+
+            return outcomes + [self._hydrate_entry(entry) for entry in links]
+        finally:
+            archive.close()
+
+    def _hydrate_entries(self, entries, shared, workers):
+        """ Create directories, copy files on a pool of workers and then create links """
+
+        for entry in entries:
+            entry['shared'] = shared
+
+        files = sorted([entry for entry in entries if entry['kind'] == 'file'], key=lambda entry: entry['length'], reverse=True)
+        shared['size'] = sum(entry['length'] for entry in files)
+        with self.hydrate_lock:
+            self.hydrate_status[shared['mount_point']]['size'] = shared['size']
+
+        # Parents missing from archives are created as well, so workers never race to create them
+        directories = set(entry['target'] for entry in entries if entry['kind'] == 'directory')
+        directories.update(os.path.dirname(entry['target']) for entry in entries if entry['kind'] in ('file', 'link'))
+        outcomes = [self._hydrate_entry({'kind': 'directory', 'target': directory, 'shared': shared})
+                    for directory in sorted(directories)]
+
+        if files:
+            outcomes += self._map(self._hydrate_entry, files, workers)
+
+        # Links go last, as they may point to files just copied
+        return outcomes + [self._hydrate_entry(entry) for entry in entries if entry['kind'] not in ('file', 'directory')]
+
+    def _hydrate_tree(self, source, mount_point):
+        """ Return the entries to copy from a seed directory """
+
+        entries = []
+        for directory, dirnames, filenames in self.backend.walk(source):
+            target = os.path.normpath(os.path.join(mount_point, os.path.relpath(directory, source)))
+            entries.append({'kind': 'directory', 'target': target})
+
+            for name in sorted(dirnames + filenames):
+                path = os.path.join(directory, name)
+                entry = {'target': os.path.join(target, name), 'source': path}
+                if self.backend.islink(path):
+                    entry.update({'kind': 'link', 'link': self.backend.readlink(path)})
+                elif self.backend.isfile(path):
+                    entry.update({'kind': 'file', 'offset': 0, 'length': self.backend.getsize(path),
+                                  'mode': self.backend.file_mode(path)})
+                elif name in filenames:
+                    entry.update({'kind': 'other', 'error': 'not a regular file, directory or symbolic link'})
+                else:
+                    # Directories are listed by walk on their own
+                    continue
+                entries.append(entry)
+
+        return entries
+
+    def _hydrate_member(self, source, member, mount_point):
+        """ Return the entry to copy for a member of a seed archive """
+
+        root = os.path.normpath(mount_point)
+        target = os.path.normpath(os.path.join(root, member.name))
+        entry = {'target': target, 'source': '{0}:{1}'.format(source, member.name)}
+
+        if not target.startswith(root.rstrip('/') + '/') and not (target == root and member.isdir()):
+            entry.update({'kind': 'unsafe', 'error': 'member is outside of {0}'.format(mount_point)})
+        elif member.isdir():
+            entry['kind'] = 'directory'
+        elif member.issym():
+            entry.update({'kind': 'link', 'link': member.linkname})
+        elif member.isfile() and not member.issparse():
+            entry.update({'kind': 'file', 'source': source, 'offset': member.offset_data, 'length': member.size,
+                          'mode': member.mode & 07777})
+        else:
+            entry.update({'kind': 'other', 'error': 'hard links, sparse and special files are not supported'})
+
+        return entry
+
+    def _hydrate_entry(self, job):
+        """ Create a directory or link, or copy a file, on behalf of hydrate """
+
+        target = job['target']
+        result = {'target': target, 'status': 'ok', 'bytes': 0, 'method': None, 'error': None}
+
+        try:
+            # Links created by a seed (e.g. to /etc) are never followed, so nothing lands outside mount_point
+            if job['kind'] in ('directory', 'link', 'file'):
+                link = self._hydrate_link(job['shared']['mount_point'], target, job['kind'] != 'link')
+                if link is not None:
+                    job.update({'kind': 'unsafe', 'source': job.get('source', target),
+                                'error': '{0} is a symbolic link, it is not followed'.format(link)})
+
+            if job['kind'] == 'directory':
+                if not self.backend.isdir(target):
+                    self.backend.makedirs(target)
+            elif job['kind'] == 'link':
+                if self.backend.islink(target):
+                    self.backend.remove(target)
+                self.backend.symlink(job['link'], target)
+            elif job['kind'] == 'file':
+                shared = job['shared']
+
+                def copied(done):
+                    self._hydrate_progress(shared, done)
+                    self._throttle(shared, done)
+
+                if 'handle' in job:
+                    result['method'] = self.backend.copy_stream(job['handle'], target, job['length'], job['mode'],
+                                                                shared['chunk'], copied)
+                else:
+                    result['method'] = self.backend.copy_range(job['source'], target, job['offset'], job['length'],
+                                                               job['mode'], shared['chunk'], copied)
+                result['bytes'] = job['length']
+                with self.hydrate_lock:
+                    self.hydrate_status[shared['mount_point']]['files'] += 1
+            elif job['kind'] == 'unsafe':
+                logging.error('Not copying {0}: {1}'.format(job['source'], job['error']))
+                result.update({'status': 'failed', 'error': job['error']})
+            else:
+                logging.warning('Skipping {0}: {1}'.format(job['source'], job['error']))
+                result.update({'status': 'skipped', 'error': job['error']})
+
+        except Exception, e:
+            result['status'] = 'failed'
+            result['error'] = "{0}".format(e)
+
+        return result
+
+    def _hydrate_link(self, mount_point, target, last=True):
+        """ Return the first symbolic link found between mount_point and target
+            (target itself included if last is set), or None """
+
+        path = os.path.normpath(mount_point)
+        relative = os.path.relpath(target, path)
+        parts = [] if relative == '.' else relative.split('/')
+        for index, part in enumerate(parts):
+            path = os.path.join(path, part)
+            if (index < len(parts) - 1 or last) and self.backend.islink(path):
+                return path
+
+        return None
+
+    def _hydrate_progress(self, shared, done):
+        """ Update hydrate_status, log every 10% and call the progress function given to hydrate """
+
+        mount_point = shared['mount_point']
+        with shared['lock']:
+            previous = shared['done']
+            shared['done'] += done
+            offset, size = shared['done'], shared['size']
+
+        elapsed = max(time.time() - shared['started'], 0.001)
+        with self.hydrate_lock:
+            self.hydrate_status[mount_point].update({'bytes': offset, 'size': size, 'rate': offset / elapsed})
+
+        if size and offset * 10 // size != previous * 10 // size:
+            logging.info('Hydrated {0}% of {1}'.format(offset * 100 // size, mount_point))
+
+        if shared['progress'] is not None:
+            shared['progress'](mount_point, offset, size)
@@ -0,0 +1,1116 @@
+#-------------------------------------------------------------------------------
+# Name:        Ephemeral Python tests
+# Purpose:     Check provisioning against simulated disks and metadata_client
+#              against a local stand-in for the metadata service
+#
+# Usage:       python -m unittest test_ephemeral_disk
+#
+#              Neither root nor real disks are needed (see
+#              ephemeral_disk.simulated_backend).
+#-------------------------------------------------------------------------------
+
+import os
+import json
+import shutil
+import logging
+import tarfile
+import tempfile
+import threading
+import unittest
+import StringIO
+import SocketServer
+import BaseHTTPServer
+
+import ephemeral_disk
+
+
+class simulated_test(unittest.TestCase):
+    """ Two 335G instance store disks in a simulated_backend, with force set """
+
+    disks = {'xvdb': '335G', 'xvdc': '335G'}
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.backend = ephemeral_disk.simulated_backend(self.disks)
+        self.tools = ephemeral_disk.tools(force=1, backend=self.backend)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def fail_command(self, name, code=1):
+        """ Make every run of a command exit with code """
+
+        execute = self.backend.execute
+        self.backend.execute = lambda argv, input=None: (code, '', 'failed') if argv[0] == name else execute(argv, input)
+
+
+class backend_test(simulated_test):
+
+    def test_to_bytes(self):
+        self.assertEqual(ephemeral_disk.to_bytes('8G'), 8 * 1024 ** 3)
+        self.assertEqual(ephemeral_disk.to_bytes('512MiB'), 512 * 1024 ** 2)
+        self.assertEqual(ephemeral_disk.to_bytes(4096), 4096)
+        self.assertEqual(ephemeral_disk.to_bytes('25%', 1024 ** 3), 256 * 1024 ** 2)
+        self.assertRaises(ValueError, ephemeral_disk.to_bytes, '25%')
+        self.assertRaises(ValueError, ephemeral_disk.to_bytes, '8X')
+
+        # Both share the same conversion
+        self.assertEqual(self.tools.to_bytes('1T'), ephemeral_disk.to_bytes('1T'))
+        self.assertEqual(self.backend.devices['xvdb']['size'], ephemeral_disk.to_bytes('335G'))
+
+    def test_commands(self):
+        self.assertEqual(self.backend.execute(['pvcreate', '/dev/xvdb'])[0], 127)
+        self.assertEqual(self.tools.run(['mkswap', '/dev/xvdb'], 'mkswap', '/dev/xvdb'), 0)
+        self.assertEqual(self.backend.commands, 2)
+        self.assertEqual(self.tools.probe_fs_type('/dev/xvdb'), 'swap')
+
+        # Devices in use are busy, as with the kernel
+        self.tools.run(['swapon', '/dev/xvdb'], 'swapon', '/dev/xvdb')
+        self.assertEqual(self.backend.execute(['mkfs.ext4', '/dev/xvdb'])[0], 1)
+
+    def test_sysfs(self):
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+        self.assertEqual(self.backend.read('/sys/block/xvdb/xvdb1/partition'), '1\n')
+        self.assertEqual(self.tools.device_size('/dev/xvdb1'), 8 * 1024 ** 3)
+        self.assertEqual(self.tools.sysfs_queue('/dev/xvdb2'), '/sys/block/xvdb/queue')
+        self.assertEqual(self.tools.inventory.partitions('/dev/xvdb'), ['xvdb1', 'xvdb2'])
+
+
+class discovery_test(simulated_test):
+
+    def test_volumes_are_skipped(self):
+        backend = ephemeral_disk.simulated_backend({'xvdb': '335G'}, volumes={'xvdf': '100G'})
+        self.assertEqual(ephemeral_disk.tools(backend=backend).discover_disks(), ['/dev/xvdb'])
+
+        # Without the block device mapping only NVMe instance store is trusted
+        backend.metadata_values = {}
+        self.assertEqual(ephemeral_disk.tools(backend=backend).discover_disks(), [])
+
+    def test_nvme_model(self):
+        backend = ephemeral_disk.simulated_backend({'nvme1n1': '1900G'}, volumes={'nvme2n1': '100G'})
+        backend.metadata_values = {}
+        self.assertEqual(ephemeral_disk.tools(backend=backend).discover_disks(), ['/dev/nvme1n1'])
+
+    def test_mounted_disk_needs_force(self):
+        # A freshly launched instance has its first ephemeral disk formatted and mounted in /mnt
+        self.backend.devices['xvdb']['fs'] = 'ext4'
+        self.backend.mounts['/mnt'] = {'device': 'xvdb', 'options': 'rw'}
+
+        self.assertEqual(ephemeral_disk.tools(backend=self.backend).discover_disks(), ['/dev/xvdc'])
+        self.assertEqual(self.tools.discover_disks(), ['/dev/xvdb', '/dev/xvdc'])
+
+        results = self.tools.provision_disks(swap_size='8G', idempotent=True)
+        self.assertEqual([results[disk]['status'] for disk in sorted(results)], ['ok', 'ok'])
+        self.assertEqual(self.backend.mounts['/mnt']['device'], 'xvdb2')
+
+    def test_foreign_holders_are_skipped(self):
+        backend = ephemeral_disk.simulated_backend(self.disks, volumes={'xvdf': '100G'})
+        tools = ephemeral_disk.tools(force=1, backend=backend)
+        tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+        tools.create_cache('/dev/xvdf', '/dev/xvdb2')
+
+        self.assertEqual(tools.discover_disks(), ['/dev/xvdc'])
+
+    def test_ephemeral_arrays_are_kept(self):
+        self.assertEqual(self.tools.provision_raid0(swap_size='8G')['status'], 'ok')
+        self.assertEqual(self.tools.discover_disks(), ['/dev/xvdb', '/dev/xvdc'])
+        self.assertEqual(self.tools.provision_raid0(swap_size='8G')['status'], 'ok')
+
+
+class partition_test(simulated_test):
+
+    def test_single_transaction(self):
+        self.assertEqual(self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')]),
+                         ['/dev/xvdb1', '/dev/xvdb2'])
+        self.assertEqual([span['step'] for span in self.tools.spans], ['sfdisk', 'partprobe'])
+        self.assertEqual(self.tools.device_size('/dev/xvdb1'), 8 * 1024 ** 3)
+
+    def test_existing_partitions_need_force(self):
+        self.tools.write_partition_table('/dev/xvdb', [(None, 'linux')])
+        tools = ephemeral_disk.tools(backend=self.backend)
+
+        self.assertRaises(SystemExit, tools.write_partition_table, '/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+        self.assertEqual(self.backend.partitions('xvdb'), [(1, 'xvdb1')])
+
+    def test_failing_sfdisk_keeps_nothing(self):
+        self.tools.write_partition_table('/dev/xvdb', [('50%', 'linux'), (None, 'linux')])
+        self.fail_command('sfdisk')
+        result = self.tools.provision_disks(disks=['/dev/xvdb'], swap_size='8G')['/dev/xvdb']
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertTrue(result['error'].startswith('partition:'))
+        self.assertEqual(self.backend.swaps, {})
+
+    def test_table_not_applied(self):
+        # sfdisk succeeds, but the kernel keeps the old table
+        self.tools.write_partition_table('/dev/xvdb', [('50%', 'linux'), (None, 'linux')])
+        self.fail_command('sfdisk', 0)
+
+        self.assertRaises(SystemExit, self.tools.write_partition_table, '/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+    def test_percentage(self):
+        size = self.tools.device_size('/dev/xvdb')
+        layout = self.tools.partition_layout('/dev/xvdb', [('25%', 'linux'), (None, 'linux')])
+
+        self.assertEqual(layout[0], (1024 ** 2, (size - 1024 ** 2) // 4 // 1024 ** 2 * 1024 ** 2, 'linux'))
+        self.assertEqual(layout[1][0] + layout[1][1], size)
+
+    def test_space_left_only_last(self):
+        self.assertRaises(SystemExit, self.tools.partition_layout, '/dev/xvdb', [(None, 'linux'), ('8G', 'swap')])
+        self.assertRaises(SystemExit, self.tools.partition_layout, '/dev/xvdb', [('400G', 'linux')])
+
+    def test_alignment(self):
+        # RAID stripe width of 768KiB does not divide 1MiB
+        self.backend.devices['xvdb']['queue']['optimal_io_size'] = '786432'
+        self.assertEqual(self.tools.partition_alignment('/dev/xvdb'), 3 * 1024 ** 2)
+
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), ('10%', 'linux'), (None, 'linux')])
+        for number, name in self.backend.partitions('xvdb'):
+            self.assertEqual(self.backend.devices[name]['start'] % (3 * 1024 ** 2), 0)
+
+    def test_label(self):
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+        self.assertEqual(self.backend.devices['xvdb']['label'], 'dos')
+
+        # Large disks get GPT, which also takes more than 4 partitions
+        backend = ephemeral_disk.simulated_backend({'xvdb': '3T'})
+        tools = ephemeral_disk.tools(force=1, backend=backend)
+        self.assertEqual(len(tools.write_partition_table('/dev/xvdb', [('1T', 'linux'), ('1T', 'linux'), (None, 'linux')])), 3)
+        self.assertEqual(backend.devices['xvdb']['label'], 'gpt')
+
+        layout = [('8G', 'linux')] * 4 + [(None, 'linux')]
+        self.assertRaises(SystemExit, self.tools.write_partition_table, '/dev/xvdb', layout)
+        self.assertEqual(len(self.tools.write_partition_table('/dev/xvdb', layout, 'gpt')), 5)
+
+
+class raid_test(simulated_test):
+
+    def test_provision_raid0(self):
+        result = self.tools.provision_raid0(swap_size='8G', fs_type='xfs', chunk=256)
+
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(sorted(result['disks']), ['/dev/xvdb', '/dev/xvdc'])
+        self.assertEqual(self.backend.devices['md0']['members'], ['xvdb2', 'xvdc2'])
+        self.assertEqual(self.backend.devices['md0']['queue']['optimal_io_size'], str(2 * 256 * 1024))
+        self.assertEqual(self.backend.devices['md0']['fs'], 'xfs')
+        self.assertEqual(self.backend.mounts['/mnt']['device'], 'md0')
+        self.assertEqual(self.backend.swaps, {'xvdb1': 10, 'xvdc1': 10})
+
+    def test_single_disk_is_not_striped(self):
+        result = self.tools.provision_raid0(disks=['/dev/xvdb'], swap_size='8G')
+
+        self.assertEqual(result['md_device'], None)
+        self.assertEqual(result['disks']['/dev/xvdb']['status'], 'ok')
+        self.assertEqual(self.backend.mounts['/mnt']['device'], 'xvdb2')
+
+    def test_raid_members_are_in_use(self):
+        self.assertEqual(self.tools.provision_raid0(swap_size='8G', fs_type='xfs')['status'], 'ok')
+
+        self.assertTrue(self.tools.check_mount_point('/dev/xvdb2'))
+        self.assertRaises(SystemExit, self.tools.format_partition, '/dev/xvdb2', 'ext4')
+        self.assertEqual(self.tools.prewarm(['/dev/xvdb2'], mode='zero')['/dev/xvdb2']['status'], 'failed')
+        self.assertEqual(self.backend.devices['xvdb2']['fs'], 'linux_raid_member')
+
+    def test_stop_raid(self):
+        self.tools.provision_raid0(swap_size='8G')
+        self.tools.stop_raid('/dev/md0')
+
+        self.assertNotIn('md0', self.backend.devices)
+        self.assertNotIn('/mnt', self.backend.mounts)
+        self.assertFalse(self.tools.check_mount_point('/dev/xvdb2'))
+
+    def test_invalid_chunk(self):
+        self.tools.write_partition_table('/dev/xvdb', [(None, 'raid')])
+        self.tools.write_partition_table('/dev/xvdc', [(None, 'raid')])
+
+        self.assertRaises(SystemExit, self.tools.create_raid0, ['/dev/xvdb1', '/dev/xvdc1'], '/dev/md0', 100)
+        self.assertNotIn('md0', self.backend.devices)
+
+
+class format_test(simulated_test):
+
+    def test_profiles(self):
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+        self.assertEqual(self.tools.format_options('/dev/xvdb2', 'ext4', 'default'), '-F')
+        self.assertEqual(self.tools.format_options('/dev/xvdb2', 'ext4', 'fast-boot'),
+                         '-E lazy_itable_init=1,lazy_journal_init=1,nodiscard -F')
+        self.assertEqual(self.tools.format_options('/dev/xvdb2', 'xfs', 'fast-boot'), '-K -f')
+
+        # Without stripe geometry, throughput only gets the larger journal
+        self.assertEqual(self.tools.format_options('/dev/xvdb2', 'xfs', 'throughput'), '-l size=512m -f')
+
+    def test_stripe_geometry(self):
+        self.tools.provision_raid0(swap_size='8G', fs_type='xfs', chunk=256)
+
+        self.assertEqual(self.tools.format_options('/dev/md0', 'xfs', 'throughput'), '-l size=512m -f -d su=256k,sw=2')
+        self.assertEqual(self.tools.format_options('/dev/md0', 'ext4', 'throughput'),
+                         '-J size=1024 -F -E stride=64,stripe_width=128')
+        self.assertIn('mkfs.xfs -q -l size=512m -f -d su=256k,sw=2 /dev/md0', [span['command'] for span in self.tools.spans])
+
+    def test_format_partition(self):
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+        self.assertTrue(self.tools.format_partition('/dev/xvdb2', 'ext4', 'fast-boot') >= 0)
+        self.assertEqual(self.tools.probe_fs_type('/dev/xvdb2'), 'ext4')
+        self.assertRaises(SystemExit, self.tools.format_partition, '/dev/xvdb2', 'btrfs')
+        self.assertRaises(SystemExit, self.tools.format_partition, '/dev/xvdb2', 'ext4', 'unknown')
+
+    def test_failing_format_is_reported(self):
+        self.fail_command('mkfs.ext4')
+        result = self.tools.provision_disks(disks=['/dev/xvdb'], swap_size='8G')['/dev/xvdb']
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertTrue(result['error'].startswith('format:'))
+        self.assertEqual(result['format_time'], None)
+
+        # SWAP does not depend on the data partition, while the mount is skipped
+        self.assertEqual(self.backend.swaps, {'xvdb1': 10})
+        self.assertNotIn('/mnt', self.backend.mounts)
+
+
+class mount_test(simulated_test):
+
+    def setUp(self):
+        simulated_test.setUp(self)
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+    def test_profiles(self):
+        self.tools.format_partition('/dev/xvdb2', 'ext4')
+
+        self.assertEqual(self.tools.mount_partition('/dev/xvdb2', '/mnt', 'scratch', commit=60, discard='online'),
+                         'noatime,nodiratime,data=writeback,barrier=0,commit=60,discard')
+        self.assertEqual(self.backend.mounts['/mnt']['options'], 'noatime,nodiratime,data=writeback,barrier=0,commit=60,discard')
+
+    def test_options_are_checked_against_the_file_system(self):
+        self.tools.format_partition('/dev/xvdb2', 'xfs')
+
+        self.assertEqual(self.tools.mount_options('/dev/xvdb2', 'scratch'), 'noatime,nodiratime,logbufs=8,logbsize=256k')
+        self.assertRaises(SystemExit, self.tools.mount_options, '/dev/xvdb2', commit=60)
+        self.assertRaises(SystemExit, self.tools.mount_options, '/dev/xvdb2', discard='sometimes')
+        self.assertRaises(SystemExit, self.tools.mount_options, '/dev/xvdb2', 'unknown')
+
+    def test_other_file_systems_are_mounted_with_defaults(self):
+        # btrfs is not probed, mount finds it out by itself
+        self.backend.devices['xvdb2']['fs'] = 'btrfs'
+
+        self.assertEqual(self.tools.mount_partition('/dev/xvdb2', '/mnt'), 'defaults')
+        self.assertEqual(self.backend.mounts['/mnt']['device'], 'xvdb2')
+        self.assertRaises(SystemExit, self.tools.mount_options, '/dev/xvdb2', 'scratch')
+
+    def test_swap_is_not_mounted(self):
+        self.tools.enable_swap('/dev/xvdb1')
+        self.backend.swaps.clear()
+
+        self.assertRaises(SystemExit, self.tools.mount_partition, '/dev/xvdb1', '/mnt')
+        self.assertNotIn('/mnt', self.backend.mounts)
+
+
+class queue_test(simulated_test):
+
+    def test_changes(self):
+        self.assertEqual(self.tools.queue_changes('/dev/xvdb', 'streaming'), [('read_ahead_kb', '4096'), ('nr_requests', '1024')])
+        self.assertEqual(self.tools.queue_changes('/dev/xvdb', 'scratch'), [('scheduler', 'none'), ('nr_requests', '1024')])
+        self.assertEqual(self.tools.queue_changes('/dev/xvdb', 'default'), [])
+
+    def test_tune_and_restore(self):
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+        # Partitions share the queue of their disk
+        self.assertEqual(self.tools.tune_queue('/dev/xvdb2', 'scratch'), {'scheduler': 'mq-deadline', 'nr_requests': '64'})
+        self.assertEqual(self.backend.devices['xvdb']['queue']['scheduler'], 'mq-deadline kyber [none]')
+
+        # Only values from before the first change are kept
+        self.assertEqual(self.tools.tune_queue('/dev/xvdb', 'streaming'), {'scheduler': 'none', 'read_ahead_kb': '128'})
+        self.assertEqual(self.tools.queue_defaults, {'xvdb': {'scheduler': 'mq-deadline', 'nr_requests': '64', 'read_ahead_kb': '128'}})
+        self.assertEqual(self.tools.queue_changes('/dev/xvdb', 'streaming'), [])
+
+        self.assertEqual(self.tools.restore_queue(), {'xvdb': {'scheduler': 'mq-deadline', 'nr_requests': '64', 'read_ahead_kb': '128'}})
+        self.assertEqual(self.tools.queue_settings('/dev/xvdb'), {'scheduler': 'mq-deadline', 'read_ahead_kb': '128', 'nr_requests': '64',
+                                                                   'rotational': '0', 'add_random': '0'})
+        self.assertEqual(self.tools.queue_defaults, {})
+
+    def test_restore_saved_defaults(self):
+        self.tools.tune_queue('/dev/xvdc', 'streaming')
+        defaults = json.loads(json.dumps(self.tools.queue_defaults))
+
+        tools = ephemeral_disk.tools(backend=self.backend)
+        self.assertEqual(tools.restore_queue(['/dev/xvdc'], defaults), {'xvdc': {'read_ahead_kb': '128', 'nr_requests': '64'}})
+        self.assertEqual(self.backend.devices['xvdc']['queue']['read_ahead_kb'], '128')
+
+    def test_md_has_no_nr_requests(self):
+        self.tools.provision_raid0(swap_size='8G', fs_type='xfs', chunk=256)
+
+        self.assertEqual(self.tools.tune_queue('/dev/md0', 'streaming'), {'read_ahead_kb': '128'})
+        self.assertEqual(self.backend.devices['md0']['queue']['nr_requests'], '64')
+
+    def test_unknown_profile(self):
+        self.assertRaises(SystemExit, self.tools.tune_queue, '/dev/xvdb', 'fastest')
+
+
+class swap_test(simulated_test):
+
+    def setUp(self):
+        simulated_test.setUp(self)
+        for disk in ('/dev/xvdb', '/dev/xvdc'):
+            self.tools.write_partition_table(disk, [('8G', 'swap'), (None, 'linux')])
+
+    def test_striped_swap(self):
+        self.tools.enable_striped_swap(['/dev/xvdb1', '/dev/xvdc1'], priority=10)
+        self.assertEqual(self.backend.swaps, {'xvdb1': 10, 'xvdc1': 10})
+
+    def test_striped_swap_failure(self):
+        self.fail_command('mkswap')
+
+        self.assertRaises(SystemExit, self.tools.enable_striped_swap, ['/dev/xvdb1', '/dev/xvdc1'])
+        self.assertEqual(self.backend.swaps, {})
+
+    def test_zram_swap(self):
+        self.tools.enable_striped_swap(['/dev/xvdb1', '/dev/xvdc1'])
+
+        self.assertEqual(self.tools.enable_zram_swap('2G'), '/dev/zram0')
+        self.assertEqual(self.backend.devices['zram0']['size'], 2 * 1024 ** 3)
+        self.assertEqual(self.backend.swaps['zram0'], 100)
+
+        self.tools.disable_swap('/dev/zram0')
+        self.assertNotIn('zram0', self.backend.swaps)
+        self.assertEqual(self.backend.devices['zram0']['size'], 0)
+
+    def test_failing_swapoff_keeps_zram(self):
+        self.tools.enable_zram_swap('4G')
+        # Pages swapped out do not fit in memory, so swapoff fails with ENOMEM
+        self.backend.swap_used['zram0'] = 4 * 1024 ** 3
+
+        self.assertRaises(SystemExit, self.tools.disable_swap, '/dev/zram0')
+        self.assertEqual(self.backend.swaps['zram0'], 100)
+        self.assertEqual(self.backend.devices['zram0']['size'], 4 * 1024 ** 3)
+
+    def test_failing_mkswap_is_reported(self):
+        self.fail_command('mkswap')
+        result = self.tools.provision_disks(disks=['/dev/xvdb'], swap_size='8G')['/dev/xvdb']
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertTrue(result['error'].startswith('mkswap:'))
+        self.assertEqual(self.backend.swaps, {})
+
+
+class swap_monitor_test(simulated_test):
+
+    def setUp(self):
+        simulated_test.setUp(self)
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+        self.tools.enable_swap('/dev/xvdb1', 10)
+        self.tools.format_partition('/dev/xvdb2', 'ext4')
+        self.backend.makedirs('/mnt')
+        self.tools.mount_partition('/dev/xvdb2', '/mnt')
+
+    def monitor(self, **options):
+        options.setdefault('cooldown', 0)
+        options.setdefault('hold', 0)
+        return ephemeral_disk.swap_monitor(self.tools, '/mnt/swap', '1G', max_files=2, **options)
+
+    def test_grow_and_shrink(self):
+        monitor = self.monitor()
+        self.assertEqual(monitor.check(), None)
+
+        # 7G of the 8G partition in use
+        self.backend.swap_used['xvdb1'] = 7 * 1024 ** 3
+        self.assertEqual(monitor.check()['file'], '/mnt/swap/swapfile0')
+        self.assertEqual(self.backend.swaps['/mnt/swap/swapfile0'], 1)
+        self.assertEqual(monitor.check()['file'], '/mnt/swap/swapfile1')
+        self.assertEqual(monitor.check(), None)
+
+        # Newest files go first once pressure is gone
+        self.backend.swap_used['xvdb1'] = 1024 ** 3
+        self.assertEqual(monitor.check()['file'], '/mnt/swap/swapfile1')
+        self.assertNotIn('/mnt/swap/swapfile1', self.backend.swaps)
+        self.assertNotIn('/mnt/swap/swapfile1', self.backend.files)
+        self.assertEqual(monitor.check()['file'], '/mnt/swap/swapfile0')
+        self.assertEqual(monitor.files, [])
+        self.assertEqual([decision['action'] for decision in monitor.decisions], ['grow', 'grow', 'shrink', 'shrink'])
+
+    def test_cooldown_and_hold(self):
+        monitor = self.monitor(cooldown=30, hold=300)
+
+        self.backend.swap_used['xvdb1'] = 7 * 1024 ** 3
+        self.assertEqual(monitor.check()['action'], 'grow')
+        self.assertEqual(monitor.check(), None)
+
+        self.backend.swap_used['xvdb1'] = 0
+        self.assertEqual(monitor.check(), None)
+        self.assertEqual(monitor.files, ['/mnt/swap/swapfile0'])
+
+    def test_memory_pressure_without_swap(self):
+        self.tools.disable_swap('/dev/xvdb1')
+        monitor = self.monitor()
+        self.assertEqual(monitor.check(), None)
+
+        self.backend.memory['MemAvailable'] = 100 * 1024 ** 2
+        self.assertEqual(monitor.check()['action'], 'grow')
+
+    def test_files_left_are_taken_over(self):
+        self.backend.swap_used['xvdb1'] = 7 * 1024 ** 3
+        self.monitor().check()
+
+        self.backend.swap_used['xvdb1'] = 0
+        monitor = self.monitor()
+        self.assertEqual(monitor.check()['file'], '/mnt/swap/swapfile0')
+        self.assertEqual(self.backend.swaps, {'xvdb1': 10})
+
+    def test_failing_grow_leaves_nothing(self):
+        monitor = self.monitor()
+        self.backend.swap_used['xvdb1'] = 7 * 1024 ** 3
+        self.fail_command('mkswap')
+
+        decision = monitor.check()
+        self.assertEqual((decision['status'], decision['error']), ('failed', 'Could not format /mnt/swap/swapfile0 as SWAP'))
+        self.assertEqual(monitor.files, [])
+        self.assertNotIn('/mnt/swap/swapfile0', self.backend.files)
+
+    def test_failing_shrink_keeps_the_file(self):
+        monitor = self.monitor()
+        self.backend.swap_used['xvdb1'] = 7 * 1024 ** 3
+        monitor.check()
+
+        self.backend.swap_used['xvdb1'] = 0
+        self.fail_command('swapoff')
+        self.assertEqual(monitor.check()['status'], 'failed')
+        self.assertEqual(monitor.files, ['/mnt/swap/swapfile0'])
+        self.assertIn('/mnt/swap/swapfile0', self.backend.swaps)
+
+
+class uevent_test(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.mkdtemp()
+        self.watcher = ephemeral_disk.uevent_watcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.directory)
+        logging.disable(logging.NOTSET)
+
+    def test_nodes_showing_up(self):
+        nodes = [os.path.join(self.directory, name) for name in ('xvdb1', 'xvdb2')]
+        timer = threading.Timer(0.1, lambda: [open(node, 'w').close() for node in nodes])
+        timer.start()
+        try:
+            self.assertTrue(self.watcher.wait(nodes, 0.5))
+        finally:
+            timer.join()
+
+    def test_timeout(self):
+        started = ephemeral_disk.time.time()
+        self.assertFalse(self.watcher.wait([os.path.join(self.directory, 'xvdb1')], 0.2))
+        self.assertTrue(ephemeral_disk.time.time() - started < 2)
+
+    def test_partitions_not_showing_up(self):
+        backend = ephemeral_disk.simulated_backend()
+        backend.wait = lambda nodes, timeout=10: False
+        tools = ephemeral_disk.tools(force=1, backend=backend, device_timeout=0)
+
+        self.assertRaises(SystemExit, tools.write_partition_table, '/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+
+
+class plan_test(simulated_test):
+
+    def test_plan_is_empty_once_applied(self):
+        steps = self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt')
+        self.assertEqual([step['step'] for step in steps], ['partition', 'mkswap', 'format', 'mount'])
+
+        self.tools.apply_plan(steps)
+        self.assertEqual(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt'), [])
+
+    def test_plan_after_reboot(self):
+        self.tools.apply_plan(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt'))
+        commands = self.backend.commands
+
+        # A reboot keeps partitions and file systems, but not mounts nor SWAP
+        del self.backend.mounts['/mnt']
+        self.backend.swaps.clear()
+
+        steps = self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt')
+        self.assertEqual([step['step'] for step in steps], ['swapon', 'mount'])
+
+        self.tools.apply_plan(steps)
+        self.assertEqual(self.backend.commands - commands, 2)
+        self.assertEqual(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt'), [])
+
+    def test_everything_without_compare(self):
+        self.tools.apply_plan(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt'))
+
+        steps = self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt', compare=False)
+        self.assertEqual([step['step'] for step in steps], ['partition', 'mkswap', 'format', 'mount'])
+
+    def test_other_file_system_is_formatted(self):
+        self.tools.apply_plan(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt'))
+
+        steps = self.tools.plan_disk('/dev/xvdb', '8G', 'xfs', '/mnt')
+        self.assertEqual([step['step'] for step in steps], ['format', 'mount'])
+
+    def test_other_layout_is_partitioned(self):
+        self.tools.apply_plan(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt'))
+
+        steps = self.tools.plan_disk('/dev/xvdb', '4G', 'ext4', '/mnt')
+        self.assertEqual([step['step'] for step in steps], ['partition', 'mkswap', 'format', 'mount'])
+
+    def test_idempotent_provisioning(self):
+        self.tools.provision_disks(swap_size='8G', idempotent=True)
+        commands = self.backend.commands
+
+        results = self.tools.provision_disks(disks=['/dev/xvdb', '/dev/xvdc'], swap_size='8G', idempotent=True)
+        self.assertEqual([results[disk]['steps'] for disk in sorted(results)], [[], []])
+        self.assertEqual([results[disk]['status'] for disk in sorted(results)], ['ok', 'ok'])
+        self.assertEqual(self.backend.commands, commands)
+
+
+class provisioning_test(simulated_test):
+
+    def test_provision_disks(self):
+        results = self.tools.provision_disks(swap_size='8G', fs_type='ext4', mount_point='/mnt')
+
+        self.assertEqual(sorted(results), ['/dev/xvdb', '/dev/xvdc'])
+        self.assertEqual([result['status'] for result in results.values()], ['ok', 'ok'])
+        self.assertEqual(self.backend.mounts['/mnt']['device'], 'xvdb2')
+        self.assertEqual(self.backend.mounts['/mnt1']['device'], 'xvdc2')
+        self.assertEqual(self.backend.swaps, {'xvdb1': 10, 'xvdc1': 10})
+
+    def test_data_partition_takes_the_space_left(self):
+        self.assertEqual(self.tools.ephemeral_size('/dev/xvdb', '8G'), '326G')
+        self.assertEqual(self.tools.data_size('/dev/xvdb', '8G'), None)
+        self.tools.apply_plan(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt'))
+
+        swap, data = [self.tools.device_size(partition) for partition in ('/dev/xvdb1', '/dev/xvdb2')]
+        self.assertEqual(swap, 8 * 1024 ** 3)
+        self.assertEqual(self.tools.device_size('/dev/xvdb') - 1024 ** 2 - swap, data)
+
+    def test_earlier_data_partition_is_kept(self):
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), ('326G', 'linux')])
+        self.tools.enable_swap('/dev/xvdb1')
+        self.tools.format_partition('/dev/xvdb2', 'ext4')
+
+        self.assertEqual([step['step'] for step in self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt')], ['mount'])
+
+    def test_one_failing_disk_does_not_stop_others(self):
+        results = self.tools.provision_disks(disks=['/dev/xvdb', '/dev/xvdz'], swap_size='8G')
+
+        self.assertEqual(results['/dev/xvdb']['status'], 'ok')
+        self.assertEqual(results['/dev/xvdz']['status'], 'failed')
+
+
+class scheduler_test(simulated_test):
+
+    def test_dependencies(self):
+        done = []
+        scheduler = ephemeral_disk.step_scheduler(lambda task: done.append(task) or task['fail'] and ephemeral_disk.exit(2))
+        scheduler.add('partition', {'name': 'partition', 'fail': False})
+        scheduler.add('mkswap', {'name': 'mkswap', 'fail': False}, after=['partition'])
+        scheduler.add('format', {'name': 'format', 'fail': True}, after=['partition'])
+        scheduler.add('mount', {'name': 'mount', 'fail': False}, after=['format'])
+        results = scheduler.run()
+
+        self.assertEqual(done[0]['name'], 'partition')
+        self.assertEqual([results[name]['status'] for name in ('partition', 'mkswap', 'format', 'mount')],
+                         ['ok', 'ok', 'failed', 'skipped'])
+
+    def test_queue_is_tuned_once_mounted(self):
+        self.fail_command('mkfs.ext4')
+        result = self.tools.provision_disks(disks=['/dev/xvdb'], swap_size='8G', queue_profile='streaming')['/dev/xvdb']
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(self.tools.queue_defaults, {})
+
+    def test_errors_fail_the_step(self):
+        # Errors other than exits (e.g. I/O errors) are not taken for success
+        execute = self.backend.execute
+
+        def failing(argv, input=None):
+            if argv[0] == 'mount':
+                raise IOError(5, 'Input/output error')
+            return execute(argv, input)
+
+        self.backend.execute = failing
+        steps = self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt', queue_profile='streaming')
+        self.assertRaises(SystemExit, self.tools.apply_plan, steps)
+        self.assertNotIn('elapsed', steps[3])
+
+        result = self.tools.provision_disks(disks=['/dev/xvdb'], swap_size='8G', queue_profile='streaming')['/dev/xvdb']
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['error'], 'mount: exited with code 2')
+        self.assertEqual(self.tools.queue_defaults, {})
+
+    def test_discard_is_skipped_only_when_unsupported(self):
+        backend = ephemeral_disk.simulated_backend({'nvme1n1': '475G'})
+        tools = ephemeral_disk.tools(force=1, backend=backend)
+        execute = backend.execute
+
+        def failing(argv, input=None):
+            if argv[0] == 'blkdiscard':
+                raise IOError(5, 'Input/output error')
+            return execute(argv, input)
+
+        backend.execute = failing
+        self.assertRaises(SystemExit, tools.apply_step, {'step': 'discard', 'device': '/dev/nvme1n1'})
+        self.assertEqual(tools.discard_devices(['/dev/nvme1n1'])['/dev/nvme1n1']['status'], 'failed')
+        self.assertTrue(self.tools.apply_step({'step': 'discard', 'device': '/dev/xvdb'})['skipped'])
+
+
+class cache_test(simulated_test):
+
+    def setUp(self):
+        simulated_test.setUp(self)
+        self.backend = ephemeral_disk.simulated_backend(self.disks, volumes={'xvdf': '100G'})
+        self.tools = ephemeral_disk.tools(force=1, backend=self.backend)
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+        self.backend.devices['xvdf']['fs'] = 'xfs'
+        self.backend.makedirs('/data')
+
+    def test_create_and_remove(self):
+        self.assertEqual(self.tools.create_cache('/dev/xvdf', '/dev/xvdb2'), '/dev/mapper/ephemeral-cache')
+        self.assertEqual(sorted(self.backend.mapper), ['ephemeral-cache', 'ephemeral-cache-cdata', 'ephemeral-cache-cmeta'])
+        self.assertEqual(self.tools.probe_fs_type('/dev/mapper/ephemeral-cache'), 'xfs')
+        self.assertEqual(sorted(self.tools.holders('/dev/xvdb2')), ['dm-0', 'dm-1'])
+
+        self.tools.remove_cache()
+        self.assertEqual(self.backend.mapper, {})
+        self.assertEqual(self.tools.probe_fs_type('/dev/xvdf'), 'xfs')
+
+    def test_refused(self):
+        # Blocks only written to the cache would be lost on stop
+        self.assertRaises(SystemExit, self.tools.create_cache, '/dev/xvdf', '/dev/xvdb2', mode='writeback')
+        self.assertRaises(SystemExit, self.tools.create_cache, '/dev/xvdf', '/dev/xvdb2', block_size='48K')
+
+        # Origin is never unmounted on our behalf
+        self.tools.mount_partition('/dev/xvdf', '/data')
+        self.assertRaises(SystemExit, self.tools.create_cache, '/dev/xvdf', '/dev/xvdb2')
+        self.assertEqual(self.backend.mapper, {})
+
+    def test_failing_target_is_rolled_back(self):
+        execute = self.backend.execute
+        self.backend.execute = lambda argv, input=None: (1, '', 'failed') if argv[:3] == ['dmsetup', 'create', 'ephemeral-cache'] \
+            else execute(argv, input)
+
+        self.assertRaises(SystemExit, self.tools.create_cache, '/dev/xvdf', '/dev/xvdb2')
+        self.assertEqual(self.backend.mapper, {})
+        self.assertEqual(self.tools.holders('/dev/xvdb2'), [])
+
+    def test_stats(self):
+        self.assertEqual(self.tools.cache_stats(), None)
+
+        self.tools.create_cache('/dev/xvdf', '/dev/xvdb2', block_size='256K')
+        self.backend.devices[self.backend.mapper['ephemeral-cache']]['cache'].update(read_hits=90, read_misses=10, dirty=3)
+
+        stats = self.tools.cache_stats()
+        self.assertEqual((stats['read_hits'], stats['read_misses'], stats['dirty'], stats['used_blocks']), (90, 10, 3, 10))
+        self.assertEqual(stats['read_hit_ratio'], 0.9)
+        self.assertEqual(stats['block_size'], 256 * 1024)
+
+    def test_dirty_blocks_are_written_back(self):
+        self.tools.create_cache('/dev/xvdf', '/dev/xvdb2')
+        self.backend.devices[self.backend.mapper['ephemeral-cache']]['cache']['dirty'] = 3
+
+        # The cleaner policy is loaded before the targets are removed
+        self.tools.remove_cache()
+        self.assertEqual(self.backend.mapper, {})
+        self.assertTrue([span for span in self.tools.spans if span['command'].startswith('dmsetup reload') and 'cleaner' in span['command']])
+
+    def test_mounted_cache_needs_force(self):
+        self.tools.create_cache('/dev/xvdf', '/dev/xvdb2')
+        self.tools.mount_partition('/dev/mapper/ephemeral-cache', '/data')
+
+        tools = ephemeral_disk.tools(backend=self.backend)
+        self.assertRaises(SystemExit, tools.remove_cache)
+        self.assertEqual(len(self.backend.mapper), 3)
+
+        self.tools.remove_cache()
+        self.assertEqual(self.backend.mapper, {})
+        self.assertNotIn('/data', self.backend.mounts)
+
+
+class discard_test(simulated_test):
+
+    disks = {'nvme1n1': '475G', 'xvdb': '335G'}
+
+    def test_discard(self):
+        self.tools.write_partition_table('/dev/nvme1n1', [('8G', 'swap'), (None, 'linux')])
+        self.tools.format_partition('/dev/nvme1n1p2', 'ext4')
+
+        self.assertTrue(self.tools.discard_partition('/dev/nvme1n1p2') >= 0)
+        self.assertEqual(self.tools.probe_fs_type('/dev/nvme1n1p2'), None)
+
+    def test_unsupported_device_is_skipped(self):
+        commands = self.backend.commands
+        self.assertFalse(self.tools.supports_discard('/dev/xvdb'))
+        self.assertEqual(self.tools.discard_partition('/dev/xvdb'), None)
+        self.assertEqual(self.backend.commands, commands)
+
+    def test_mounted_partition_needs_force(self):
+        self.tools.write_partition_table('/dev/nvme1n1', [('8G', 'swap'), (None, 'linux')])
+        self.tools.format_partition('/dev/nvme1n1p2', 'ext4')
+        self.tools.mount_partition('/dev/nvme1n1p2', '/mnt')
+
+        self.tools.force = 0
+        self.assertRaises(SystemExit, self.tools.discard_partition, '/dev/nvme1n1p2')
+
+    def test_plan(self):
+        steps = self.tools.plan_disk('/dev/nvme1n1', '8G', 'ext4', '/mnt', discard='disk')
+        self.assertEqual([step['step'] for step in steps], ['discard', 'partition', 'mkswap', 'format', 'mount'])
+        self.assertEqual(steps[0]['device'], '/dev/nvme1n1')
+
+        steps = self.tools.plan_disk('/dev/nvme1n1', '8G', 'ext4', '/mnt', discard='partition')
+        self.assertEqual([step['step'] for step in steps], ['partition', 'mkswap', 'discard', 'format', 'mount'])
+        self.assertEqual(steps[2]['device'], '/dev/nvme1n1p2')
+
+        self.tools.apply_plan(steps)
+        self.assertFalse(steps[2]['skipped'])
+
+        # Only a data partition that gets formatted again is discarded
+        self.assertEqual(self.tools.plan_disk('/dev/nvme1n1', '8G', 'ext4', '/mnt', discard='disk'), [])
+        steps = self.tools.plan_disk('/dev/nvme1n1', '8G', 'xfs', '/data', discard='disk')
+        self.assertEqual([step['step'] for step in steps], ['discard', 'format', 'mount'])
+
+    def test_plan_on_unsupported_device(self):
+        steps = self.tools.apply_plan(self.tools.plan_disk('/dev/xvdb', '8G', 'ext4', '/mnt', discard='disk'))
+        self.assertTrue(steps[0]['skipped'])
+        self.assertEqual(self.tools.probe_fs_type('/dev/xvdb2'), 'ext4')
+
+    def test_discard_devices(self):
+        results = self.tools.discard_devices(['/dev/nvme1n1', '/dev/xvdb'])
+
+        self.assertEqual(results['/dev/nvme1n1']['status'], 'ok')
+        self.assertEqual(results['/dev/xvdb']['status'], 'skipped')
+        self.assertEqual(self.tools.discard_results, results)
+
+
+class prewarm_test(simulated_test):
+
+    disks = {'xvdb': '64M', 'xvdc': '64M'}
+
+    def setUp(self):
+        simulated_test.setUp(self)
+        self.backend.makedirs('/var/lib/ephemeral_disk')
+        self.state = '/var/lib/ephemeral_disk/prewarm.json'
+
+    def test_read(self):
+        results = self.tools.prewarm(['/dev/xvdb', '/dev/xvdc'], chunk='4M')
+
+        self.assertEqual([results[device]['bytes'] for device in sorted(results)], [64 * 1024 ** 2] * 2)
+        self.assertEqual(self.tools.prewarm_status['/dev/xvdb']['status'], 'ok')
+
+    def test_resume(self):
+        def interrupt(device, offset, size):
+            if offset >= size // 2:
+                raise IOError(5, 'Input/output error')
+
+        result = self.tools.prewarm('/dev/xvdb', chunk='4M', state=self.state, progress=interrupt)['/dev/xvdb']
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(json.loads(self.backend.files[self.state])['/dev/xvdb']['offset'], 32 * 1024 ** 2)
+
+        result = self.tools.prewarm('/dev/xvdb', chunk='4M', state=self.state)['/dev/xvdb']
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(result['bytes'], 32 * 1024 ** 2)
+
+        # Another mode starts over
+        self.assertEqual(self.tools.prewarm('/dev/xvdb', 'zero', state=self.state)['/dev/xvdb']['bytes'], 64 * 1024 ** 2)
+
+    def test_bandwidth(self):
+        started = ephemeral_disk.time.time()
+        self.tools.prewarm(['/dev/xvdb', '/dev/xvdc'], chunk='4M', bandwidth='512M')
+
+        # 128M at 512M per second for both devices together
+        self.assertTrue(ephemeral_disk.time.time() - started >= 0.2)
+
+    def test_zero(self):
+        self.tools.write_partition_table('/dev/xvdb', [(None, 'linux')])
+        self.tools.format_partition('/dev/xvdb1', 'ext4')
+        self.assertEqual(self.tools.prewarm('/dev/xvdb1', 'zero')['/dev/xvdb1']['status'], 'ok')
+        self.assertEqual(self.tools.probe_fs_type('/dev/xvdb1'), None)
+
+        # Mounted partitions, or the disk they are on, are never zeroed
+        self.tools.format_partition('/dev/xvdb1', 'ext4')
+        self.tools.mount_partition('/dev/xvdb1', '/mnt')
+        self.assertEqual(self.tools.prewarm('/dev/xvdb1', 'zero')['/dev/xvdb1']['status'], 'failed')
+        self.assertEqual(self.tools.prewarm('/dev/xvdb', 'zero')['/dev/xvdb']['status'], 'failed')
+        self.assertEqual(self.tools.prewarm('/dev/xvdb1', 'read')['/dev/xvdb1']['status'], 'ok')
+
+    def test_background(self):
+        thread = self.tools.prewarm('/dev/xvdb', background=True)
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.tools.prewarm_status['/dev/xvdb']['bytes'], 64 * 1024 ** 2)
+
+
+class hydrate_test(simulated_test):
+
+    def setUp(self):
+        simulated_test.setUp(self)
+        self.tools.write_partition_table('/dev/xvdb', [('8G', 'swap'), (None, 'linux')])
+        self.tools.format_partition('/dev/xvdb2', 'ext4')
+        self.backend.makedirs('/mnt')
+        self.tools.mount_partition('/dev/xvdb2', '/mnt')
+        self.backend.makedirs('/etc')
+        self.backend.makedirs('/var/lib/seed')
+
+    def archive(self, path, members, mode='w'):
+        """ Write a tar archive with members given as {name: data}, where data
+            starting with '->' stands for a symbolic link """
+
+        buffer = StringIO.StringIO()
+        archive = tarfile.open(fileobj=buffer, mode=mode)
+        for name, data in sorted(members.items()):
+            member = tarfile.TarInfo(name)
+            if data.startswith('->'):
+                member.type = tarfile.SYMTYPE
+                member.linkname = data[2:]
+                archive.addfile(member)
+            else:
+                member.size = len(data)
+                archive.addfile(member, StringIO.StringIO(data))
+        archive.close()
+        self.backend.files[path] = buffer.getvalue()
+
+    def test_directory(self):
+        self.backend.makedirs('/var/lib/seed/cache/index')
+        self.backend.files['/var/lib/seed/cache/data.db'] = 'a' * 4096
+        self.backend.files['/var/lib/seed/cache/index/data.idx'] = 'b' * 512
+
+        result = self.tools.hydrate('/var/lib/seed/cache', '/mnt')
+        self.assertEqual((result['status'], result['files'], result['bytes']), ('ok', 2, 4608))
+        self.assertEqual(self.backend.files['/mnt/index/data.idx'], 'b' * 512)
+        self.assertEqual(json.loads(self.backend.files['/mnt/.hydrated'])['files'], 2)
+
+        # Nothing is copied again once marked
+        self.assertEqual(self.tools.hydrate('/var/lib/seed/cache', '/mnt')['status'], 'skipped')
+
+    def test_archives(self):
+        self.archive('/var/lib/seed/cache.tar', {'data.db': 'a' * 4096, 'index/data.idx': 'b' * 512, 'latest': '->data.db'})
+        self.archive('/var/lib/seed/cache.tar.gz', {'data.db': 'c' * 4096}, 'w:gz')
+
+        result = self.tools.hydrate('/var/lib/seed/cache.tar', '/mnt')
+        self.assertEqual((result['status'], result['methods']), ('ok', {'copy_file_range': 2}))
+        self.assertEqual(self.backend.readlink('/mnt/latest'), 'data.db')
+
+        result = self.tools.hydrate('/var/lib/seed/cache.tar.gz', '/mnt', force=True)
+        self.assertEqual((result['status'], result['methods']), ('ok', {'read': 1}))
+        self.assertEqual(self.backend.files['/mnt/data.db'], 'c' * 4096)
+
+    def test_members_outside_are_refused(self):
+        self.archive('/var/lib/seed/cache.tar', {'../etc/passwd': 'root::0:0::/root:/bin/sh'})
+
+        result = self.tools.hydrate('/var/lib/seed/cache.tar', '/mnt')
+        self.assertEqual(result['status'], 'failed')
+        self.assertNotIn('/etc/passwd', self.backend.files)
+        self.assertFalse(self.backend.exists('/mnt/.hydrated'))
+
+    def test_links_are_not_followed(self):
+        # A link left by a first seed must not lead a later one out of mount_point
+        self.archive('/var/lib/seed/first.tar', {'lnk': '->/etc'})
+        self.archive('/var/lib/seed/second.tar', {'lnk/passwd': 'root::0:0::/root:/bin/sh'})
+        self.assertEqual(self.tools.hydrate('/var/lib/seed/first.tar', '/mnt')['status'], 'ok')
+
+        result = self.tools.hydrate('/var/lib/seed/second.tar', '/mnt', force=True)
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['errors']['/mnt/lnk/passwd'], '/mnt/lnk is a symbolic link, it is not followed')
+        self.assertNotIn('/etc/passwd', self.backend.files)
+
+        # Nor by a seed directory
+        self.backend.makedirs('/var/lib/seed/cache/lnk')
+        self.backend.files['/var/lib/seed/cache/lnk/passwd'] = 'root::0:0::/root:/bin/sh'
+        self.assertEqual(self.tools.hydrate('/var/lib/seed/cache', '/mnt', force=True)['status'], 'failed')
+        self.assertNotIn('/etc/passwd', self.backend.files)
+
+    def test_mount_point_must_be_mounted(self):
+        self.backend.makedirs('/data')
+        self.backend.files['/var/lib/seed/data.db'] = 'a'
+
+        self.assertRaises(SystemExit, self.tools.hydrate, '/var/lib/seed', '/data')
+        self.assertRaises(SystemExit, self.tools.hydrate, '/var/lib/seed', '/cache')
+
+
+class metadata_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Stand-in for the metadata service, answering as told by the server """
+
+    def do_PUT(self):
+        self.answer('PUT')
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def answer(self, method):
+        server = self.server
+        server.requests.append((method, self.path, self.headers.get('X-aws-ec2-metadata-token')))
+        ephemeral_disk.time.sleep(server.delay)
+
+        if server.failures:
+            server.failures -= 1
+            code, body = 500, 'busy'
+        elif method == 'PUT':
+            code, body = (200, 'token-{0}'.format(len(server.requests))) if server.tokens else (405, '')
+        elif server.tokens and self.headers.get('X-aws-ec2-metadata-token') not in server.valid_tokens():
+            code, body = 401, ''
+        else:
+            code, body = (200, server.values[self.path]) if self.path in server.values else (404, '')
+
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class metadata_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Answers as the metadata service would, after delay seconds, with
+        failures server errors first. Requests are kept in requests """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), metadata_handler)
+        self.requests = []
+        self.delay = 0
+        self.failures = 0
+        self.tokens = True
+        self.revoked = set()
+        self.values = {'/latest/meta-data/instance-type': 'c5d.large'}
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on a slow answer close the connection first
+        pass
+
+    def valid_tokens(self):
+        return set('token-{0}'.format(index + 1) for index, request in enumerate(self.requests)
+                   if request[0] == 'PUT') - self.revoked
+
+
+class metadata_test(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.server = metadata_server()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+        # Identity of the instance answers are cached for
+        self.backend = ephemeral_disk.simulated_backend()
+        self.backend.files['/sys/hypervisor/uuid'] = 'ec2-instance-one\n'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        logging.disable(logging.NOTSET)
+
+    def client(self, **options):
+        options.setdefault('cache', None)
+        options.setdefault('timeout', 1)
+        options.setdefault('retries', 2)
+        return ephemeral_disk.metadata_client(self.url, backend=self.backend, **options)
+
+    def test_token_is_reused(self):
+        client = self.client()
+        self.server.values['/latest/meta-data/placement/availability-zone'] = 'eu-west-1a'
+
+        self.assertEqual(client.get('instance-type'), 'c5d.large')
+        self.assertEqual(client.get('placement/availability-zone'), 'eu-west-1a')
+        self.assertEqual([request[0] for request in self.server.requests], ['PUT', 'GET', 'GET'])
+        self.assertEqual(set(request[2] for request in self.server.requests[1:]), set(['token-1']))
+
+    def test_revoked_token_is_renewed(self):
+        client = self.client()
+        client.get('instance-type')
+        self.server.revoked.add('token-1')
+        self.server.values['/latest/meta-data/ami-id'] = 'ami-12345678'
+
+        self.assertEqual(client.get('ami-id'), 'ami-12345678')
+        self.assertEqual(self.server.requests[-1][2], 'token-4')
+
+    def test_imdsv1_without_token(self):
+        self.server.tokens = False
+
+        self.assertEqual(self.client().get('instance-type'), 'c5d.large')
+        self.assertEqual(self.server.requests[-1], ('GET', '/latest/meta-data/instance-type', None))
+
+    def test_server_errors_are_retried(self):
+        self.server.failures = 2
+
+        self.assertEqual(self.client().get('instance-type'), 'c5d.large')
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = 100
+
+        # The token is retried, then the plain request without it
+        self.assertEqual(self.client().get('instance-type'), None)
+        self.assertEqual([request[0] for request in self.server.requests], ['PUT'] * 3 + ['GET'] * 3)
+
+    def test_unreachable_service(self):
+        self.server.shutdown()
+        self.server.server_close()
+        client = ephemeral_disk.metadata_client('http://127.0.0.1:1', timeout=0.2, retries=1, cache=None, backend=self.backend)
+
+        self.assertEqual(client.get('instance-type'), None)
+
+    def test_slow_service_times_out(self):
+        self.server.delay = 1
+        started = ephemeral_disk.time.time()
+
+        self.assertEqual(self.client(timeout=0.1, retries=1).get('instance-type'), None)
+        self.assertTrue(ephemeral_disk.time.time() - started < 1)
+
+    def test_answers_are_cached(self):
+        self.backend.makedirs('/var/cache/ephemeral_disk')
+        cache = '/var/cache/ephemeral_disk/metadata.json'
+
+        self.assertEqual(self.client(cache=cache).get('instance-type'), 'c5d.large')
+        requests = len(self.server.requests)
+        self.assertEqual(self.client(cache=cache).get('instance-type'), 'c5d.large')
+        self.assertEqual(len(self.server.requests), requests)
+        self.assertEqual(json.loads(self.backend.files[cache])['identity'], 'ec2-instance-one')
+
+    def test_cache_of_another_instance_is_ignored(self):
+        self.backend.makedirs('/var/cache/ephemeral_disk')
+        cache = '/var/cache/ephemeral_disk/metadata.json'
+        self.backend.files[cache] = json.dumps({'identity': 'ec2-instance-two', 'values': {'instance-type': 'm1.small'}})
+
+        self.assertEqual(self.client(cache=cache).get('instance-type'), 'c5d.large')
+
+    def test_nitro_identity(self):
+        self.backend.files['/sys/devices/virtual/dmi/id/board_asset_tag'] = 'i-0123456789abcdef0\n'
+        self.assertEqual(self.client().identify(), 'i-0123456789abcdef0')
+
+    def test_discovery_reads_metadata_once(self):
+        # Instance store disks of Xen instances are only known through the block device mapping
+        self.server.values['/latest/meta-data/block-device-mapping/'] = 'ami\nephemeral0\nroot'
+        self.server.values['/latest/meta-data/block-device-mapping/ephemeral0'] = 'sdb'
+        self.backend.makedirs('/var/cache/ephemeral_disk')
+        cache = '/var/cache/ephemeral_disk/metadata.json'
+
+        tools = ephemeral_disk.tools(force=1, backend=self.backend, metadata=self.client(cache=cache))
+        self.assertEqual(tools.provision_disks(swap_size='8G')['/dev/xvdb']['status'], 'ok')
+        requests = len(self.server.requests)
+        self.assertEqual([request[1] for request in self.server.requests if request[0] == 'GET'],
+                         ['/latest/meta-data/block-device-mapping/', '/latest/meta-data/block-device-mapping/ephemeral0'])
+
+        # After a reboot answers come from the cache, and disk sizes from sysfs
+        self.backend.mounts.pop('/mnt')
+        self.backend.swaps.clear()
+        tools = ephemeral_disk.tools(force=1, backend=self.backend, metadata=self.client(cache=cache))
+        self.assertEqual(tools.provision_disks(swap_size='8G', idempotent=True)['/dev/xvdb']['steps'], ['swapon', 'mount'])
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_nvme_provisioning_reads_no_metadata(self):
+        backend = ephemeral_disk.simulated_backend({'nvme1n1': '475G'})
+        tools = ephemeral_disk.tools(force=1, backend=backend, metadata=self.client())
+
+        self.assertEqual(tools.provision_disks(swap_size='8G')['/dev/nvme1n1']['status'], 'ok')
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()